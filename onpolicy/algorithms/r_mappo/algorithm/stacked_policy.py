@@ -0,0 +1,136 @@
+import copy
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
+
+from onpolicy.algorithms.utils.distributions import FixedCategorical
+from onpolicy.algorithms.utils.mlp import MLPBase
+from onpolicy.algorithms.utils.rnn import gru_cell
+from onpolicy.algorithms.utils.util import check
+
+
+class StackedPolicy:
+    """
+    Evaluates the actors and critics of several separated R_MAPPOPolicy instances in single batched calls.
+    Their parameters are stacked along a leading agent dimension, so refresh() has to be called after the
+    policies have been updated. Only MLP bases and Discrete action spaces are supported.
+
+    :param args: (argparse.Namespace) arguments containing relevant model and policy information.
+    :param policies: (list) R_MAPPOPolicy of every agent, all with the same architecture.
+    :param device: (torch.device) specifies the device to run on (cpu/gpu).
+    """
+
+    def __init__(self, args, policies, device=torch.device("cpu")):
+        self.policies = policies
+        self.tpdv = dict(dtype=torch.float32, device=device)
+        self._use_recurrent = args.use_naive_recurrent_policy or args.use_recurrent_policy
+        self._recurrent_N = args.recurrent_N
+
+        for policy in policies:
+            assert policy.act_space.__class__.__name__ == 'Discrete', "stacked inference only supports Discrete actions"
+            assert isinstance(policy.actor.base, MLPBase) and isinstance(policy.critic.base, MLPBase), \
+                "stacked inference only supports MLP bases"
+
+        # parameter-free copies of the bases, called with the stacked parameters
+        self.actor_base = copy.deepcopy(policies[0].actor.base).to('meta')
+        self.critic_base = copy.deepcopy(policies[0].critic.base).to('meta')
+        self.actor_rnn = None
+        self.critic_rnn = None
+
+        self.refresh()
+
+    @torch.no_grad()
+    def refresh(self):
+        """Re-stack the parameters of the wrapped policies."""
+        actors = [policy.actor for policy in self.policies]
+        critics = [policy.critic for policy in self.policies]
+
+        self.actor_base_state = stack_module_state([actor.base for actor in actors])
+        self.critic_base_state = stack_module_state([critic.base for critic in critics])
+        if self._use_recurrent:
+            self.actor_rnn = self._stack_rnn([actor.rnn for actor in actors])
+            self.critic_rnn = self._stack_rnn([critic.rnn for critic in critics])
+
+        self.act_weight = self._stack([actor.act.action_out.linear.weight for actor in actors])
+        self.act_bias = self._stack([actor.act.action_out.linear.bias for actor in actors])
+        self.v_weight = self._stack([critic.v_out.weight for critic in critics])
+        self.v_bias = self._stack([critic.v_out.bias for critic in critics])
+
+    def _stack(self, tensors):
+        return torch.stack([tensor.detach() for tensor in tensors])
+
+    def _stack_rnn(self, rnns):
+        layers = []
+        for layer in range(self._recurrent_N):
+            layers.append([self._stack([getattr(rnn.rnn, name % layer) for rnn in rnns])
+                           for name in ('weight_ih_l%d', 'weight_hh_l%d', 'bias_ih_l%d', 'bias_hh_l%d')])
+        norm = (self._stack([rnn.norm.weight for rnn in rnns]), self._stack([rnn.norm.bias for rnn in rnns]))
+        return layers, norm
+
+    def _linear(self, x, weight, bias):
+        return torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+
+    def _rnn(self, rnn, x, hxs, masks):
+        layers, (norm_weight, norm_bias) = rnn
+        next_hxs = []
+        for layer, (w_ih, w_hh, b_ih, b_hh) in enumerate(layers):
+            h = hxs[:, :, layer] * masks
+            x = gru_cell(self._linear(x, w_ih, b_ih), self._linear(h, w_hh, b_hh), h)
+            next_hxs.append(x)
+        x = vmap(lambda x, w, b: F.layer_norm(x, w.shape, w, b))(x, norm_weight, norm_bias)
+        return x, torch.stack(next_hxs, dim=2)
+
+    def _features(self, base, base_state, rnn, x, rnn_states, masks):
+        x = vmap(lambda params, buffers, x: functional_call(base, (params, buffers), (x,)))(*base_state, x)
+        if self._use_recurrent:
+            x, rnn_states = self._rnn(rnn, x, rnn_states, masks)
+        return x, rnn_states
+
+    def _actions(self, obs, rnn_states_actor, masks, available_actions, deterministic):
+        actor_features, rnn_states_actor = self._features(self.actor_base, self.actor_base_state,
+                                                          self.actor_rnn, obs, rnn_states_actor, masks)
+        logits = self._linear(actor_features, self.act_weight, self.act_bias)
+        if available_actions is not None:
+            logits[available_actions == 0] = -1e10
+        action_logits = FixedCategorical(logits=logits)
+        actions = action_logits.mode() if deterministic else action_logits.sample()
+        action_log_probs = action_logits.log_prob(actions.squeeze(-1)).unsqueeze(-1)
+        return actions, action_log_probs, rnn_states_actor
+
+    @torch.no_grad()
+    def get_actions(self, cent_obs, obs, rnn_states_actor, rnn_states_critic, masks, available_actions=None,
+                    deterministic=False):
+        """
+        Compute actions and value function predictions of all agents. Inputs and outputs carry a leading
+        agent dimension and otherwise match R_MAPPOPolicy.get_actions.
+        """
+        cent_obs = check(cent_obs).to(**self.tpdv)
+        obs = check(obs).to(**self.tpdv)
+        rnn_states_actor = check(rnn_states_actor).to(**self.tpdv)
+        rnn_states_critic = check(rnn_states_critic).to(**self.tpdv)
+        masks = check(masks).to(**self.tpdv)
+        if available_actions is not None:
+            available_actions = check(available_actions).to(**self.tpdv)
+
+        actions, action_log_probs, rnn_states_actor = self._actions(obs, rnn_states_actor, masks,
+                                                                    available_actions, deterministic)
+
+        critic_features, rnn_states_critic = self._features(self.critic_base, self.critic_base_state,
+                                                            self.critic_rnn, cent_obs,
+                                                            rnn_states_critic, masks)
+        values = self._linear(critic_features, self.v_weight, self.v_bias)
+        return values, actions, action_log_probs, rnn_states_actor, rnn_states_critic
+
+    @torch.no_grad()
+    def act(self, obs, rnn_states_actor, masks, available_actions=None, deterministic=False):
+        """
+        Compute actions of all agents, see R_MAPPOPolicy.act. Inputs and outputs carry a leading agent dimension.
+        """
+        obs = check(obs).to(**self.tpdv)
+        rnn_states_actor = check(rnn_states_actor).to(**self.tpdv)
+        masks = check(masks).to(**self.tpdv)
+        if available_actions is not None:
+            available_actions = check(available_actions).to(**self.tpdv)
+
+        actions, _, rnn_states_actor = self._actions(obs, rnn_states_actor, masks, available_actions, deterministic)
+        return actions, rnn_states_actor
@@ -1,8 +1,10 @@
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 from onpolicy.utils.util import get_gard_norm, huber_loss, mse_loss
 from onpolicy.utils.valuenorm import ValueNorm
+from onpolicy.utils.prefetch import MinibatchPrefetcher
 from onpolicy.algorithms.utils.util import check
 
 class R_MAPPO():
@@ -39,16 +41,58 @@ class R_MAPPO():
         self._use_valuenorm = args.use_valuenorm
         self._use_value_active_masks = args.use_value_active_masks
         self._use_policy_active_masks = args.use_policy_active_masks
+        self._use_prefetch = args.use_prefetch
+        self.prefetch_queue_size = args.prefetch_queue_size
+        self._use_distributed = args.use_distributed
         
         assert (self._use_popart and self._use_valuenorm) == False, ("self._use_popart and self._use_valuenorm can not be set True simultaneously")
+        assert not (self._use_popart and self._use_distributed), ("PopArt statistics are not synchronized across learner processes")
         
         if self._use_popart:
             self.value_normalizer = self.policy.critic.v_out
         elif self._use_valuenorm:
-            self.value_normalizer = ValueNorm(1, device = self.device)
+            self.value_normalizer = ValueNorm(1, device = self.device, distributed = self._use_distributed)
         else:
             self.value_normalizer = None
 
+        if self._use_distributed:
+            # all learner processes start from the weights of the first one
+            self.world_size = dist.get_world_size()
+            for param in list(self.policy.actor.parameters()) + list(self.policy.critic.parameters()):
+                dist.broadcast(param.data, src=0)
+
+    def all_reduce_grads(self, parameters):
+        """
+        Average gradients over all learner processes.
+        :param parameters: (iterable) parameters whose gradients are averaged, in the same order in every process.
+        """
+        grads = [param.grad for param in parameters if param.grad is not None]
+        if len(grads) == 0:
+            return
+        # one collective for all gradients instead of one per tensor
+        flat_grads = torch.cat([grad.reshape(-1) for grad in grads])
+        dist.all_reduce(flat_grads)
+        flat_grads /= self.world_size
+        offset = 0
+        for grad in grads:
+            grad.copy_(flat_grads[offset:offset + grad.numel()].view_as(grad))
+            offset += grad.numel()
+
+    def global_mean_std(self, x):
+        """
+        Mean and standard deviation of x over the data of all learner processes.
+        :param x: (np.ndarray / torch.Tensor) local values.
+
+        :return mean: (float) global mean.
+        :return std: (float) global standard deviation.
+        """
+        x = check(x).to(dtype=torch.float64, device="cpu")
+        stats = torch.stack([x.sum(), (x ** 2).sum(), torch.tensor(x.numel(), dtype=torch.float64)])
+        dist.all_reduce(stats)
+        total, total_sq, count = stats.tolist()
+        mean = total / count
+        return mean, max(total_sq / count - mean ** 2, 0.0) ** 0.5
+
     def cal_value_loss(self, values, value_preds_batch, return_batch, active_masks_batch):
         """
         Calculate value function loss.
@@ -140,6 +184,9 @@ class R_MAPPO():
         if update_actor:
             (policy_loss - dist_entropy * self.entropy_coef).backward()
 
+        if self._use_distributed:
+            self.all_reduce_grads(self.policy.actor.parameters())
+
         if self._use_max_grad_norm:
             actor_grad_norm = nn.utils.clip_grad_norm_(self.policy.actor.parameters(), self.max_grad_norm)
         else:
@@ -154,6 +201,9 @@ class R_MAPPO():
 
         (value_loss * self.value_loss_coef).backward()
 
+        if self._use_distributed:
+            self.all_reduce_grads(self.policy.critic.parameters())
+
         if self._use_max_grad_norm:
             critic_grad_norm = nn.utils.clip_grad_norm_(self.policy.critic.parameters(), self.max_grad_norm)
         else:
@@ -163,22 +213,36 @@ class R_MAPPO():
 
         return value_loss, critic_grad_norm, policy_loss, dist_entropy, actor_grad_norm, imp_weights
 
-    def train(self, buffer, update_actor=True):
+    def train(self, buffer, update_actor=True, generator=None, value_normalizer=None):
         """
         Perform a training update using minibatch GD.
         :param buffer: (SharedReplayBuffer) buffer containing training data.
         :param update_actor: (bool) whether to update actor network.
+        :param generator: (torch.Generator) optional generator used to shuffle minibatches, global RNG if None.
+        :param value_normalizer: (ValueNorm / PopArt) normalizer the value predictions in buffer were made with,
+                                 the trainer's own if None.
 
         :return train_info: (dict) contains information regarding training update (e.g. loss, grad norms, etc).
         """
+        if value_normalizer is None:
+            value_normalizer = self.value_normalizer
         if self._use_popart or self._use_valuenorm:
-            advantages = buffer.returns[:-1] - self.value_normalizer.denormalize(buffer.value_preds[:-1])
+            advantages = buffer.returns[:-1] - value_normalizer.denormalize(buffer.value_preds[:-1])
         else:
             advantages = buffer.returns[:-1] - buffer.value_preds[:-1]
-        advantages_copy = advantages.copy()
-        advantages_copy[buffer.active_masks[:-1] == 0.0] = np.nan
-        mean_advantages = np.nanmean(advantages_copy)
-        std_advantages = np.nanstd(advantages_copy)
+        if self._use_distributed:
+            # normalize with the statistics of all learners' shards
+            mean_advantages, std_advantages = self.global_mean_std(advantages[buffer.active_masks[:-1] != 0.0])
+        elif torch.is_tensor(advantages):
+            # device-resident buffer, normalize without leaving the device
+            active_advantages = advantages[buffer.active_masks[:-1] != 0.0]
+            mean_advantages = active_advantages.mean()
+            std_advantages = active_advantages.std(unbiased=False)
+        else:
+            advantages_copy = advantages.copy()
+            advantages_copy[buffer.active_masks[:-1] == 0.0] = np.nan
+            mean_advantages = np.nanmean(advantages_copy)
+            std_advantages = np.nanstd(advantages_copy)
         advantages = (advantages - mean_advantages) / (std_advantages + 1e-5)
         
 
@@ -193,23 +257,31 @@ class R_MAPPO():
 
         for _ in range(self.ppo_epoch):
             if self._use_recurrent_policy:
-                data_generator = buffer.recurrent_generator(advantages, self.num_mini_batch, self.data_chunk_length)
+                data_generator = buffer.recurrent_generator(advantages, self.num_mini_batch, self.data_chunk_length,
+                                                            generator=generator)
             elif self._use_naive_recurrent:
-                data_generator = buffer.naive_recurrent_generator(advantages, self.num_mini_batch)
+                data_generator = buffer.naive_recurrent_generator(advantages, self.num_mini_batch, generator=generator)
             else:
-                data_generator = buffer.feed_forward_generator(advantages, self.num_mini_batch)
-
-            for sample in data_generator:
-
-                value_loss, critic_grad_norm, policy_loss, dist_entropy, actor_grad_norm, imp_weights \
-                    = self.ppo_update(sample, update_actor)
-
-                train_info['value_loss'] += value_loss.item()
-                train_info['policy_loss'] += policy_loss.item()
-                train_info['dist_entropy'] += dist_entropy.item()
-                train_info['actor_grad_norm'] += actor_grad_norm
-                train_info['critic_grad_norm'] += critic_grad_norm
-                train_info['ratio'] += imp_weights.mean()
+                data_generator = buffer.feed_forward_generator(advantages, self.num_mini_batch, generator=generator)
+            if self._use_prefetch:
+                data_generator = MinibatchPrefetcher(data_generator, self.device, self.prefetch_queue_size)
+
+            try:
+                for sample in data_generator:
+
+                    value_loss, critic_grad_norm, policy_loss, dist_entropy, actor_grad_norm, imp_weights \
+                        = self.ppo_update(sample, update_actor)
+
+                    train_info['value_loss'] += value_loss.item()
+                    train_info['policy_loss'] += policy_loss.item()
+                    train_info['dist_entropy'] += dist_entropy.item()
+                    train_info['actor_grad_norm'] += actor_grad_norm
+                    train_info['critic_grad_norm'] += critic_grad_norm
+                    train_info['ratio'] += imp_weights.mean()
+            finally:
+                if self._use_prefetch:
+                    # stops the prefetch thread if the update failed half way
+                    data_generator.close()
 
         num_updates = self.ppo_epoch * self.num_mini_batch
 
@@ -86,13 +86,16 @@ class PopArt(torch.nn.Module):
         return out
 
     def denormalize(self, input_vector):
-        if type(input_vector) == np.ndarray:
+        # numpy arrays are returned as numpy arrays, tensors stay tensors
+        is_numpy = type(input_vector) == np.ndarray
+        if is_numpy:
             input_vector = torch.from_numpy(input_vector)
         input_vector = input_vector.to(**self.tpdv)
 
         mean, var = self.debiased_mean_var()
         out = input_vector * torch.sqrt(var)[(None,) * self.norm_axes] + mean[(None,) * self.norm_axes]
         
-        out = out.cpu().numpy()
+        if is_numpy:
+            out = out.cpu().numpy()
 
         return out
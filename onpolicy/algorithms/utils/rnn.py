@@ -1,14 +1,29 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 """RNN modules."""
 
 
+def gru_cell(gi, gh, h):
+    """
+    GRU cell update, matching nn.GRU, from precomputed input (gi) and hidden (gh) projections.
+    The gates are split along the last dimension, so any leading batch dimensions are allowed.
+    """
+    i_r, i_z, i_n = gi.chunk(3, -1)
+    h_r, h_z, h_n = gh.chunk(3, -1)
+    r = torch.sigmoid(i_r + h_r)
+    z = torch.sigmoid(i_z + h_z)
+    n = torch.tanh(i_n + r * h_n)
+    return n + z * (h - n)
+
+
 class RNNLayer(nn.Module):
-    def __init__(self, inputs_dim, outputs_dim, recurrent_N, use_orthogonal):
+    def __init__(self, inputs_dim, outputs_dim, recurrent_N, use_orthogonal, use_masked_scan=False):
         super(RNNLayer, self).__init__()
         self._recurrent_N = recurrent_N
         self._use_orthogonal = use_orthogonal
+        self._use_masked_scan = use_masked_scan
 
         self.rnn = nn.GRU(inputs_dim, outputs_dim, num_layers=self._recurrent_N)
         for name, param in self.rnn.named_parameters():
@@ -27,6 +42,8 @@ class RNNLayer(nn.Module):
                               (hxs * masks.repeat(1, self._recurrent_N).unsqueeze(-1)).transpose(0, 1).contiguous())
             x = x.squeeze(0)
             hxs = hxs.transpose(0, 1)
+        elif self._use_masked_scan:
+            x, hxs = self._masked_scan(x, hxs, masks)
         else:
             # x is a (T, N, -1) tensor that has been flatten to (T * N, -1)
             N = hxs.size(0)
@@ -78,3 +95,37 @@ class RNNLayer(nn.Module):
 
         x = self.norm(x)
         return x, hxs
+
+    def _masked_scan(self, x, hxs, masks):
+        """
+        Run the GRU over a (T * N, -1) sequence in one time scan, resetting hidden states wherever masks are zero,
+        instead of splitting the sequence at every step where any mask is zero.
+        Input projections are computed for all steps at once, only the hidden projection is done per step.
+        """
+        N = hxs.size(0)
+        T = int(x.size(0) / N)
+
+        x = x.view(T, N, x.size(1))
+        masks = masks.view(T, N, 1)
+        hxs = hxs.transpose(0, 1)
+
+        next_hxs = []
+        for layer in range(self._recurrent_N):
+            w_ih = getattr(self.rnn, 'weight_ih_l%d' % layer)
+            w_hh = getattr(self.rnn, 'weight_hh_l%d' % layer)
+            b_ih = getattr(self.rnn, 'bias_ih_l%d' % layer)
+            b_hh = getattr(self.rnn, 'bias_hh_l%d' % layer)
+
+            gi = F.linear(x, w_ih, b_ih)
+            h = hxs[layer]
+            outputs = []
+            for t in range(T):
+                h = h * masks[t]
+                h = gru_cell(gi[t], F.linear(h, w_hh, b_hh), h)
+                outputs.append(h)
+            x = torch.stack(outputs)
+            next_hxs.append(h)
+
+        x = x.reshape(T * N, -1)
+        hxs = torch.stack(next_hxs, dim=1)
+        return x, hxs
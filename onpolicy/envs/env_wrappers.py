@@ -3,8 +3,10 @@ Modified from OpenAI Baselines code to work with multi-agent envs
 """
 import numpy as np
 import torch
-from multiprocessing import Process, Pipe
+from multiprocessing import Process, Pipe, resource_tracker, shared_memory
+from multiprocessing.connection import wait
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from onpolicy.utils.util import tile_images
 
 
@@ -375,7 +377,24 @@ class ShareSubprocVecEnv(ShareVecEnv): #Starcraft
         results = [remote.recv() for remote in self.remotes]
         self.waiting = False
         obs, share_obs, rews, dones, infos, available_actions = zip(*results)
-        return np.stack(obs), np.stack(share_obs), np.stack(rews), np.stack(dones), infos, np.stack(available_actions)
+        return np.stack(obs), np.stack(share_obs), np.stack(rews), np.stack(dones), np.stack(infos), np.stack(available_actions)
+
+    def step_async_envs(self, actions, env_ids):
+        """
+        Like step_async, but only for the envs in env_ids, so that the other
+        envs can be acted on while these are stepping. Every call has to be
+        matched by a step_wait_envs call with the same env_ids.
+        :param actions: (np.ndarray) actions of shape (len(env_ids), n_agents, ...).
+        :param env_ids: (np.ndarray) ids of the envs to step.
+        """
+        for env_id, action in zip(env_ids, actions):
+            self.remotes[env_id].send(('step', action))
+
+    def step_wait_envs(self, env_ids):
+        """Like step_wait, but for the envs in env_ids, see step_async_envs."""
+        results = [self.remotes[env_id].recv() for env_id in env_ids]
+        obs, share_obs, rews, dones, infos, available_actions = zip(*results)
+        return np.stack(obs), np.stack(share_obs), np.stack(rews), np.stack(dones), np.stack(infos), np.stack(available_actions)
 
     def reset(self):
         for remote in self.remotes:
@@ -405,6 +424,441 @@ class ShareSubprocVecEnv(ShareVecEnv): #Starcraft
         self.remotes[0].send(('save_replay', None))
 
 
+def shmshareworker(remote, parent_remote, env_fn_wrapper):
+    """
+    env: StarCraft2_Env
+    Like shareworker, but writes obs, share_obs, rewards, dones and
+    available_actions into shared memory slabs instead of sending them back.
+    """
+    parent_remote.close()
+    env = env_fn_wrapper.x()
+    shms, slabs = [], None
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            ob, s_ob, reward, done, info, available_actions = env.step(data)
+            if 'bool' in done.__class__.__name__:
+                if done:
+                    ob, s_ob, available_actions = env.reset()
+            else:
+                if np.all(done):
+                    ob, s_ob, available_actions = env.reset()
+
+            obs, share_obs, rews, dones, avails = slabs
+            obs[...] = ob
+            share_obs[...] = s_ob
+            rews[...] = reward
+            dones[...] = done
+            avails[...] = available_actions
+            remote.send(info)
+        elif cmd == 'reset':
+            ob, s_ob, available_actions = env.reset()
+            obs, share_obs, _, _, avails = slabs
+            obs[...] = ob
+            share_obs[...] = s_ob
+            avails[...] = available_actions
+            remote.send(None)
+        elif cmd == 'attach':
+            index, specs = data
+            shms = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+            slabs = [np.ndarray(shape, dtype=dtype, buffer=shm.buf)[index]
+                     for shm, (_, shape, dtype) in zip(shms, specs)]
+            remote.send(None)
+        elif cmd == 'close':
+            slabs = None
+            for shm in shms:
+                shm.close()
+            env.close()
+            remote.close()
+            break
+        elif cmd == 'get_spaces':
+            remote.send(
+                (env.observation_space, env.share_observation_space, env.action_space))
+        elif cmd == 'save_replay':
+            env.save_replay()
+        else:
+            raise NotImplementedError
+
+
+class ShmShareSubprocVecEnv(ShareSubprocVecEnv): #Starcraft
+    """
+    ShareSubprocVecEnv whose workers write obs, share_obs, rewards, dones and
+    available_actions straight into shared memory arrays of shape
+    (n_envs, n_agents, dim). Only actions, infos and acks go through the pipes.
+    The returned obs, share_obs and available_actions are views of the shared
+    memory and are overwritten by the next step or reset, so they must be
+    copied if they are kept around.
+    """
+    def __init__(self, env_fns, spaces=None):
+        """
+        envs: list of gym environments to run in subprocesses
+        """
+        self.waiting = False
+        self.closed = False
+        nenvs = len(env_fns)
+        # workers share the resource tracker of this process, so that they do
+        # not unlink the slabs when they exit
+        resource_tracker.ensure_running()
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nenvs)])
+        self.ps = [Process(target=shmshareworker, args=(work_remote, remote, CloudpickleWrapper(env_fn)))
+                   for (work_remote, remote, env_fn) in zip(self.work_remotes, self.remotes, env_fns)]
+        for p in self.ps:
+            p.daemon = True  # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, share_observation_space, action_space = self.remotes[0].recv(
+        )
+        ShareVecEnv.__init__(self, len(env_fns), observation_space,
+                             share_observation_space, action_space)
+
+        num_agents = len(observation_space)
+        shapes = [(nenvs, num_agents, observation_space[0][0]),
+                  (nenvs, num_agents, share_observation_space[0][0]),
+                  (nenvs, num_agents, 1),
+                  (nenvs, num_agents),
+                  (nenvs, num_agents, action_space[0].n)]
+        dtypes = [np.float32, np.float32, np.float32, np.bool_, np.float32]
+        self.shms, self.slabs = [], []
+        for shape, dtype in zip(shapes, dtypes):
+            shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+            self.shms.append(shm)
+            self.slabs.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        specs = [(shm.name, shape, np.dtype(dtype).str) for shm, shape, dtype in zip(self.shms, shapes, dtypes)]
+        for index, remote in enumerate(self.remotes):
+            remote.send(('attach', (index, specs)))
+        for remote in self.remotes:
+            remote.recv()
+
+    def step_wait(self):
+        infos = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        obs, share_obs, rews, dones, available_actions = self.slabs
+        # rewards and dones are small and may be accumulated by the caller
+        return obs, share_obs, rews.copy(), dones.copy(), np.stack(infos), available_actions
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        for remote in self.remotes:
+            remote.recv()
+        obs, share_obs, _, _, available_actions = self.slabs
+        return obs, share_obs, available_actions
+
+    def reset_task(self):
+        raise NotImplementedError
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.slabs = []
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+
+
+class ShareAsyncSubprocVecEnv(ShareSubprocVecEnv): #Starcraft
+    """
+    ShareSubprocVecEnv that can step a subset of the envs and return results
+    as soon as the first min_ready of them are done, so that a slow env does
+    not stall the others. Every result carries the ids of the envs it came
+    from. step and reset still work synchronously on all envs.
+    """
+    def __init__(self, env_fns, spaces=None, min_ready=None):
+        """
+        envs: list of gym environments to run in subprocesses
+        min_ready: default number of envs step_recv waits for
+        """
+        ShareSubprocVecEnv.__init__(self, env_fns, spaces)
+        self.min_ready = len(env_fns) if min_ready is None else min_ready
+        self.in_flight = set()
+
+    def step_send(self, actions, env_ids):
+        """
+        Send actions to the envs in env_ids, which must not be stepping yet.
+        :param actions: (np.ndarray) actions of shape (len(env_ids), n_agents, ...).
+        :param env_ids: (np.ndarray) ids of the envs to step.
+        """
+        for env_id, action in zip(env_ids, actions):
+            env_id = int(env_id)
+            assert env_id not in self.in_flight, "env {} is already stepping".format(env_id)
+            self.remotes[env_id].send(('step', action))
+            self.in_flight.add(env_id)
+
+    def step_recv(self, min_ready=None):
+        """
+        Wait until at least min_ready of the stepping envs are done and
+        collect every env that is done by then.
+        :return env_ids: (np.ndarray) sorted ids of the envs the results belong to.
+        The remaining returns are the same as step_wait, indexed by env_ids.
+        """
+        assert self.in_flight, "no env is stepping"
+        min_ready = self.min_ready if min_ready is None else min_ready
+        min_ready = max(1, min(min_ready, len(self.in_flight)))
+        ready = []
+        pending = {self.remotes[env_id]: env_id for env_id in self.in_flight}
+        while len(ready) < min_ready:
+            for remote in wait(list(pending)):
+                ready.append(pending.pop(remote))
+        env_ids = np.array(sorted(ready), dtype=np.int64)
+        results = [self.remotes[env_id].recv() for env_id in env_ids]
+        self.in_flight.difference_update(ready)
+        obs, share_obs, rews, dones, infos, available_actions = zip(*results)
+        return env_ids, np.stack(obs), np.stack(share_obs), np.stack(rews), np.stack(dones), np.stack(infos), np.stack(available_actions)
+
+    def close(self):
+        if self.closed:
+            return
+        for env_id in self.in_flight:
+            self.remotes[env_id].recv()
+        self.in_flight.clear()
+        super().close()
+
+
+def servedshareworker(remote, parent_remote, env_fn_wrapper):
+    """
+    env: StarCraft2_Env
+    Like shareworker, but once an InferenceClient is connected it can also
+    collect rollouts on its own: it asks the inference server for actions
+    and steps its env in a loop, keeping the recurrent states and masks of
+    its agents, and sends back every step together with the policy outputs
+    that produced it.
+    """
+    parent_remote.close()
+    env = env_fn_wrapper.x()
+    client, use_centralized_V, rnn_shape = None, True, None
+    ob = s_ob = available_actions = None
+    rnn_states = rnn_states_critic = masks = None
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'rollout':
+            if rnn_states is None:
+                # start of training, the same initial states as in the buffer
+                rnn_states = np.zeros((len(ob), *rnn_shape), dtype=np.float32)
+                rnn_states_critic = np.zeros_like(rnn_states)
+                masks = np.ones((len(ob), 1), dtype=np.float32)
+            for _ in range(data):
+                value, action, action_log_prob, rnn_state, rnn_state_critic = client.get_actions(
+                    s_ob if use_centralized_V else ob, ob, rnn_states, rnn_states_critic, masks, available_actions)
+                ob, s_ob, reward, done, info, available_actions = env.step(action)
+                done_env = np.all(done)
+                if done_env:
+                    ob, s_ob, available_actions = env.reset()
+                remote.send((ob, s_ob, reward, done, info, available_actions,
+                             value, action, action_log_prob, rnn_state, rnn_state_critic))
+
+                # inputs of the next request, set the same way as the runner inserts them into the buffer
+                rnn_states = np.zeros_like(rnn_state) if done_env else rnn_state
+                rnn_states_critic = np.zeros_like(rnn_state_critic) if done_env else rnn_state_critic
+                masks = np.full_like(masks, 0.0 if done_env else 1.0)
+        elif cmd == 'step':
+            ob, s_ob, reward, done, info, available_actions = env.step(data)
+            if np.all(done):
+                ob, s_ob, available_actions = env.reset()
+            remote.send((ob, s_ob, reward, done, info, available_actions))
+        elif cmd == 'reset':
+            ob, s_ob, available_actions = env.reset()
+            rnn_states = rnn_states_critic = masks = None
+            remote.send((ob, s_ob, available_actions))
+        elif cmd == 'connect':
+            client, use_centralized_V, rnn_shape = data
+            remote.send(None)
+        elif cmd == 'close':
+            if client is not None:
+                client.close()
+            env.close()
+            remote.close()
+            break
+        elif cmd == 'get_spaces':
+            remote.send(
+                (env.observation_space, env.share_observation_space, env.action_space))
+        elif cmd == 'save_replay':
+            env.save_replay()
+        else:
+            raise NotImplementedError
+
+
+class ShareServedSubprocVecEnv(ShareSubprocVecEnv): #Starcraft
+    """
+    ShareSubprocVecEnv whose workers collect rollouts with actions from an
+    InferenceServer, see servedshareworker. Every worker runs its env and its
+    inference requests back to back without waiting for the other envs, and
+    the steps are handed out in the order they arrive. step and reset still
+    work synchronously on all envs, but steps taken with step are not seen by
+    the recurrent states the workers keep for rollouts.
+    """
+    def __init__(self, env_fns, spaces=None):
+        """
+        envs: list of gym environments to run in subprocesses
+        """
+        self.waiting = False
+        self.closed = False
+        nenvs = len(env_fns)
+        # workers share the resource tracker of this process, so that they do
+        # not unlink the inference server's arrays when they exit
+        resource_tracker.ensure_running()
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nenvs)])
+        self.ps = [Process(target=servedshareworker, args=(work_remote, remote, CloudpickleWrapper(env_fn)))
+                   for (work_remote, remote, env_fn) in zip(self.work_remotes, self.remotes, env_fns)]
+        for p in self.ps:
+            p.daemon = True  # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, share_observation_space, action_space = self.remotes[0].recv(
+        )
+        ShareVecEnv.__init__(self, len(env_fns), observation_space,
+                             share_observation_space, action_space)
+        self.steps_left = np.zeros(nenvs, dtype=np.int64)
+
+    def connect(self, clients, use_centralized_V, rnn_shape):
+        """
+        Hand one InferenceClient to every worker. The clients are closed in
+        this process afterwards.
+        :param clients: (list) InferenceClient of every env.
+        :param use_centralized_V: (bool) whether the critic gets share_obs, it gets obs otherwise.
+        :param rnn_shape: (tuple) (recurrent_N, hidden_size) of the recurrent states.
+        """
+        for remote, client in zip(self.remotes, clients):
+            remote.send(('connect', (client, use_centralized_V, tuple(rnn_shape))))
+        for remote, client in zip(self.remotes, clients):
+            remote.recv()
+            client.close()
+
+    def rollout_send(self, n_steps):
+        """Let every worker collect n_steps steps with the inference server."""
+        assert not self.steps_left.any(), "a rollout is still being collected"
+        for remote in self.remotes:
+            remote.send(('rollout', n_steps))
+        self.steps_left[:] = n_steps
+
+    def rollout_recv(self):
+        """
+        Wait for the next steps of the rollout and collect every step that has
+        arrived by then, at most one per env.
+        :return env_ids: (np.ndarray) sorted ids of the envs the steps belong to.
+        The remaining returns are the same as step_wait followed by the values,
+        actions, action log probs and recurrent states the steps were taken with,
+        all indexed by env_ids.
+        """
+        assert self.steps_left.any(), "no rollout is being collected"
+        pending = {self.remotes[env_id]: env_id for env_id in np.flatnonzero(self.steps_left)}
+        env_ids = np.array(sorted(pending[remote] for remote in wait(list(pending))), dtype=np.int64)
+        results = [self.remotes[env_id].recv() for env_id in env_ids]
+        self.steps_left[env_ids] -= 1
+        return (env_ids, *[np.stack(x) for x in zip(*results)])
+
+    def reset_task(self):
+        raise NotImplementedError
+
+    def close(self):
+        if self.closed:
+            return
+        while self.steps_left.any():
+            self.rollout_recv()
+        super().close()
+
+
+def multishareworker(remote, parent_remote, env_fn_wrapper):
+    """
+    env: list of StarCraft2_Env
+    Hosts several envs in one process. Their steps and resets run on a thread
+    pool, so that the waits on the SC2 sockets overlap, and the results of all
+    envs are sent back as one message.
+    """
+    parent_remote.close()
+    envs = [env_fn() for env_fn in env_fn_wrapper.x]
+    pool = ThreadPoolExecutor(max_workers=len(envs))
+
+    def step_env(env, action):
+        ob, s_ob, reward, done, info, available_actions = env.step(action)
+        if 'bool' in done.__class__.__name__:
+            if done:
+                ob, s_ob, available_actions = env.reset()
+        else:
+            if np.all(done):
+                ob, s_ob, available_actions = env.reset()
+        return ob, s_ob, reward, done, info, available_actions
+
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            results = list(pool.map(step_env, envs, data))
+            remote.send([np.stack(x) for x in zip(*results)])
+        elif cmd == 'reset':
+            results = list(pool.map(lambda env: env.reset(), envs))
+            remote.send([np.stack(x) for x in zip(*results)])
+        elif cmd == 'close':
+            pool.shutdown()
+            for env in envs:
+                env.close()
+            remote.close()
+            break
+        elif cmd == 'get_spaces':
+            remote.send(
+                (envs[0].observation_space, envs[0].share_observation_space, envs[0].action_space))
+        elif cmd == 'save_replay':
+            envs[0].save_replay()
+        else:
+            raise NotImplementedError
+
+
+class MultiShareSubprocVecEnv(ShareSubprocVecEnv): #Starcraft
+    """
+    ShareSubprocVecEnv that runs envs_per_worker envs in each subprocess
+    instead of one, see multishareworker. Envs are assigned to workers in
+    order, the last worker takes the remainder.
+    """
+    def __init__(self, env_fns, spaces=None, envs_per_worker=1):
+        """
+        envs: list of gym environments to run in subprocesses
+        envs_per_worker: number of envs hosted by each subprocess
+        """
+        self.waiting = False
+        self.closed = False
+        nenvs = len(env_fns)
+        env_fn_groups = [env_fns[i:i + envs_per_worker] for i in range(0, nenvs, envs_per_worker)]
+        # index of the first env of each worker, used to split the actions
+        self.splits = np.cumsum([len(group) for group in env_fn_groups])[:-1]
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(len(env_fn_groups))])
+        self.ps = [Process(target=multishareworker, args=(work_remote, remote, CloudpickleWrapper(group)))
+                   for (work_remote, remote, group) in zip(self.work_remotes, self.remotes, env_fn_groups)]
+        for p in self.ps:
+            p.daemon = True  # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, share_observation_space, action_space = self.remotes[0].recv(
+        )
+        ShareVecEnv.__init__(self, nenvs, observation_space,
+                             share_observation_space, action_space)
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, np.split(np.asarray(actions), self.splits)):
+            remote.send(('step', action))
+        self.waiting = True
+
+    def step_wait(self):
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        obs, share_obs, rews, dones, infos, available_actions = zip(*results)
+        return np.concatenate(obs), np.concatenate(share_obs), np.concatenate(rews), np.concatenate(dones), np.concatenate(infos), np.concatenate(available_actions)
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        results = [remote.recv() for remote in self.remotes]
+        obs, share_obs, available_actions = zip(*results)
+        return np.concatenate(obs), np.concatenate(share_obs), np.concatenate(available_actions)
+
+    def reset_task(self):
+        raise NotImplementedError
+
+
 def choosesimpleworker(remote, parent_remote, env_fn_wrapper):
     parent_remote.close()
     env = env_fn_wrapper.x()
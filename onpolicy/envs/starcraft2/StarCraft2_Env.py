@@ -6,8 +6,12 @@ from .multiagentenv import MultiAgentEnv
 from .smac_maps import get_map_params
 
 import atexit
+import os
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from operator import attrgetter
-from copy import deepcopy
 import numpy as np
 import enum
 import math
@@ -52,6 +56,18 @@ actions = {
     "heal": 386,  # Unit
 }
 
+# The info returned by every step, one record per environment instead of one
+# dict per agent, so that vec envs can stack them into a structured array.
+info_dtype = np.dtype([
+    ("battles_won", np.int64),
+    ("battles_game", np.int64),
+    ("battles_draw", np.int64),
+    ("restarts", np.int64),
+    ("bad_transition", np.bool_),
+    ("won", np.bool_),
+    ("episode_limit", np.bool_),
+])
+
 
 class Direction(enum.IntEnum):
     NORTH = 0
@@ -102,6 +118,8 @@ class StarCraft2Env(MultiAgentEnv):
         heuristic_ai=False,
         heuristic_rest=False,
         debug=False,
+        map_cache_dir=None,
+        warm_standby=False,
     ):
         """
         Create a StarCraftC2Env environment.
@@ -198,6 +216,15 @@ class StarCraft2Env(MultiAgentEnv):
         debug: bool, optional
             Log messages about observations, state, actions and rewards for
             debugging purposes (default is False).
+        map_cache_dir: str, optional
+            Directory to cache the decoded pathing grid, terrain height and
+            map size in, keyed by map name and game version, so that later
+            launches skip decoding them (default is None, no cache).
+        warm_standby: bool, optional
+            Keep a second StarCraft II instance launched with the map loaded,
+            so that full_restart can swap to it instead of relaunching, and
+            launch its replacement in the background. Doubles the number of
+            SC2 processes (default is False).
         """
         # Map arguments
         self.map_name = args.map_name
@@ -260,6 +287,8 @@ class StarCraft2Env(MultiAgentEnv):
         self.heuristic_ai = heuristic_ai
         self.heuristic_rest = heuristic_rest
         self.debug = debug
+        self.map_cache_dir = map_cache_dir
+        self.warm_standby = warm_standby
         self.window_size = (window_size_x, window_size_y)
         self.replay_dir = replay_dir
         self.replay_prefix = replay_prefix
@@ -294,9 +323,15 @@ class StarCraft2Env(MultiAgentEnv):
         self.last_stats = None
         self.death_tracker_ally = np.zeros(self.n_agents, dtype=np.float32)
         self.death_tracker_enemy = np.zeros(self.n_enemies, dtype=np.float32)
-        self.previous_ally_units = None
-        self.previous_enemy_units = None
+        self.previous_ally_health = np.zeros(self.n_agents, dtype=np.float64)
+        self.previous_ally_shield = np.zeros(self.n_agents, dtype=np.float64)
+        self.previous_enemy_health = np.zeros(self.n_enemies, dtype=np.float64)
+        self.previous_enemy_shield = np.zeros(self.n_enemies, dtype=np.float64)
         self.last_action = np.zeros((self.n_agents, self.n_actions), dtype=np.float32)
+        self._avail_actions = None
+        self._distances = None
+        self._ally_tags = {}
+        self._enemy_tags = {}
         self._min_unit_type = 0
         self.marine_id = self.marauder_id = self.medivac_id = 0
         self.hydralisk_id = self.zergling_id = self.baneling_id = 0
@@ -307,9 +342,17 @@ class StarCraft2Env(MultiAgentEnv):
         self.map_y = 0
         self.terrain_height = None
         self.pathing_grid = None
+        self.surrounding_pathing = None
+        self.surrounding_height = None
+        self.can_move_table = None
         self._run_config = None
         self._sc2_proc = None
         self._controller = None
+        self._standby = None
+        self._standby_pool = None
+        self.standby_swaps = 0
+        self.last_restart_time = 0.0
+        self.total_restart_time = 0.0
 
         # Try to avoid leaking SC2 processes on shutdown
         atexit.register(lambda: self.close())
@@ -329,33 +372,67 @@ class StarCraft2Env(MultiAgentEnv):
 
     def _launch(self):
         """Launch the StarCraft II game."""
-        self._run_config = run_configs.get(version=self.game_version)
+        self._run_config, self._sc2_proc, self._controller = self._start_game()
+
+        if self.warm_standby:
+            self._launch_standby()
+
+        if not self._load_map_cache():
+            game_info = self._controller.game_info()
+            self._decode_map_info(game_info.start_raw)
+            self._save_map_cache()
+
+        self._init_surrounding_tables()
+
+    def _start_game(self):
+        """Start a StarCraft II process, create the game and join it.
+        Returns the run config, the process and its controller."""
+        run_config = run_configs.get(version=self.game_version)
         _map = maps.get(self.map_name)
         self._seed += 1
 
         # Setting up the interface
         interface_options = sc_pb.InterfaceOptions(raw=True, score=False)
-        self._sc2_proc = self._run_config.start(window_size=self.window_size, want_rgb=False)
-        self._controller = self._sc2_proc.controller
+        sc2_proc = run_config.start(window_size=self.window_size, want_rgb=False)
+        controller = sc2_proc.controller
 
         # Request to create the game
         create = sc_pb.RequestCreateGame(
             local_map=sc_pb.LocalMap(
                 map_path=_map.path,
-                map_data=self._run_config.map_data(_map.path)),
+                map_data=run_config.map_data(_map.path)),
             realtime=False,
             random_seed=self._seed)
         create.player_setup.add(type=sc_pb.Participant)
         create.player_setup.add(type=sc_pb.Computer, race=races[self._bot_race],
                                 difficulty=difficulties[self.difficulty])
-        self._controller.create_game(create)
+        controller.create_game(create)
 
         join = sc_pb.RequestJoinGame(race=races[self._agent_race],
                                      options=interface_options)
-        self._controller.join_game(join)
+        controller.join_game(join)
+
+        return run_config, sc2_proc, controller
 
-        game_info = self._controller.game_info()
-        map_info = game_info.start_raw
+    def _launch_standby(self):
+        """Start launching the standby game in the background."""
+        if self._standby_pool is None:
+            self._standby_pool = ThreadPoolExecutor(max_workers=1)
+        self._standby = self._standby_pool.submit(self._start_game)
+
+    def _close_standby(self):
+        """Close the standby game, waiting for it to finish launching."""
+        if self._standby is None:
+            return
+        try:
+            self._standby.result()[1].close()
+        except Exception as e:
+            logging.warning("Standby StarCraft II failed to launch: {}".format(e))
+        self._standby = None
+
+    def _decode_map_info(self, map_info):
+        """Read the playable area, map size, pathing grid and terrain height
+        from the start_raw part of the game info."""
         map_play_area_min = map_info.playable_area.p0
         map_play_area_max = map_info.playable_area.p1
         self.max_distance_x = map_play_area_max.x - map_play_area_min.x
@@ -363,21 +440,71 @@ class StarCraft2Env(MultiAgentEnv):
         self.map_x = map_info.map_size.x
         self.map_y = map_info.map_size.y
 
+        pathing_data = np.frombuffer(map_info.pathing_grid.data, dtype=np.uint8)
         if map_info.pathing_grid.bits_per_pixel == 1:
-            vals = np.array(list(map_info.pathing_grid.data)).reshape(
-                self.map_x, int(self.map_y / 8))
-            self.pathing_grid = np.transpose(np.array([
-                [(b >> i) & 1 for b in row for i in range(7, -1, -1)]
-                for row in vals], dtype=np.bool))
+            vals = pathing_data.reshape(self.map_x, int(self.map_y / 8))
+            self.pathing_grid = np.transpose(np.unpackbits(vals, axis=1).astype(bool))
         else:
-            self.pathing_grid = np.invert(np.flip(np.transpose(np.array(
-                list(map_info.pathing_grid.data), dtype=np.bool).reshape(
-                    self.map_x, self.map_y)), axis=1))
+            self.pathing_grid = np.invert(np.flip(np.transpose(
+                pathing_data.astype(bool).reshape(self.map_x, self.map_y)), axis=1))
 
         self.terrain_height = np.flip(
-            np.transpose(np.array(list(map_info.terrain_height.data))
+            np.transpose(np.frombuffer(map_info.terrain_height.data, dtype=np.uint8)
                          .reshape(self.map_x, self.map_y)), 1) / 255
 
+    def _map_cache_path(self):
+        """Path of the cached map info for the current map and game version,
+        or None if the cache is disabled."""
+        if not self.map_cache_dir:
+            return None
+        version = getattr(getattr(self._run_config, "version", None), "game_version", None)
+        version = version or self.game_version or "latest"
+        return os.path.join(self.map_cache_dir, "{}_{}.npz".format(self.map_name, version))
+
+    def _load_map_cache(self):
+        """Load the decoded map info from the map cache. Returns whether it
+        was found."""
+        path = self._map_cache_path()
+        if path is None or not os.path.exists(path):
+            return False
+        try:
+            with np.load(path) as data:
+                self.max_distance_x = data["max_distance_x"].item()
+                self.max_distance_y = data["max_distance_y"].item()
+                self.map_x = data["map_x"].item()
+                self.map_y = data["map_y"].item()
+                self.pathing_grid = data["pathing_grid"]
+                self.terrain_height = data["terrain_height"]
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            logging.warning("Could not read map cache {}: {}".format(path, e))
+            return False
+        return True
+
+    def _save_map_cache(self):
+        """Save the decoded map info to the map cache. Written to a unique
+        temporary file first, since several environments may launch at the
+        same time, also from the same process."""
+        path = self._map_cache_path()
+        if path is None:
+            return
+        tmp_path = None
+        try:
+            os.makedirs(self.map_cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.map_cache_dir, suffix=".npz")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f,
+                         max_distance_x=self.max_distance_x,
+                         max_distance_y=self.max_distance_y,
+                         map_x=self.map_x,
+                         map_y=self.map_y,
+                         pathing_grid=self.pathing_grid,
+                         terrain_height=self.terrain_height)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("Could not write map cache {}: {}".format(path, e))
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
     def reset(self):
         """Reset the environment. Required after each full episode.
         Returns initial observations and states.
@@ -392,8 +519,10 @@ class StarCraft2Env(MultiAgentEnv):
         # Information kept for counting the reward
         self.death_tracker_ally = np.zeros(self.n_agents, dtype=np.float32)
         self.death_tracker_enemy = np.zeros(self.n_enemies, dtype=np.float32)
-        self.previous_ally_units = None
-        self.previous_enemy_units = None
+        self.previous_ally_health = np.zeros(self.n_agents, dtype=np.float64)
+        self.previous_ally_shield = np.zeros(self.n_agents, dtype=np.float64)
+        self.previous_enemy_health = np.zeros(self.n_enemies, dtype=np.float64)
+        self.previous_enemy_shield = np.zeros(self.n_enemies, dtype=np.float64)
         self.win_counted = False
         self.defeat_counted = False
 
@@ -408,18 +537,16 @@ class StarCraft2Env(MultiAgentEnv):
         except (protocol.ProtocolError, protocol.ConnectionError):
             self.full_restart()
 
-        available_actions = []
-        for i in range(self.n_agents):
-            available_actions.append(self.get_avail_agent_actions(i))
+        available_actions = self.get_avail_actions()
 
         if self.debug:
             logging.debug("Started Episode {}"
                           .format(self._episode_count).center(60, "*"))
 
         if self.use_state_agent:
-            global_state = [self.get_state_agent(agent_id) for agent_id in range(self.n_agents)]
+            global_state = self.get_state_agents()
         else:
-            global_state = [self.get_state(agent_id) for agent_id in range(self.n_agents)]
+            global_state = self.get_states()
 
         local_obs = self.get_obs()
 
@@ -447,17 +574,32 @@ class StarCraft2Env(MultiAgentEnv):
             self.full_restart()
 
     def full_restart(self):
-        """Full restart. Closes the SC2 process and launches a new one. """
+        """Full restart. Closes the SC2 process and launches a new one, or
+        swaps to the standby one if warm_standby is set. """
+        start = time.time()
         self._sc2_proc.close()
-        self._launch()
+        standby, self._standby = self._standby, None
+        swapped = False
+        if standby is not None:
+            try:
+                self._run_config, self._sc2_proc, self._controller = standby.result()
+                swapped = True
+            except Exception as e:
+                logging.warning("Standby StarCraft II failed to launch: {}".format(e))
+        if swapped:
+            self.standby_swaps += 1
+            self._launch_standby()
+        else:
+            self._launch()
         self.force_restarts += 1
+        self.last_restart_time = time.time() - start
+        self.total_restart_time += self.last_restart_time
 
     def step(self, actions):
         """A single environment step. Returns reward, terminated, info."""
         terminated = False
         bad_transition = False
-        infos = [{} for i in range(self.n_agents)]
-        dones = np.zeros((self.n_agents), dtype=bool)
+        episode_limit = False
 
         actions_int = [int(a) for a in actions]
 
@@ -489,29 +631,14 @@ class StarCraft2Env(MultiAgentEnv):
         except (protocol.ProtocolError, protocol.ConnectionError):
             self.full_restart()
             terminated = True
-            available_actions = []
-            for i in range(self.n_agents):
-                available_actions.append(self.get_avail_agent_actions(i))
-                infos[i] = {
-                    "battles_won": self.battles_won,
-                    "battles_game": self.battles_game,
-                    "battles_draw": self.timeouts,
-                    "restarts": self.force_restarts,
-                    "bad_transition": bad_transition,
-                    "won": self.win_counted
-                }
-                if terminated:
-                    dones[i] = True
-                else:
-                    if self.death_tracker_ally[i]:
-                        dones[i] = True
-                    else:
-                        dones[i] = False
+            available_actions = self.get_avail_actions()
+            infos = self.get_info(bad_transition)
+            dones = np.ones(self.n_agents, dtype=bool)
 
             if self.use_state_agent:
-                global_state = [self.get_state_agent(agent_id) for agent_id in range(self.n_agents)]
+                global_state = self.get_state_agents()
             else:
-                global_state = [self.get_state(agent_id) for agent_id in range(self.n_agents)]
+                global_state = self.get_states()
 
             local_obs = self.get_obs()
 
@@ -535,9 +662,7 @@ class StarCraft2Env(MultiAgentEnv):
 
         reward = self.reward_battle()
 
-        available_actions = []
-        for i in range(self.n_agents):
-            available_actions.append(self.get_avail_agent_actions(i))
+        available_actions = self.get_avail_actions()
 
         if game_end_code is not None:
             # Battle is over
@@ -562,27 +687,12 @@ class StarCraft2Env(MultiAgentEnv):
             terminated = True
             self.bad_transition = True
             if self.continuing_episode:
-                infos["episode_limit"] = True
+                episode_limit = True
             self.battles_game += 1
             self.timeouts += 1
 
-        for i in range(self.n_agents):
-            infos[i] = {
-                "battles_won": self.battles_won,
-                "battles_game": self.battles_game,
-                "battles_draw": self.timeouts,
-                "restarts": self.force_restarts,
-                "bad_transition": bad_transition,
-                "won": self.win_counted
-            }
-
-            if terminated:
-                dones[i] = True
-            else:
-                if self.death_tracker_ally[i]:
-                    dones[i] = True
-                else:
-                    dones[i] = False
+        infos = self.get_info(bad_transition, episode_limit)
+        dones = np.logical_or(terminated, self.death_tracker_ally != 0)
 
         if self.debug:
             logging.debug("Reward = {}".format(reward).center(60, '-'))
@@ -596,9 +706,9 @@ class StarCraft2Env(MultiAgentEnv):
         rewards = [[reward]]*self.n_agents
 
         if self.use_state_agent:
-            global_state = [self.get_state_agent(agent_id) for agent_id in range(self.n_agents)]
+            global_state = self.get_state_agents()
         else:
-            global_state = [self.get_state(agent_id) for agent_id in range(self.n_agents)]
+            global_state = self.get_states()
 
         local_obs = self.get_obs()
 
@@ -614,6 +724,17 @@ class StarCraft2Env(MultiAgentEnv):
 
         return local_obs, global_state, rewards, dones, infos, available_actions
 
+    def get_info(self, bad_transition=False, episode_limit=False):
+        """Returns the battle counters shared by all agents as a single
+        record of dtype ``info_dtype``."""
+        return np.array((self.battles_won,
+                         self.battles_game,
+                         self.timeouts,
+                         self.force_restarts,
+                         bad_transition,
+                         self.win_counted,
+                         episode_limit), dtype=info_dtype)
+
     def get_agent_action(self, a_id, action):
         """Construct the action for agent a_id."""
         avail_actions = self.get_avail_agent_actions(a_id)
@@ -816,45 +937,26 @@ class StarCraft2Env(MultiAgentEnv):
         if self.reward_sparse:
             return 0
 
-        reward = 0
-        delta_deaths = 0
-        delta_ally = 0
-        delta_enemy = 0
-
         neg_scale = self.reward_negative_scale
 
-        # update deaths
-        for al_id, al_unit in self.agents.items():
-            if not self.death_tracker_ally[al_id]:
-                # did not die so far
-                prev_health = (
-                    self.previous_ally_units[al_id].health
-                    + self.previous_ally_units[al_id].shield
-                )
-                if al_unit.health == 0:
-                    # just died
-                    self.death_tracker_ally[al_id] = 1
-                    if not self.reward_only_positive:
-                        delta_deaths -= self.reward_death_value * neg_scale
-                    delta_ally += prev_health * neg_scale
-                else:
-                    # still alive
-                    delta_ally += neg_scale * (
-                        prev_health - al_unit.health - al_unit.shield
-                    )
-
-        for e_id, e_unit in self.enemies.items():
-            if not self.death_tracker_enemy[e_id]:
-                prev_health = (
-                    self.previous_enemy_units[e_id].health
-                    + self.previous_enemy_units[e_id].shield
-                )
-                if e_unit.health == 0:
-                    self.death_tracker_enemy[e_id] = 1
-                    delta_deaths += self.reward_death_value
-                    delta_enemy += prev_health
-                else:
-                    delta_enemy += prev_health - e_unit.health - e_unit.shield
+        # update deaths, only units that did not die so far count
+        ally_tracked = self.death_tracker_ally == 0
+        prev_ally = self.previous_ally_health + self.previous_ally_shield
+        ally_died = ally_tracked & (self.ally_health == 0)  # just died
+        ally_lost = np.where(ally_died, prev_ally, prev_ally - self.ally_health - self.ally_shield)
+        self.death_tracker_ally[ally_died] = 1
+
+        enemy_tracked = self.death_tracker_enemy == 0
+        prev_enemy = self.previous_enemy_health + self.previous_enemy_shield
+        enemy_died = enemy_tracked & (self.enemy_health == 0)
+        enemy_lost = np.where(enemy_died, prev_enemy, prev_enemy - self.enemy_health - self.enemy_shield)
+        self.death_tracker_enemy[enemy_died] = 1
+
+        delta_ally = neg_scale * ally_lost[ally_tracked].sum()
+        delta_enemy = enemy_lost[enemy_tracked].sum()
+        delta_deaths = self.reward_death_value * np.count_nonzero(enemy_died)
+        if not self.reward_only_positive:
+            delta_deaths -= self.reward_death_value * neg_scale * np.count_nonzero(ally_died)
 
         if self.reward_only_positive:
             reward = abs(delta_enemy + delta_deaths)  # shield regeneration
@@ -872,6 +974,42 @@ class StarCraft2Env(MultiAgentEnv):
         """Distance between two points."""
         return math.hypot(x2 - x1, y2 - y1)
 
+    @staticmethod
+    def relative_positions(pos_a, pos_b):
+        """Pairwise offsets and distances from the points in pos_a (n, 2) to
+        the points in pos_b (m, 2). Returns dx, dy and dist of shape (n, m)."""
+        dx = pos_b[None, :, 0] - pos_a[:, None, 0]
+        dy = pos_b[None, :, 1] - pos_a[:, None, 1]
+        return dx, dy, np.hypot(dx, dy)
+
+    def get_distances(self):
+        """Returns the ally x ally and ally x enemy offsets, distances and
+        sight/shoot range masks, seen from each agent. They are computed once
+        per observation of the game and shared by the observation, state,
+        available actions and visibility functions.
+        """
+        if self._distances is not None:
+            return self._distances
+
+        sight_range = self.ally_sight_range[:, None]
+        shoot_range = self.ally_shoot_range[:, None]
+        al_dx, al_dy, al_dist = self.relative_positions(self.ally_pos, self.ally_pos)
+        e_dx, e_dy, e_dist = self.relative_positions(self.ally_pos, self.enemy_pos)
+
+        self._distances = {
+            "ally_dx": al_dx,
+            "ally_dy": al_dy,
+            "ally_dist": al_dist,
+            "ally_in_sight": al_dist < sight_range,
+            "ally_in_shoot": al_dist <= shoot_range,
+            "enemy_dx": e_dx,
+            "enemy_dy": e_dy,
+            "enemy_dist": e_dist,
+            "enemy_in_sight": e_dist < sight_range,
+            "enemy_in_shoot": e_dist <= shoot_range,
+        }
+        return self._distances
+
     def unit_shoot_range(self, agent_id):
         """Returns the shooting range for an agent."""
         return 6
@@ -975,8 +1113,78 @@ class StarCraft2Env(MultiAgentEnv):
         ]
         return vals
 
+    def _init_surrounding_tables(self):
+        """Precompute, for every cell of the map, the pathing values of the
+        8 surrounding points, the height values of the 8 surrounding points
+        and the cell itself, and whether a unit in the cell can move north,
+        south, east and west. The grids are padded so that out of bounds
+        points read as 1 (and as not movable). Should be called once the
+        pathing grid and terrain height are known.
+        """
+        ma = int(self._move_amount)
+        pad = 2 * ma
+        offsets = [
+            (0, 2 * ma),
+            (0, -2 * ma),
+            (2 * ma, 0),
+            (-2 * ma, 0),
+            (ma, ma),
+            (-ma, -ma),
+            (ma, -ma),
+            (-ma, ma),
+        ]
+
+        def shifted(grid, dx, dy):
+            return grid[pad + dx: pad + dx + self.map_x, pad + dy: pad + dy + self.map_y]
+
+        pathing = np.pad(self.pathing_grid, pad, constant_values=1)
+        height = np.pad(self.terrain_height, pad, constant_values=1)
+
+        self.surrounding_pathing = np.stack(
+            [shifted(pathing, dx, dy) for dx, dy in offsets], axis=-1)
+        self.surrounding_height = np.stack(
+            [shifted(height, dx, dy) for dx, dy in offsets + [(0, 0)]], axis=-1)
+
+        # can_move looks half a move ahead, which only maps to a fixed cell
+        # offset when it is a whole number of cells
+        m = self._move_amount / 2
+        if float(m).is_integer():
+            m = int(m)
+            movable = np.pad(self.pathing_grid, pad, constant_values=False)
+            self.can_move_table = np.stack(
+                [shifted(movable, dx, dy) for dx, dy in [(0, m), (0, -m), (m, 0), (-m, 0)]], axis=-1)
+            # int() truncates towards zero, so moving south/west from the
+            # cell m - 1 lands on the cell 0 instead of out of the map, unless
+            # the unit is exactly on its border (see get_avail_agent_actions)
+            if 0 < m <= self.map_y:
+                self.can_move_table[:, m - 1, Direction.SOUTH] = self.pathing_grid[:, 0]
+            if 0 < m <= self.map_x:
+                self.can_move_table[m - 1, :, Direction.WEST] = self.pathing_grid[0, :]
+        else:
+            self.can_move_table = None
+
+    def get_surrounding_pathing_all(self):
+        """Returns pathing values of the grid surrounding every agent."""
+        cells = self.ally_pos.astype(np.int64)
+        return self.surrounding_pathing[cells[:, 0], cells[:, 1]]
+
+    def get_surrounding_height_all(self):
+        """Returns height values of the grid surrounding every agent."""
+        cells = self.ally_pos.astype(np.int64)
+        return self.surrounding_height[cells[:, 0], cells[:, 1]]
+
     def get_obs_agent(self, agent_id):
-        """Returns observation for agent_id. The observation is composed of:
+        """Returns observation for agent_id. See ``get_obs`` for the layout
+        of the observation vector.
+
+           NOTE: Agents should have access only to their local observations
+           during decentralised execution.
+        """
+        return self.get_obs()[agent_id]
+
+    def get_obs(self):
+        """Returns all agent observations as an (n_agents, obs_size) array.
+        The observation of each agent is composed of:
 
            - agent movement features (where it can move to, height information and pathing grid)
            - enemy features (available_to_attack, health, relative_x, relative_y, shield, unit_type)
@@ -997,165 +1205,151 @@ class StarCraft2Env(MultiAgentEnv):
            unit_type is not included if there is only one type of unit in the
            map etc.).
 
+           The observations of all agents are built in one batched pass over
+           the unit arrays (see ``_update_unit_arrays``).
+
            NOTE: Agents should have access only to their local observations
            during decentralised execution.
         """
-        unit = self.get_unit_by_id(agent_id)
-
-        move_feats_dim = self.get_obs_move_feats_size()
-        enemy_feats_dim = self.get_obs_enemy_feats_size()
-        ally_feats_dim = self.get_obs_ally_feats_size()
-        own_feats_dim = self.get_obs_own_feats_size()
-
-        move_feats = np.zeros(move_feats_dim, dtype=np.float32)
-        enemy_feats = np.zeros(enemy_feats_dim, dtype=np.float32)
-        ally_feats = np.zeros(ally_feats_dim, dtype=np.float32)
-        own_feats = np.zeros(own_feats_dim, dtype=np.float32)
-        agent_id_feats = np.zeros(self.n_agents, dtype=np.float32)
-
-        if unit.health > 0:  # otherwise dead, return all zeros
-            x = unit.pos.x
-            y = unit.pos.y
-            sight_range = self.unit_sight_range(agent_id)
-
-            # Movement features
-            avail_actions = self.get_avail_agent_actions(agent_id)
-            for m in range(self.n_actions_move):
-                move_feats[m] = avail_actions[m + 2]
-
-            ind = self.n_actions_move
-
-            if self.obs_pathing_grid:
-                move_feats[ind: ind + self.n_obs_pathing] = self.get_surrounding_pathing(unit)
-                ind += self.n_obs_pathing
-
-            if self.obs_terrain_height:
-                move_feats[ind:] = self.get_surrounding_height(unit)
-
-            # Enemy features
-            for e_id, e_unit in self.enemies.items():
-                e_x = e_unit.pos.x
-                e_y = e_unit.pos.y
-                dist = self.distance(x, y, e_x, e_y)
-
-                if (dist < sight_range and e_unit.health > 0):  # visible and alive
-                    # Sight range > shoot range
-                    enemy_feats[e_id, 0] = avail_actions[self.n_actions_no_attack + e_id]  # available
-                    enemy_feats[e_id, 1] = dist / sight_range  # distance
-                    enemy_feats[e_id, 2] = (e_x - x) / sight_range  # relative X
-                    enemy_feats[e_id, 3] = (e_y - y) / sight_range  # relative Y
-
-                    ind = 4
-                    if self.obs_all_health:
-                        enemy_feats[e_id, ind] = (e_unit.health / e_unit.health_max)  # health
-                        ind += 1
-                        if self.shield_bits_enemy > 0:
-                            max_shield = self.unit_max_shield(e_unit)
-                            enemy_feats[e_id, ind] = (e_unit.shield / max_shield)  # shield
-                            ind += 1
-
-                    if self.unit_type_bits > 0:
-                        type_id = self.get_unit_type_id(e_unit, False)
-                        enemy_feats[e_id, ind + type_id] = 1  # unit type
-
-            # Ally features
-            al_ids = [al_id for al_id in range(self.n_agents) if al_id != agent_id]
-            for i, al_id in enumerate(al_ids):
-
-                al_unit = self.get_unit_by_id(al_id)
-                al_x = al_unit.pos.x
-                al_y = al_unit.pos.y
-                dist = self.distance(x, y, al_x, al_y)
-
-                if (dist < sight_range and al_unit.health > 0):  # visible and alive
-                    ally_feats[i, 0] = 1  # visible
-                    ally_feats[i, 1] = dist / sight_range  # distance
-                    ally_feats[i, 2] = (al_x - x) / sight_range  # relative X
-                    ally_feats[i, 3] = (al_y - y) / sight_range  # relative Y
-
-                    ind = 4
-                    if self.obs_all_health:
-                        ally_feats[i, ind] = (al_unit.health / al_unit.health_max)  # health
-                        ind += 1
-                        if self.shield_bits_ally > 0:
-                            max_shield = self.unit_max_shield(al_unit)
-                            ally_feats[i, ind] = (al_unit.shield / max_shield)  # shield
-                            ind += 1
-
-                    if self.unit_type_bits > 0:
-                        type_id = self.get_unit_type_id(al_unit, True)
-                        ally_feats[i, ind + type_id] = 1
-                        ind += self.unit_type_bits
-
-                    if self.obs_last_action:
-                        ally_feats[i, ind:] = self.last_action[al_id]
-
-            # Own features
-            ind = 0
-            own_feats[0] = 1  # visible
-            own_feats[1] = 0  # distance
-            own_feats[2] = 0  # X
-            own_feats[3] = 0  # Y
-            ind = 4
-            if self.obs_own_health:
-                own_feats[ind] = unit.health / unit.health_max
+        n_agents = self.n_agents
+
+        move_feats = np.zeros((n_agents, self.get_obs_move_feats_size()), dtype=np.float32)
+        enemy_feats = np.zeros((n_agents, *self.get_obs_enemy_feats_size()), dtype=np.float32)
+        ally_feats = np.zeros((n_agents, n_agents, self.get_obs_ally_feats_size()[1]), dtype=np.float32)
+        own_feats = np.zeros((n_agents, self.get_obs_own_feats_size()), dtype=np.float32)
+
+        sight_range = self.ally_sight_range[:, None]
+        avail_actions = self.get_avail_actions()
+        dists = self.get_distances()
+
+        # Movement features
+        move_feats[:, :self.n_actions_move] = avail_actions[:, 2:2 + self.n_actions_move]
+
+        ind = self.n_actions_move
+
+        if self.obs_pathing_grid:
+            move_feats[:, ind: ind + self.n_obs_pathing] = self.get_surrounding_pathing_all()
+            ind += self.n_obs_pathing
+
+        if self.obs_terrain_height:
+            move_feats[:, ind:] = self.get_surrounding_height_all()
+
+        # Enemy features
+        e_dx, e_dy, e_dist = dists["enemy_dx"], dists["enemy_dy"], dists["enemy_dist"]
+        # Sight range > shoot range
+        enemy_feats[:, :, 0] = avail_actions[:, self.n_actions_no_attack:]  # available
+        enemy_feats[:, :, 1] = e_dist / sight_range  # distance
+        enemy_feats[:, :, 2] = e_dx / sight_range  # relative X
+        enemy_feats[:, :, 3] = e_dy / sight_range  # relative Y
+
+        ind = 4
+        if self.obs_all_health:
+            enemy_feats[:, :, ind] = self.enemy_health / self.enemy_health_max  # health
+            ind += 1
+            if self.shield_bits_enemy > 0:
+                enemy_feats[:, :, ind] = self.enemy_shield / self.enemy_max_shield  # shield
                 ind += 1
-                if self.shield_bits_ally > 0:
-                    max_shield = self.unit_max_shield(unit)
-                    own_feats[ind] = unit.shield / max_shield
-                    ind += 1
 
-            if self.unit_type_bits > 0:
-                type_id = self.get_unit_type_id(unit, True)
-                own_feats[ind + type_id] = 1
-                ind += self.unit_type_bits
+        if self.unit_type_bits > 0:
+            enemy_feats[:, np.arange(self.n_enemies), ind + self.enemy_type_id] = 1  # unit type
+
+        # visible and alive
+        enemy_feats[~(dists["enemy_in_sight"] & self.enemy_alive)] = 0
+
+        # Ally features, computed for every pair and then the agent itself is dropped
+        al_dx, al_dy, al_dist = dists["ally_dx"], dists["ally_dy"], dists["ally_dist"]
+        ally_feats[:, :, 0] = 1  # visible
+        ally_feats[:, :, 1] = al_dist / sight_range  # distance
+        ally_feats[:, :, 2] = al_dx / sight_range  # relative X
+        ally_feats[:, :, 3] = al_dy / sight_range  # relative Y
 
-            if self.obs_last_action:
-                own_feats[ind:] = self.last_action[agent_id]
+        ind = 4
+        if self.obs_all_health:
+            ally_feats[:, :, ind] = self.ally_health / self.ally_health_max  # health
+            ind += 1
+            if self.shield_bits_ally > 0:
+                ally_feats[:, :, ind] = self.ally_shield / self.ally_max_shield  # shield
+                ind += 1
 
-        agent_obs = np.concatenate((ally_feats.flatten(),
-                                      enemy_feats.flatten(),
-                                      move_feats.flatten(),
-                                      own_feats.flatten()))
+        if self.unit_type_bits > 0:
+            ally_feats[:, np.arange(n_agents), ind + self.ally_type_id] = 1
+            ind += self.unit_type_bits
+
+        if self.obs_last_action:
+            ally_feats[:, :, ind:] = self.last_action
+
+        # visible and alive
+        ally_feats[~(dists["ally_in_sight"] & self.ally_alive)] = 0
+        ally_feats = ally_feats[~np.eye(n_agents, dtype=bool)].reshape(n_agents, n_agents - 1, -1)
+
+        # Own features
+        own_feats[:, 0] = 1  # visible
+        own_feats[:, 1] = 0  # distance
+        own_feats[:, 2] = 0  # X
+        own_feats[:, 3] = 0  # Y
+        ind = 4
+        if self.obs_own_health:
+            own_feats[:, ind] = self.ally_health / self.ally_health_max
+            ind += 1
+            if self.shield_bits_ally > 0:
+                own_feats[:, ind] = self.ally_shield / self.ally_max_shield
+                ind += 1
+
+        if self.unit_type_bits > 0:
+            own_feats[np.arange(n_agents), ind + self.ally_type_id] = 1
+            ind += self.unit_type_bits
+
+        if self.obs_last_action:
+            own_feats[:, ind:] = self.last_action
+
+        # dead agents observe all zeros
+        dead = ~self.ally_alive
+        move_feats[dead] = 0
+        enemy_feats[dead] = 0
+        ally_feats[dead] = 0
+        own_feats[dead] = 0
+
+        agents_obs = np.concatenate((ally_feats.reshape(n_agents, -1),
+                                     enemy_feats.reshape(n_agents, -1),
+                                     move_feats,
+                                     own_feats), axis=1)
 
         # Agent id features
         if self.obs_agent_id:
-            agent_id_feats[agent_id] = 1.
-            agent_obs = np.concatenate((ally_feats.flatten(),
-                                          enemy_feats.flatten(),
-                                          move_feats.flatten(),
-                                          own_feats.flatten(),
-                                          agent_id_feats.flatten()))
+            agents_obs = np.concatenate((agents_obs, np.eye(n_agents, dtype=np.float32)), axis=1)
 
         if self.obs_timestep_number:
-            agent_obs = np.append(agent_obs, self._episode_steps / self.episode_limit)
+            agents_obs = np.concatenate(
+                (agents_obs, np.full((n_agents, 1), self._episode_steps / self.episode_limit)), axis=1)
 
         if self.debug:
-            logging.debug("Obs Agent: {}".format(agent_id).center(60, "-"))
-            logging.debug("Avail. actions {}".format(
-                self.get_avail_agent_actions(agent_id)))
-            logging.debug("Move feats {}".format(move_feats))
-            logging.debug("Enemy feats {}".format(enemy_feats))
-            logging.debug("Ally feats {}".format(ally_feats))
-            logging.debug("Own feats {}".format(own_feats))
+            for agent_id in range(n_agents):
+                logging.debug("Obs Agent: {}".format(agent_id).center(60, "-"))
+                logging.debug("Avail. actions {}".format(avail_actions[agent_id]))
+                logging.debug("Move feats {}".format(move_feats[agent_id]))
+                logging.debug("Enemy feats {}".format(enemy_feats[agent_id]))
+                logging.debug("Ally feats {}".format(ally_feats[agent_id]))
+                logging.debug("Own feats {}".format(own_feats[agent_id]))
 
-        return agent_obs
-
-    def get_obs(self):
-        """Returns all agent observations in a list.
-        NOTE: Agents should have access only to their local observations
-        during decentralised execution.
-        """
-        agents_obs = [self.get_obs_agent(i) for i in range(self.n_agents)]
         return agents_obs
 
     def get_state(self, agent_id=-1):
-        """Returns the global state.
+        """Returns the global state from the point of view of agent_id.
+        See ``get_states`` for the layout of the state vector.
+        NOTE: This functon should not be used during decentralised execution.
+        """
+        return self.get_states()[agent_id]
+
+    def get_states(self):
+        """Returns the global state of every agent as an (n_agents, state_size)
+        array. All agents share the ally and enemy features; the distance,
+        relative position, visibility and enemy action features are taken
+        from the point of view of each agent.
         NOTE: This functon should not be used during decentralised execution.
         """
         if self.obs_instead_of_state:
             obs_concat = np.concatenate(self.get_obs(), axis=0).astype(np.float32)
-            return obs_concat
+            return np.tile(obs_concat, (self.n_agents, 1))
 
         nf_al = 2 + self.shield_bits_ally + self.unit_type_bits
         nf_en = 1 + self.shield_bits_enemy + self.unit_type_bits
@@ -1185,134 +1379,130 @@ class StarCraft2Env(MultiAgentEnv):
 
         nf_mv = self.get_state_move_feats_size()
 
-        ally_state = np.zeros((self.n_agents, nf_al), dtype=np.float32)
-        enemy_state = np.zeros((self.n_enemies, nf_en), dtype=np.float32)
-        move_state = np.zeros((1, nf_mv), dtype=np.float32)
-        agent_id_feats = np.zeros((self.n_agents, 1), dtype=np.float32)
+        n_agents = self.n_agents
+
+        ally_state = np.zeros((n_agents, n_agents, nf_al), dtype=np.float32)
+        enemy_state = np.zeros((n_agents, self.n_enemies, nf_en), dtype=np.float32)
+        move_state = np.zeros((n_agents, nf_mv), dtype=np.float32)
 
         center_x = self.map_x / 2
         center_y = self.map_y / 2
 
-        unit = self.get_unit_by_id(agent_id)# get the unit of some agent 
-        x = unit.pos.x
-        y = unit.pos.y
-        sight_range = self.unit_sight_range(agent_id)
-        avail_actions = self.get_avail_agent_actions(agent_id) 
-
-        if (self.use_mustalive and unit.health > 0) or (not self.use_mustalive): # or else all zeros
-            # Movement features
-            for m in range(self.n_actions_move):
-                move_state[0, m] = avail_actions[m + 2]
-
-            ind = self.n_actions_move
-
-            if self.state_pathing_grid:
-                move_state[0, ind: ind + self.n_obs_pathing] = self.get_surrounding_pathing(unit)
-                ind += self.n_obs_pathing
-
-            if self.state_terrain_height:
-                move_state[0, ind:] = self.get_surrounding_height(unit)
-                                      
-            for al_id, al_unit in self.agents.items():
-                if al_unit.health > 0:
-                    al_x = al_unit.pos.x
-                    al_y = al_unit.pos.y
-                    max_cd = self.unit_max_cooldown(al_unit)
-                    dist = self.distance(x, y, al_x, al_y)
-
-                    ally_state[al_id, 0] = (al_unit.health / al_unit.health_max)  # health
-                    if (self.map_type == "MMM" and al_unit.unit_type == self.medivac_id):
-                        ally_state[al_id, 1] = al_unit.energy / max_cd  # energy
-                    else:
-                        ally_state[al_id, 1] = (al_unit.weapon_cooldown / max_cd)  # cooldown
-                    
-                    ind = 2
-                    
-                    if self.add_center_xy:
-                        ally_state[al_id, ind] = (al_x - center_x) / self.max_distance_x  # center X
-                        ally_state[al_id, ind+1] = (al_y - center_y) / self.max_distance_y  # center Y
-                        ind += 2
-
-                    if self.shield_bits_ally > 0:
-                        max_shield = self.unit_max_shield(al_unit)
-                        ally_state[al_id, ind] = (al_unit.shield / max_shield)  # shield
-                        ind += 1
-
-                    if self.unit_type_bits > 0:
-                        type_id = self.get_unit_type_id(al_unit, True)
-                        ally_state[al_id, ind + type_id] = 1
-
-                    if unit.health > 0:
-                        ind += self.unit_type_bits
-                        if self.add_distance_state:
-                            ally_state[al_id, ind] = dist / sight_range  # distance
-                            ind += 1
-                        if self.add_xy_state:
-                            ally_state[al_id, ind] = (al_x - x) / sight_range  # relative X
-                            ally_state[al_id, ind + 1] = (al_y - y) / sight_range  # relative Y
-                            ind += 2
-                        if self.add_visible_state:
-                            if dist < sight_range:
-                                ally_state[al_id, ind] = 1 # visible
-                            ind += 1
-                        if self.state_last_action:
-                            ally_state[al_id, ind:] = self.last_action[al_id]
-
-            for e_id, e_unit in self.enemies.items():
-                if e_unit.health > 0:
-                    e_x = e_unit.pos.x
-                    e_y = e_unit.pos.y
-                    dist = self.distance(x, y, e_x, e_y)
-
-                    enemy_state[e_id, 0] = (e_unit.health / e_unit.health_max)  # health               
-                    
-                    ind = 1
-                    if self.add_center_xy:
-                        enemy_state[e_id, ind] = (e_x - center_x) / self.max_distance_x  # center X
-                        enemy_state[e_id, ind+1] = (e_y - center_y) / self.max_distance_y  # center Y
-                        ind += 2
-                        
-                    if self.shield_bits_enemy > 0:
-                        max_shield = self.unit_max_shield(e_unit)
-                        enemy_state[e_id, ind] = (e_unit.shield / max_shield)  # shield
-                        ind += 1
-
-                    if self.unit_type_bits > 0:
-                        type_id = self.get_unit_type_id(e_unit, False)
-                        enemy_state[e_id, ind + type_id] = 1
-
-                    if unit.health > 0:
-                        ind += self.unit_type_bits
-                        if self.add_distance_state:
-                            enemy_state[e_id, ind] = dist / sight_range  # distance
-                            ind += 1
-                        if self.add_xy_state:
-                            enemy_state[e_id, ind] = (e_x - x) / sight_range  # relative X
-                            enemy_state[e_id, ind + 1] = (e_y - y) / sight_range  # relative Y
-                            ind += 2
-                        if self.add_visible_state:
-                            if dist < sight_range:
-                                enemy_state[e_id, ind] = 1 # visible
-                            ind += 1
-                        if self.add_enemy_action_state:
-                            enemy_state[e_id, ind] = avail_actions[self.n_actions_no_attack + e_id]  # available
-
-        state = np.append(ally_state.flatten(), enemy_state.flatten())
-               
+        sight_range = self.ally_sight_range[:, None]
+        avail_actions = self.get_avail_actions()
+        dists = self.get_distances()
+        viewer_alive = self.ally_alive[:, None]
+
+        # Movement features
+        move_state[:, :self.n_actions_move] = avail_actions[:, 2:2 + self.n_actions_move]
+
+        ind = self.n_actions_move
+
+        if self.state_pathing_grid:
+            move_state[:, ind: ind + self.n_obs_pathing] = self.get_surrounding_pathing_all()
+            ind += self.n_obs_pathing
+
+        if self.state_terrain_height:
+            move_state[:, ind:] = self.get_surrounding_height_all()
+
+        # Ally features
+        al_dx, al_dy, al_dist = dists["ally_dx"], dists["ally_dy"], dists["ally_dist"]
+        ally_state[:, :, 0] = self.ally_health / self.ally_health_max  # health
+        ally_state[:, :, 1] = self.ally_cooldown  # energy / cooldown
+
+        ind = 2
+
+        if self.add_center_xy:
+            ally_state[:, :, ind] = (self.ally_pos[:, 0] - center_x) / self.max_distance_x  # center X
+            ally_state[:, :, ind+1] = (self.ally_pos[:, 1] - center_y) / self.max_distance_y  # center Y
+            ind += 2
+
+        if self.shield_bits_ally > 0:
+            ally_state[:, :, ind] = self.ally_shield / self.ally_max_shield  # shield
+            ind += 1
+
+        if self.unit_type_bits > 0:
+            ally_state[:, np.arange(n_agents), ind + self.ally_type_id] = 1
+            ind += self.unit_type_bits
+
+        # the remaining features are only filled in by alive agents
+        viewer_ind = ind
+        if self.add_distance_state:
+            ally_state[:, :, ind] = al_dist / sight_range  # distance
+            ind += 1
+        if self.add_xy_state:
+            ally_state[:, :, ind] = al_dx / sight_range  # relative X
+            ally_state[:, :, ind + 1] = al_dy / sight_range  # relative Y
+            ind += 2
+        if self.add_visible_state:
+            ally_state[:, :, ind] = dists["ally_in_sight"]  # visible
+            ind += 1
+        if self.state_last_action:
+            ally_state[:, :, ind:] = self.last_action
+
+        ally_state[:, :, viewer_ind:] *= viewer_alive[:, :, None]
+        ally_state[:, ~self.ally_alive] = 0
+
+        # Enemy features
+        e_dx, e_dy, e_dist = dists["enemy_dx"], dists["enemy_dy"], dists["enemy_dist"]
+        enemy_state[:, :, 0] = self.enemy_health / self.enemy_health_max  # health
+
+        ind = 1
+        if self.add_center_xy:
+            enemy_state[:, :, ind] = (self.enemy_pos[:, 0] - center_x) / self.max_distance_x  # center X
+            enemy_state[:, :, ind+1] = (self.enemy_pos[:, 1] - center_y) / self.max_distance_y  # center Y
+            ind += 2
+
+        if self.shield_bits_enemy > 0:
+            enemy_state[:, :, ind] = self.enemy_shield / self.enemy_max_shield  # shield
+            ind += 1
+
+        if self.unit_type_bits > 0:
+            enemy_state[:, np.arange(self.n_enemies), ind + self.enemy_type_id] = 1
+            ind += self.unit_type_bits
+
+        # the remaining features are only filled in by alive agents
+        viewer_ind = ind
+        if self.add_distance_state:
+            enemy_state[:, :, ind] = e_dist / sight_range  # distance
+            ind += 1
+        if self.add_xy_state:
+            enemy_state[:, :, ind] = e_dx / sight_range  # relative X
+            enemy_state[:, :, ind + 1] = e_dy / sight_range  # relative Y
+            ind += 2
+        if self.add_visible_state:
+            enemy_state[:, :, ind] = dists["enemy_in_sight"]  # visible
+            ind += 1
+        if self.add_enemy_action_state:
+            enemy_state[:, :, ind] = avail_actions[:, self.n_actions_no_attack:]  # available
+
+        enemy_state[:, :, viewer_ind:] *= viewer_alive[:, :, None]
+        enemy_state[:, ~self.enemy_alive] = 0
+
+        if self.use_mustalive:
+            # or else all zeros
+            dead = ~self.ally_alive
+            ally_state[dead] = 0
+            enemy_state[dead] = 0
+            move_state[dead] = 0
+
+        states = np.concatenate((ally_state.reshape(n_agents, -1),
+                                 enemy_state.reshape(n_agents, -1)), axis=1)
+
         if self.add_move_state:
-            state = np.append(state, move_state.flatten())
+            states = np.concatenate((states, move_state), axis=1)
 
         if self.add_local_obs:
-            state = np.append(state, self.get_obs_agent(agent_id).flatten())
+            states = np.concatenate((states, self.get_obs()), axis=1)
 
         if self.state_timestep_number:
-            state = np.append(state, self._episode_steps / self.episode_limit)
+            states = np.concatenate(
+                (states, np.full((n_agents, 1), self._episode_steps / self.episode_limit)), axis=1)
 
         if self.add_agent_id:
-            agent_id_feats[agent_id] = 1.0
-            state = np.append(state, agent_id_feats.flatten())
+            states = np.concatenate((states, np.eye(n_agents, dtype=np.float32)), axis=1)
 
-        state = state.astype(dtype=np.float32)
+        states = states.astype(dtype=np.float32)
 
         if self.debug:
             logging.debug("STATE".center(60, "-"))
@@ -1322,10 +1512,18 @@ class StarCraft2Env(MultiAgentEnv):
             if self.state_last_action:
                 logging.debug("Last actions {}".format(self.last_action))
 
-        return state
-    
+        return states
+
     def get_state_agent(self, agent_id):
-        """Returns observation for agent_id. The observation is composed of:
+        """Returns the agent-specific global state for agent_id. See
+        ``get_state_agents`` for the layout of the state vector.
+        NOTE: This functon should not be used during decentralised execution.
+        """
+        return self.get_state_agents()[agent_id]
+
+    def get_state_agents(self):
+        """Returns the agent-specific global state of every agent as an
+        (n_agents, state_size) array. The state of each agent is composed of:
 
            - agent movement features (where it can move to, height information and pathing grid)
            - enemy features (available_to_attack, health, relative_x, relative_y, shield, unit_type)
@@ -1336,188 +1534,164 @@ class StarCraft2Env(MultiAgentEnv):
            in the aforementioned order. To know the sizes of each of the
            features inside the final list of features, take a look at the
            functions ``get_obs_move_feats_size()``,
-           ``get_obs_enemy_feats_size()``, ``get_obs_ally_feats_size()`` and
-           ``get_obs_own_feats_size()``.
+           ``get_state_enemy_feats_size()``, ``get_state_ally_feats_size()``
+           and ``get_state_own_feats_size()``.
 
-           The size of the observation vector may vary, depending on the
-           environment configuration and type of units present in the map.
-           For instance, non-Protoss units will not have shields, movement
-           features may or may not include terrain height and pathing grid,
-           unit_type is not included if there is only one type of unit in the
-           map etc.).
+           Unlike the observation, enemies and allies outside of the sight
+           range are still included.
 
-           NOTE: Agents should have access only to their local observations
-           during decentralised execution.
+           NOTE: This functon should not be used during decentralised execution.
         """
         if self.obs_instead_of_state:
             obs_concat = np.concatenate(self.get_obs(), axis=0).astype(np.float32)
-            return obs_concat
-            
-        unit = self.get_unit_by_id(agent_id)
+            return np.tile(obs_concat, (self.n_agents, 1))
 
-        move_feats_dim = self.get_obs_move_feats_size()
-        enemy_feats_dim = self.get_state_enemy_feats_size()
-        ally_feats_dim = self.get_state_ally_feats_size()
-        own_feats_dim = self.get_state_own_feats_size()
+        n_agents = self.n_agents
 
-        move_feats = np.zeros(move_feats_dim, dtype=np.float32)
-        enemy_feats = np.zeros(enemy_feats_dim, dtype=np.float32)
-        ally_feats = np.zeros(ally_feats_dim, dtype=np.float32)
-        own_feats = np.zeros(own_feats_dim, dtype=np.float32)
-        agent_id_feats = np.zeros(self.n_agents, dtype=np.float32)
+        move_feats = np.zeros((n_agents, self.get_obs_move_feats_size()), dtype=np.float32)
+        enemy_feats = np.zeros((n_agents, *self.get_state_enemy_feats_size()), dtype=np.float32)
+        ally_feats = np.zeros((n_agents, n_agents, self.get_state_ally_feats_size()[1]), dtype=np.float32)
+        own_feats = np.zeros((n_agents, self.get_state_own_feats_size()), dtype=np.float32)
 
         center_x = self.map_x / 2
         center_y = self.map_y / 2
 
-        if (self.use_mustalive and unit.health > 0) or (not self.use_mustalive):  # otherwise dead, return all zeros
-            x = unit.pos.x
-            y = unit.pos.y
-            sight_range = self.unit_sight_range(agent_id)
-
-            # Movement features
-            avail_actions = self.get_avail_agent_actions(agent_id)
-            for m in range(self.n_actions_move):
-                move_feats[m] = avail_actions[m + 2]
-
-            ind = self.n_actions_move
-
-            if self.state_pathing_grid:
-                move_feats[ind: ind + self.n_obs_pathing] = self.get_surrounding_pathing(unit)
-                ind += self.n_obs_pathing
-
-            if self.state_terrain_height:
-                move_feats[ind:] = self.get_surrounding_height(unit)
-
-            # Enemy features
-            for e_id, e_unit in self.enemies.items():
-                e_x = e_unit.pos.x
-                e_y = e_unit.pos.y
-                dist = self.distance(x, y, e_x, e_y)
-
-                if e_unit.health > 0:  # visible and alive
-                    # Sight range > shoot range
-                    if unit.health > 0:
-                        enemy_feats[e_id, 0] = avail_actions[self.n_actions_no_attack + e_id]  # available
-                        enemy_feats[e_id, 1] = dist / sight_range  # distance
-                        enemy_feats[e_id, 2] = (e_x - x) / sight_range  # relative X
-                        enemy_feats[e_id, 3] = (e_y - y) / sight_range  # relative Y
-                        if dist < sight_range:
-                            enemy_feats[e_id, 4] = 1  # visible
-
-                    ind = 5
-                    if self.obs_all_health:
-                        enemy_feats[e_id, ind] = (e_unit.health / e_unit.health_max)  # health
-                        ind += 1
-                        if self.shield_bits_enemy > 0:
-                            max_shield = self.unit_max_shield(e_unit)
-                            enemy_feats[e_id, ind] = (e_unit.shield / max_shield)  # shield
-                            ind += 1
-
-                    if self.unit_type_bits > 0:
-                        type_id = self.get_unit_type_id(e_unit, False)
-                        enemy_feats[e_id, ind + type_id] = 1  # unit type
-                        ind += self.unit_type_bits
-
-                    if self.add_center_xy:
-                        enemy_feats[e_id, ind] = (e_x - center_x) / self.max_distance_x  # center X
-                        enemy_feats[e_id, ind+1] = (e_y - center_y) / self.max_distance_y  # center Y
-
-            # Ally features
-            al_ids = [al_id for al_id in range(self.n_agents) if al_id != agent_id]
-            for i, al_id in enumerate(al_ids):
-
-                al_unit = self.get_unit_by_id(al_id)
-                al_x = al_unit.pos.x
-                al_y = al_unit.pos.y
-                dist = self.distance(x, y, al_x, al_y)
-                max_cd = self.unit_max_cooldown(al_unit)
-
-                if al_unit.health > 0:  # visible and alive
-                    if unit.health > 0:
-                        if dist < sight_range:
-                            ally_feats[i, 0] = 1  # visible
-                        ally_feats[i, 1] = dist / sight_range  # distance
-                        ally_feats[i, 2] = (al_x - x) / sight_range  # relative X
-                        ally_feats[i, 3] = (al_y - y) / sight_range  # relative Y
-
-                    if (self.map_type == "MMM" and al_unit.unit_type == self.medivac_id):
-                        ally_feats[i, 4] = al_unit.energy / max_cd  # energy
-                    else:
-                        ally_feats[i, 4] = (al_unit.weapon_cooldown / max_cd)  # cooldown
-
-                    ind = 5
-                    if self.obs_all_health:
-                        ally_feats[i, ind] = (al_unit.health / al_unit.health_max)  # health
-                        ind += 1
-                        if self.shield_bits_ally > 0:
-                            max_shield = self.unit_max_shield(al_unit)
-                            ally_feats[i, ind] = (al_unit.shield / max_shield)  # shield
-                            ind += 1
-
-                    if self.add_center_xy:
-                        ally_feats[i, ind] = (al_x - center_x) / self.max_distance_x  # center X
-                        ally_feats[i, ind+1] = (al_y - center_y) / self.max_distance_y  # center Y
-                        ind += 2
-
-                    if self.unit_type_bits > 0:
-                        type_id = self.get_unit_type_id(al_unit, True)
-                        ally_feats[i, ind + type_id] = 1
-                        ind += self.unit_type_bits
-
-                    if self.state_last_action:
-                        ally_feats[i, ind:] = self.last_action[al_id]
-
-            # Own features
-            ind = 0
-            own_feats[0] = 1  # visible
-            own_feats[1] = 0  # distance
-            own_feats[2] = 0  # X
-            own_feats[3] = 0  # Y
-            ind = 4
-            if self.obs_own_health:
-                own_feats[ind] = unit.health / unit.health_max
+        sight_range = self.ally_sight_range[:, None]
+        avail_actions = self.get_avail_actions()
+        dists = self.get_distances()
+        viewer_dead = ~self.ally_alive
+
+        # Movement features
+        move_feats[:, :self.n_actions_move] = avail_actions[:, 2:2 + self.n_actions_move]
+
+        ind = self.n_actions_move
+
+        if self.state_pathing_grid:
+            move_feats[:, ind: ind + self.n_obs_pathing] = self.get_surrounding_pathing_all()
+            ind += self.n_obs_pathing
+
+        if self.state_terrain_height:
+            move_feats[:, ind:] = self.get_surrounding_height_all()
+
+        # Enemy features
+        e_dx, e_dy, e_dist = dists["enemy_dx"], dists["enemy_dy"], dists["enemy_dist"]
+        # Sight range > shoot range, only filled in by alive agents
+        enemy_feats[:, :, 0] = avail_actions[:, self.n_actions_no_attack:]  # available
+        enemy_feats[:, :, 1] = e_dist / sight_range  # distance
+        enemy_feats[:, :, 2] = e_dx / sight_range  # relative X
+        enemy_feats[:, :, 3] = e_dy / sight_range  # relative Y
+        enemy_feats[:, :, 4] = dists["enemy_in_sight"]  # visible
+        enemy_feats[viewer_dead, :, :5] = 0
+
+        ind = 5
+        if self.obs_all_health:
+            enemy_feats[:, :, ind] = self.enemy_health / self.enemy_health_max  # health
+            ind += 1
+            if self.shield_bits_enemy > 0:
+                enemy_feats[:, :, ind] = self.enemy_shield / self.enemy_max_shield  # shield
                 ind += 1
-                if self.shield_bits_ally > 0:
-                    max_shield = self.unit_max_shield(unit)
-                    own_feats[ind] = unit.shield / max_shield
-                    ind += 1
 
-            if self.add_center_xy:
-                own_feats[ind] = (x - center_x) / self.max_distance_x  # center X
-                own_feats[ind+1] = (y - center_y) / self.max_distance_y  # center Y
-                ind += 2
+        if self.unit_type_bits > 0:
+            enemy_feats[:, np.arange(self.n_enemies), ind + self.enemy_type_id] = 1  # unit type
+            ind += self.unit_type_bits
+
+        if self.add_center_xy:
+            enemy_feats[:, :, ind] = (self.enemy_pos[:, 0] - center_x) / self.max_distance_x  # center X
+            enemy_feats[:, :, ind+1] = (self.enemy_pos[:, 1] - center_y) / self.max_distance_y  # center Y
 
-            if self.unit_type_bits > 0:
-                type_id = self.get_unit_type_id(unit, True)
-                own_feats[ind + type_id] = 1
-                ind += self.unit_type_bits
+        # alive
+        enemy_feats[:, ~self.enemy_alive] = 0
 
-            if self.state_last_action:
-                own_feats[ind:] = self.last_action[agent_id]
+        # Ally features, computed for every pair and then the agent itself is dropped
+        al_dx, al_dy, al_dist = dists["ally_dx"], dists["ally_dy"], dists["ally_dist"]
+        # only filled in by alive agents
+        ally_feats[:, :, 0] = dists["ally_in_sight"]  # visible
+        ally_feats[:, :, 1] = al_dist / sight_range  # distance
+        ally_feats[:, :, 2] = al_dx / sight_range  # relative X
+        ally_feats[:, :, 3] = al_dy / sight_range  # relative Y
+        ally_feats[viewer_dead, :, :4] = 0
+
+        ally_feats[:, :, 4] = self.ally_cooldown  # energy / cooldown
+
+        ind = 5
+        if self.obs_all_health:
+            ally_feats[:, :, ind] = self.ally_health / self.ally_health_max  # health
+            ind += 1
+            if self.shield_bits_ally > 0:
+                ally_feats[:, :, ind] = self.ally_shield / self.ally_max_shield  # shield
+                ind += 1
 
-        state = np.concatenate((ally_feats.flatten(), 
-                                enemy_feats.flatten(),
-                                move_feats.flatten(),
-                                own_feats.flatten()))
+        if self.add_center_xy:
+            ally_feats[:, :, ind] = (self.ally_pos[:, 0] - center_x) / self.max_distance_x  # center X
+            ally_feats[:, :, ind+1] = (self.ally_pos[:, 1] - center_y) / self.max_distance_y  # center Y
+            ind += 2
+
+        if self.unit_type_bits > 0:
+            ally_feats[:, np.arange(n_agents), ind + self.ally_type_id] = 1
+            ind += self.unit_type_bits
+
+        if self.state_last_action:
+            ally_feats[:, :, ind:] = self.last_action
+
+        # alive
+        ally_feats[:, ~self.ally_alive] = 0
+        ally_feats = ally_feats[~np.eye(n_agents, dtype=bool)].reshape(n_agents, n_agents - 1, -1)
+
+        # Own features
+        own_feats[:, 0] = 1  # visible
+        own_feats[:, 1] = 0  # distance
+        own_feats[:, 2] = 0  # X
+        own_feats[:, 3] = 0  # Y
+        ind = 4
+        if self.obs_own_health:
+            own_feats[:, ind] = self.ally_health / self.ally_health_max
+            ind += 1
+            if self.shield_bits_ally > 0:
+                own_feats[:, ind] = self.ally_shield / self.ally_max_shield
+                ind += 1
+
+        if self.add_center_xy:
+            own_feats[:, ind] = (self.ally_pos[:, 0] - center_x) / self.max_distance_x  # center X
+            own_feats[:, ind+1] = (self.ally_pos[:, 1] - center_y) / self.max_distance_y  # center Y
+            ind += 2
+
+        if self.unit_type_bits > 0:
+            own_feats[np.arange(n_agents), ind + self.ally_type_id] = 1
+            ind += self.unit_type_bits
+
+        if self.state_last_action:
+            own_feats[:, ind:] = self.last_action
+
+        if self.use_mustalive:
+            # otherwise dead, return all zeros
+            move_feats[viewer_dead] = 0
+            enemy_feats[viewer_dead] = 0
+            ally_feats[viewer_dead] = 0
+            own_feats[viewer_dead] = 0
+
+        states = np.concatenate((ally_feats.reshape(n_agents, -1),
+                                 enemy_feats.reshape(n_agents, -1),
+                                 move_feats,
+                                 own_feats), axis=1)
 
         # Agent id features
         if self.state_agent_id:
-            agent_id_feats[agent_id] = 1.
-            state = np.append(state, agent_id_feats.flatten())
+            states = np.concatenate((states, np.eye(n_agents, dtype=np.float32)), axis=1)
 
         if self.state_timestep_number:
-            state = np.append(state, self._episode_steps / self.episode_limit)
+            states = np.concatenate(
+                (states, np.full((n_agents, 1), self._episode_steps / self.episode_limit)), axis=1)
 
         if self.debug:
-            logging.debug("Obs Agent: {}".format(agent_id).center(60, "-"))
-            logging.debug("Avail. actions {}".format(
-                self.get_avail_agent_actions(agent_id)))
-            logging.debug("Move feats {}".format(move_feats))
-            logging.debug("Enemy feats {}".format(enemy_feats))
-            logging.debug("Ally feats {}".format(ally_feats))
-            logging.debug("Own feats {}".format(own_feats))
+            for agent_id in range(n_agents):
+                logging.debug("Obs Agent: {}".format(agent_id).center(60, "-"))
+                logging.debug("Avail. actions {}".format(avail_actions[agent_id]))
+                logging.debug("Move feats {}".format(move_feats[agent_id]))
+                logging.debug("Enemy feats {}".format(enemy_feats[agent_id]))
+                logging.debug("Ally feats {}".format(ally_feats[agent_id]))
+                logging.debug("Own feats {}".format(own_feats[agent_id]))
 
-        return state
+        return states
 
     def get_obs_enemy_feats_size(self):
         """ Returns the dimensions of the matrix containing enemy features.
@@ -1739,39 +1913,17 @@ class StarCraft2Env(MultiAgentEnv):
         (n_agents, n_agents + n_enemies) indicating which units
         are visible to each agent.
         """
-        arr = np.zeros((self.n_agents, self.n_agents + self.n_enemies), dtype=np.bool)
+        arr = np.zeros((self.n_agents, self.n_agents + self.n_enemies), dtype=bool)
+        dists = self.get_distances()
+        alive = self.ally_alive[:, None]
 
-        for agent_id in range(self.n_agents):
-            current_agent = self.get_unit_by_id(agent_id)
-            if current_agent.health > 0:  # it agent not dead
-                x = current_agent.pos.x
-                y = current_agent.pos.y
-                sight_range = self.unit_sight_range(agent_id)
+        # Enemies
+        arr[:, self.n_agents:] = dists["enemy_in_sight"] & alive & self.enemy_alive
 
-                # Enemies
-                for e_id, e_unit in self.enemies.items():
-                    e_x = e_unit.pos.x
-                    e_y = e_unit.pos.y
-                    dist = self.distance(x, y, e_x, e_y)
-
-                    if (dist < sight_range and e_unit.health > 0):
-                        # visible and alive
-                        arr[agent_id, self.n_agents + e_id] = 1
-
-                # The matrix for allies is filled symmetrically
-                al_ids = [
-                    al_id for al_id in range(self.n_agents)
-                    if al_id > agent_id
-                ]
-                for i, al_id in enumerate(al_ids):
-                    al_unit = self.get_unit_by_id(al_id)
-                    al_x = al_unit.pos.x
-                    al_y = al_unit.pos.y
-                    dist = self.distance(x, y, al_x, al_y)
-
-                    if (dist < sight_range and al_unit.health > 0):
-                        # visible and alive
-                        arr[agent_id, al_id] = arr[al_id, agent_id] = 1
+        # The matrix for allies is filled symmetrically from the sight range
+        # of the agent with the lower id
+        upper = np.triu(dists["ally_in_sight"] & alive & self.ally_alive, 1)
+        arr[:, :self.n_agents] = upper | upper.T
 
         return arr
 
@@ -1808,62 +1960,67 @@ class StarCraft2Env(MultiAgentEnv):
 
     def get_avail_agent_actions(self, agent_id):
         """Returns the available actions for agent_id."""
-        unit = self.get_unit_by_id(agent_id)
-        if unit.health > 0:
-            # cannot choose no-op when alive
-            avail_actions = [0] * self.n_actions
-
-            # stop should be allowed
-            avail_actions[1] = 1
-
-            # see if we can move
-            if self.can_move(unit, Direction.NORTH):
-                avail_actions[2] = 1
-            if self.can_move(unit, Direction.SOUTH):
-                avail_actions[3] = 1
-            if self.can_move(unit, Direction.EAST):
-                avail_actions[4] = 1
-            if self.can_move(unit, Direction.WEST):
-                avail_actions[5] = 1
-
-            # Can attack only alive units that are alive in the shooting range
-            shoot_range = self.unit_shoot_range(agent_id)
-
-            target_items = self.enemies.items()
-            if self.map_type == "MMM" and unit.unit_type == self.medivac_id:
-                # Medivacs cannot heal themselves or other flying units
-                target_items = [
-                    (t_id, t_unit)
-                    for (t_id, t_unit) in self.agents.items()
-                    if t_unit.unit_type != self.medivac_id
-                ]
-
-            for t_id, t_unit in target_items:
-                if t_unit.health > 0:
-                    dist = self.distance(
-                        unit.pos.x, unit.pos.y, t_unit.pos.x, t_unit.pos.y
-                    )
-                    if dist <= shoot_range:
-                        avail_actions[t_id + self.n_actions_no_attack] = 1
-
-            return avail_actions
-
-        else:
-            # only no-op allowed
-            return [1] + [0] * (self.n_actions - 1)
+        return self.get_avail_actions()[agent_id].tolist()
 
     def get_avail_actions(self):
-        """Returns the available actions of all agents in a list."""
-        avail_actions = []
-        for agent_id in range(self.n_agents):
-            avail_agent = self.get_avail_agent_actions(agent_id)
-            avail_actions.append(avail_agent)
+        """Returns the available actions of all agents as an
+        (n_agents, n_actions) array. The result is cached until the units
+        are updated."""
+        if self._avail_actions is not None:
+            return self._avail_actions
+
+        avail_actions = np.zeros((self.n_agents, self.n_actions), dtype=np.int64)
+        alive = self.ally_alive
+
+        # only no-op allowed for dead agents
+        avail_actions[~alive, 0] = 1
+
+        # stop should be allowed, cannot choose no-op when alive
+        avail_actions[alive, 1] = 1
+
+        # see if we can move
+        if self.can_move_table is not None:
+            pos = self.ally_pos[alive]
+            cells = pos.astype(np.int64)
+            can_move = self.can_move_table[cells[:, 0], cells[:, 1]]
+            # the table assumes moving south/west from the cell m - 1 lands on the cell 0, but int() only
+            # truncates to 0 if the target is above -1, like check_bounds in can_move
+            m = self._move_amount / 2
+            can_move[:, Direction.SOUTH] &= pos[:, 1] - m > -1
+            can_move[:, Direction.WEST] &= pos[:, 0] - m > -1
+            avail_actions[alive, 2:2 + self.n_actions_move] = can_move
+        else:
+            for agent_id in np.flatnonzero(alive):
+                unit = self.get_unit_by_id(agent_id)
+                for direction in Direction:
+                    if self.can_move(unit, direction):
+                        avail_actions[agent_id, 2 + direction] = 1
+
+        # Can attack only alive units that are alive in the shooting range
+        dists = self.get_distances()
+        attack = alive[:, None] & self.enemy_alive & dists["enemy_in_shoot"]
+        avail_actions[:, self.n_actions_no_attack:] = attack
+
+        if self.map_type == "MMM":
+            # Medivacs cannot heal themselves or other flying units
+            medivac = alive & (self.ally_unit_type == self.medivac_id)
+            if medivac.any():
+                heal = (self.ally_alive & (self.ally_unit_type != self.medivac_id)
+                        & dists["ally_in_shoot"])
+                avail_actions[medivac, self.n_actions_no_attack:] = 0
+                avail_actions[medivac, self.n_actions_no_attack:self.n_actions_no_attack + self.n_agents] = heal[medivac]
+
+        self._avail_actions = avail_actions
         return avail_actions
 
     def close(self):
         """Close StarCraft II."""
         if self._sc2_proc:
             self._sc2_proc.close()
+        self._close_standby()
+        if self._standby_pool is not None:
+            self._standby_pool.shutdown()
+            self._standby_pool = None
 
     def seed(self, seed):
         """Returns the random seed used by the environment."""
@@ -1929,6 +2086,10 @@ class StarCraft2Env(MultiAgentEnv):
             all_enemies_created = (len(self.enemies) == self.n_enemies)
 
             if all_agents_created and all_enemies_created:  # all good
+                # unit tags stay the same for the whole episode
+                self._ally_tags = {unit.tag: al_id for al_id, unit in self.agents.items()}
+                self._enemy_tags = {unit.tag: e_id for e_id, unit in self.enemies.items()}
+                self._update_unit_arrays()
                 return
 
             try:
@@ -1942,36 +2103,37 @@ class StarCraft2Env(MultiAgentEnv):
         """Update units after an environment step.
         This function assumes that self._obs is up-to-date.
         """
-        n_ally_alive = 0
-        n_enemy_alive = 0
-
         # Store previous state
-        self.previous_ally_units = deepcopy(self.agents)
-        self.previous_enemy_units = deepcopy(self.enemies)
+        self.previous_ally_health[:] = self.ally_health
+        self.previous_ally_shield[:] = self.ally_shield
+        self.previous_enemy_health[:] = self.enemy_health
+        self.previous_enemy_shield[:] = self.enemy_shield
 
-        for al_id, al_unit in self.agents.items():
-            updated = False
-            for unit in self._obs.observation.raw_data.units:
-                if al_unit.tag == unit.tag:
-                    self.agents[al_id] = unit
-                    updated = True
-                    n_ally_alive += 1
-                    break
+        ally_updated = np.zeros(self.n_agents, dtype=bool)
+        enemy_updated = np.zeros(self.n_enemies, dtype=bool)
 
-            if not updated:  # dead
-                al_unit.health = 0
+        for unit in self._obs.observation.raw_data.units:
+            al_id = self._ally_tags.get(unit.tag)
+            if al_id is not None:
+                self.agents[al_id] = unit
+                ally_updated[al_id] = True
+                continue
 
-        for e_id, e_unit in self.enemies.items():
-            updated = False
-            for unit in self._obs.observation.raw_data.units:
-                if e_unit.tag == unit.tag:
-                    self.enemies[e_id] = unit
-                    updated = True
-                    n_enemy_alive += 1
-                    break
+            e_id = self._enemy_tags.get(unit.tag)
+            if e_id is not None:
+                self.enemies[e_id] = unit
+                enemy_updated[e_id] = True
+
+        for al_id in np.flatnonzero(~ally_updated):  # dead
+            self.agents[al_id].health = 0
+
+        for e_id in np.flatnonzero(~enemy_updated):  # dead
+            self.enemies[e_id].health = 0
 
-            if not updated:  # dead
-                e_unit.health = 0
+        n_ally_alive = np.count_nonzero(ally_updated)
+        n_enemy_alive = np.count_nonzero(enemy_updated)
+
+        self._update_unit_arrays()
 
         if (n_ally_alive == 0 and n_enemy_alive > 0
                 or self.only_medivac_left(ally=True)):
@@ -1984,6 +2146,50 @@ class StarCraft2Env(MultiAgentEnv):
 
         return None
 
+    def _update_unit_arrays(self):
+        """Copy the unit attributes used for observations, states and
+        available actions into numpy arrays, indexed by agent and enemy id.
+        Should be called whenever self.agents or self.enemies change.
+        """
+        agents = [self.agents[al_id] for al_id in range(self.n_agents)]
+        enemies = [self.enemies[e_id] for e_id in range(self.n_enemies)]
+
+        self.ally_pos = np.array([(u.pos.x, u.pos.y) for u in agents], dtype=np.float64).reshape(-1, 2)
+        self.ally_health = np.array([u.health for u in agents], dtype=np.float64)
+        self.ally_health_max = np.array([u.health_max for u in agents], dtype=np.float64)
+        self.ally_shield = np.array([u.shield for u in agents], dtype=np.float64)
+        self.ally_unit_type = np.array([u.unit_type for u in agents], dtype=np.int64)
+        self.ally_alive = self.ally_health > 0
+        self.ally_sight_range = np.array([self.unit_sight_range(al_id) for al_id in range(self.n_agents)], dtype=np.float64)
+        self.ally_shoot_range = np.array([self.unit_shoot_range(al_id) for al_id in range(self.n_agents)], dtype=np.float64)
+
+        max_cd = np.array([self.unit_max_cooldown(u) for u in agents], dtype=np.float64)
+        if self.map_type == "MMM":
+            cooldown = np.array([u.energy if u.unit_type == self.medivac_id else u.weapon_cooldown
+                                 for u in agents], dtype=np.float64)
+        else:
+            cooldown = np.array([u.weapon_cooldown for u in agents], dtype=np.float64)
+        self.ally_cooldown = cooldown / max_cd
+
+        self.enemy_pos = np.array([(u.pos.x, u.pos.y) for u in enemies], dtype=np.float64).reshape(-1, 2)
+        self.enemy_health = np.array([u.health for u in enemies], dtype=np.float64)
+        self.enemy_health_max = np.array([u.health_max for u in enemies], dtype=np.float64)
+        self.enemy_shield = np.array([u.shield for u in enemies], dtype=np.float64)
+        self.enemy_alive = self.enemy_health > 0
+
+        if self.shield_bits_ally > 0:
+            self.ally_max_shield = np.array([self.unit_max_shield(u) for u in agents], dtype=np.float64)
+        if self.shield_bits_enemy > 0:
+            self.enemy_max_shield = np.array([self.unit_max_shield(u) for u in enemies], dtype=np.float64)
+
+        if self.unit_type_bits > 0:
+            self.ally_type_id = np.array([self.get_unit_type_id(u, True) for u in agents], dtype=np.int64)
+            self.enemy_type_id = np.array([self.get_unit_type_id(u, False) for u in enemies], dtype=np.int64)
+
+        # cached results derived from the previous observation
+        self._avail_actions = None
+        self._distances = None
+
     def _init_ally_unit_types(self, min_unit_type):
         """Initialise ally unit types. Should be called once from the
         init_units function.
@@ -2050,5 +2256,8 @@ class StarCraft2Env(MultiAgentEnv):
             "win_rate": self.battles_won / self.battles_game,
             "timeouts": self.timeouts,
             "restarts": self.force_restarts,
+            "standby_swaps": self.standby_swaps,
+            "last_restart_time": self.last_restart_time,
+            "mean_restart_time": self.total_restart_time / max(1, self.force_restarts),
         }
         return stats
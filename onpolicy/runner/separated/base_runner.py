@@ -5,9 +5,11 @@ import os
 import numpy as np
 from itertools import chain
 import torch
+import torch.distributed as dist
 from tensorboardX import SummaryWriter
 
 from onpolicy.utils.separated_buffer import SeparatedReplayBuffer
+from onpolicy.utils.train_pool import TrainPool
 from onpolicy.utils.util import update_linear_schedule
 
 def _t2n(x):
@@ -37,6 +39,7 @@ class Runner(object):
         self.use_wandb = self.all_args.use_wandb
         self.use_render = self.all_args.use_render
         self.recurrent_N = self.all_args.recurrent_N
+        self.use_parallel_train = self.all_args.use_parallel_train
 
         # interval
         self.save_interval = self.all_args.save_interval
@@ -86,6 +89,7 @@ class Runner(object):
 
         self.trainer = []
         self.buffer = []
+        share_obs_storage = None
         for agent_id in range(self.num_agents):
             # algorithm
             tr = TrainAlgo(self.all_args, self.policy[agent_id], device = self.device)
@@ -94,9 +98,17 @@ class Runner(object):
             bu = SeparatedReplayBuffer(self.all_args,
                                        self.envs.observation_space[agent_id],
                                        share_observation_space,
-                                       self.envs.action_space[agent_id])
+                                       self.envs.action_space[agent_id],
+                                       share_obs=share_obs_storage)
+            if self.use_centralized_V and share_obs_storage is None:
+                # every agent sees the same centralized state, keep a single copy of it
+                share_obs_storage = bu.share_obs
             self.buffer.append(bu)
             self.trainer.append(tr)
+
+        if self.use_parallel_train:
+            self.train_pool = TrainPool(self.trainer, self.buffer, n_workers=self.all_args.n_train_workers,
+                                        n_threads=self.all_args.n_training_threads)
             
     def run(self):
         raise NotImplementedError
@@ -121,16 +133,35 @@ class Runner(object):
             self.buffer[agent_id].compute_returns(next_value, self.trainer[agent_id].value_normalizer)
 
     def train(self):
+        if self.use_parallel_train:
+            return self.train_parallel()
+
         train_infos = []
         for agent_id in range(self.num_agents):
             self.trainer[agent_id].prep_training()
             train_info = self.trainer[agent_id].train(self.buffer[agent_id])
             train_infos.append(train_info)       
+
+        # buffers may share storage, so only roll them over once every trainer is done
+        for agent_id in range(self.num_agents):
+            self.buffer[agent_id].after_update()
+
+        return train_infos
+
+    def train_parallel(self):
+        # one seed per trainer for the minibatch shuffle, drawn from the global RNG so that runs stay deterministic
+        seeds = torch.randint(2 ** 62, (self.num_agents,)).tolist()
+        train_infos = self.train_pool.train(seeds)
+        # buffers may share storage, so only roll them over once every trainer is done
+        for agent_id in range(self.num_agents):
             self.buffer[agent_id].after_update()
 
         return train_infos
 
     def save(self):
+        if self.all_args.use_distributed and dist.get_rank() != 0:
+            # the weights are the same in all learner processes
+            return
         for agent_id in range(self.num_agents):
             policy_actor = self.trainer[agent_id].policy.actor
             torch.save(policy_actor.state_dict(), str(self.save_dir) + "/actor_agent" + str(agent_id) + ".pt")
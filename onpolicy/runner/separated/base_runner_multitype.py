@@ -6,15 +6,20 @@ import numpy as np
 from itertools import chain
 from collections import Counter
 import torch
+import torch.distributed as dist
 from tensorboardX import SummaryWriter
 
-from onpolicy.utils.separated_buffer import SeparatedReplayBuffer
 from onpolicy.utils.shared_buffer import SharedReplayBuffer
+from onpolicy.utils.train_pool import TrainPool
 from onpolicy.utils.util import update_linear_schedule
 
 def _t2n(x):
     return x.detach().cpu().numpy()
 
+def _flatten_agents(x):
+    # (threads, agents, ...) view -> (threads * agents, ...) policy batch
+    return x.reshape(-1, *x.shape[2:])
+
 class Runner(object):
     def __init__(self, config):
 
@@ -38,6 +43,9 @@ class Runner(object):
                                          0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
                                          1, 1, 1, 1]}
         self.type_count = list(Counter(unit_types[self.all_args.map_name]).values())
+        # agents of a unit type are contiguous, so each type is a slice of the agent axis
+        type_offsets = np.cumsum([0] + self.type_count)
+        self.type_slices = [slice(start, end) for start, end in zip(type_offsets[:-1], type_offsets[1:])]
 
         # parameters
         self.env_name = self.all_args.env_name
@@ -54,6 +62,7 @@ class Runner(object):
         self.use_wandb = self.all_args.use_wandb
         self.use_render = self.all_args.use_render
         self.recurrent_N = self.all_args.recurrent_N
+        self.use_parallel_train = self.all_args.use_parallel_train
 
         # interval
         self.save_interval = self.all_args.save_interval
@@ -106,7 +115,8 @@ class Runner(object):
         for unit_type in range(self.unit_type_bits):
             # algorithm
             tr = TrainAlgo(self.all_args, self.policy[unit_type], device = self.device)
-            # buffer
+            # buffer, its share_obs has a row per agent of the unit type (states can be agent specific, e.g.
+            # with --use_state_agent), so unlike the separated runner the buffers can not share that array
             share_observation_space = self.envs.share_observation_space[0] if self.use_centralized_V else self.envs.observation_space[0]
             bu = SharedReplayBuffer(self.all_args,
                                     self.type_count[unit_type],
@@ -115,6 +125,10 @@ class Runner(object):
                                     self.envs.action_space[0])
             self.buffer.append(bu)
             self.trainer.append(tr)
+
+        if self.use_parallel_train:
+            self.train_pool = TrainPool(self.trainer, self.buffer, n_workers=self.all_args.n_train_workers,
+                                        n_threads=self.all_args.n_training_threads)
             
     def run(self):
         raise NotImplementedError
@@ -132,13 +146,17 @@ class Runner(object):
     def compute(self):
         for unit_type in range(self.unit_type_bits):
             self.trainer[unit_type].prep_rollout()
-            next_value = self.trainer[unit_type].policy.get_values(np.concatenate(self.buffer[unit_type].share_obs[-1]),
-                                                                   np.concatenate(self.buffer[unit_type].rnn_states_critic[-1]),
-                                                                   np.concatenate(self.buffer[unit_type].masks[-1]))
-            next_value = np.array(np.split(_t2n(next_value), self.n_rollout_threads))
+            buffer = self.buffer[unit_type]
+            next_value = self.trainer[unit_type].policy.get_values(_flatten_agents(buffer.share_obs[-1]),
+                                                                   _flatten_agents(buffer.rnn_states_critic[-1]),
+                                                                   _flatten_agents(buffer.masks[-1]))
+            next_value = _t2n(next_value).reshape(self.n_rollout_threads, -1, 1)
             self.buffer[unit_type].compute_returns(next_value, self.trainer[unit_type].value_normalizer)
 
     def train(self):
+        if self.use_parallel_train:
+            return self.train_parallel()
+
         train_infos = []
         for unit_type in range(self.unit_type_bits):
             self.trainer[unit_type].prep_training()
@@ -148,7 +166,19 @@ class Runner(object):
 
         return train_infos
 
+    def train_parallel(self):
+        # one seed per trainer for the minibatch shuffle, drawn from the global RNG so that runs stay deterministic
+        seeds = torch.randint(2 ** 62, (self.unit_type_bits,)).tolist()
+        train_infos = self.train_pool.train(seeds)
+        for unit_type in range(self.unit_type_bits):
+            self.buffer[unit_type].after_update()
+
+        return train_infos
+
     def save(self):
+        if self.all_args.use_distributed and dist.get_rank() != 0:
+            # the weights are the same in all learner processes
+            return
         for unit_type in range(self.unit_type_bits):
             policy_actor = self.trainer[unit_type].policy.actor
             torch.save(policy_actor.state_dict(), str(self.save_dir) + "/actor_agent" + str(unit_type) + ".pt")
@@ -77,6 +77,9 @@ class MPERunner(Runner):
             if episode % self.eval_interval == 0 and self.use_eval:
                 self.eval(total_num_steps)
 
+        if self.use_parallel_train:
+            self.train_pool.close()
+
     def warmup(self):
         # reset env
         obs = self.envs.reset()
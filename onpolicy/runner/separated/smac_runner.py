@@ -16,6 +16,10 @@ class SMACRunner(Runner):
 
     def __init__(self, config):
         super(SMACRunner, self).__init__(config)
+        self.use_batched_inference = getattr(self.all_args, "use_batched_inference", False)
+        if self.use_batched_inference:
+            from onpolicy.algorithms.r_mappo.algorithm.stacked_policy import StackedPolicy
+            self.stacked_policy = StackedPolicy(self.all_args, self.policy, device=self.device)
 
     def run(self):
         self.warmup()
@@ -50,6 +54,8 @@ class SMACRunner(Runner):
             # compute return and update network
             self.compute()
             train_infos = self.train()
+            if self.use_batched_inference:
+                self.stacked_policy.refresh()
 
             # post process
             total_num_steps = (episode + 1) * \
@@ -72,20 +78,10 @@ class SMACRunner(Runner):
                               int(total_num_steps / (end - start))))
 
                 if self.env_name == "StarCraft2":
-                    battles_won = []
-                    battles_game = []
-                    incre_battles_won = []
-                    incre_battles_game = []
-
-                    for i, info in enumerate(infos):
-                        if 'battles_won' in info[0].keys():
-                            battles_won.append(info[0]['battles_won'])
-                            incre_battles_won.append(
-                                info[0]['battles_won']-last_battles_won[i])
-                        if 'battles_game' in info[0].keys():
-                            battles_game.append(info[0]['battles_game'])
-                            incre_battles_game.append(
-                                info[0]['battles_game']-last_battles_game[i])
+                    battles_won = infos['battles_won']
+                    battles_game = infos['battles_game']
+                    incre_battles_won = battles_won - last_battles_won
+                    incre_battles_game = battles_game - last_battles_game
 
                     incre_win_rate = np.sum(
                         incre_battles_won)/np.sum(incre_battles_game) if np.sum(incre_battles_game) > 0 else 0.0
@@ -111,6 +107,9 @@ class SMACRunner(Runner):
             # eval
             if episode % self.eval_interval == 0 and self.use_eval:
                 self.eval(total_num_steps)
+
+        if self.use_parallel_train:
+            self.train_pool.close()
         # print("saving")
         # self.envs.envs[0].save_replay()
         # print("saved")
@@ -134,6 +133,9 @@ class SMACRunner(Runner):
 
     @ torch.no_grad()
     def collect(self, step):
+        if self.use_batched_inference:
+            return self.collect_batched(step)
+
         values = []
         actions = []
         action_log_probs = []
@@ -163,6 +165,25 @@ class SMACRunner(Runner):
 
         return values, actions, action_log_probs, rnn_states, rnn_states_critic
 
+    @ torch.no_grad()
+    def collect_batched(self, step):
+        # evaluate every agent's actor and critic in one batched call, [agents, self.envs, dim]
+        value, action, action_log_prob, rnn_state, rnn_state_critic \
+            = self.stacked_policy.get_actions(np.stack([buffer.share_obs[step] for buffer in self.buffer]),
+                                              np.stack([buffer.obs[step] for buffer in self.buffer]),
+                                              np.stack([buffer.rnn_states[step] for buffer in self.buffer]),
+                                              np.stack([buffer.rnn_states_critic[step] for buffer in self.buffer]),
+                                              np.stack([buffer.masks[step] for buffer in self.buffer]),
+                                              np.stack([buffer.available_actions[step] for buffer in self.buffer]))
+        # [self.envs, agents, dim]
+        values = _t2n(value).transpose(1, 0, 2)
+        actions = _t2n(action).transpose(1, 0, 2)
+        action_log_probs = _t2n(action_log_prob).transpose(1, 0, 2)
+        rnn_states = _t2n(rnn_state).transpose(1, 0, 2, 3)
+        rnn_states_critic = _t2n(rnn_state_critic).transpose(1, 0, 2, 3)
+
+        return values, actions, action_log_probs, rnn_states, rnn_states_critic
+
     def insert(self, data):
         obs, share_obs, rewards, dones, infos, available_actions, \
             values, actions, action_log_probs, rnn_states, rnn_states_critic = data
@@ -183,8 +204,8 @@ class SMACRunner(Runner):
         active_masks[dones_env == True] = np.ones(
             ((dones_env == True).sum(), self.num_agents, 1), dtype=np.float32)
 
-        bad_masks = np.array([[[0.0] if info[agent_id]['bad_transition'] else [
-                             1.0] for agent_id in range(self.num_agents)] for info in infos])
+        bad_masks = np.ones((self.n_rollout_threads, self.num_agents, 1), dtype=np.float32)
+        bad_masks[infos['bad_transition']] = 0.0
         for agent_id in range(self.num_agents):
             if not self.use_centralized_V:
                 share_obs = np.array(list(obs[:, agent_id]))
@@ -218,19 +239,28 @@ class SMACRunner(Runner):
                               self.num_agents, 1), dtype=np.float32)
 
         while True:
-            eval_actions = []
-            _eval_rnn_states = []
-            for agent_id in range(self.num_agents):
-                self.trainer[agent_id].prep_rollout()
-                eval_action, eval_rnn_state = self.trainer[agent_id].policy.act(eval_obs[:, agent_id],
-                                                                        eval_rnn_states[:, agent_id],
-                                                                        eval_masks[:, agent_id],
-                                                                        eval_available_actions[:, agent_id],
-                                                                    deterministic=True)
-                eval_actions.append(_t2n(eval_action))
-                _eval_rnn_states.append(_t2n(eval_rnn_state))
-            eval_actions = np.array(eval_actions).transpose(1,0,2)
-            eval_rnn_states = np.array(_eval_rnn_states).transpose(1,0,2,3)
+            if self.use_batched_inference:
+                eval_actions, eval_rnn_states = self.stacked_policy.act(eval_obs.transpose(1, 0, 2),
+                                                                        eval_rnn_states.transpose(1, 0, 2, 3),
+                                                                        eval_masks.transpose(1, 0, 2),
+                                                                        eval_available_actions.transpose(1, 0, 2),
+                                                                        deterministic=True)
+                eval_actions = _t2n(eval_actions).transpose(1, 0, 2)
+                eval_rnn_states = _t2n(eval_rnn_states).transpose(1, 0, 2, 3)
+            else:
+                eval_actions = []
+                _eval_rnn_states = []
+                for agent_id in range(self.num_agents):
+                    self.trainer[agent_id].prep_rollout()
+                    eval_action, eval_rnn_state = self.trainer[agent_id].policy.act(eval_obs[:, agent_id],
+                                                                            eval_rnn_states[:, agent_id],
+                                                                            eval_masks[:, agent_id],
+                                                                            eval_available_actions[:, agent_id],
+                                                                        deterministic=True)
+                    eval_actions.append(_t2n(eval_action))
+                    _eval_rnn_states.append(_t2n(eval_rnn_state))
+                eval_actions = np.array(eval_actions).transpose(1,0,2)
+                eval_rnn_states = np.array(_eval_rnn_states).transpose(1,0,2,3)
 
             
             # eval_actions = np.array(
@@ -259,7 +289,7 @@ class SMACRunner(Runner):
                     eval_episode_rewards.append(
                         np.sum(one_episode_rewards, axis=0))
                     one_episode_rewards = []
-                    if eval_infos[eval_i][0]['won']:
+                    if eval_infos['won'][eval_i]:
                         eval_battles_won += 1
 
             if eval_episode >= self.all_args.eval_episodes:
@@ -4,7 +4,7 @@ import numpy as np
 from functools import reduce
 from itertools import chain
 import torch
-from onpolicy.runner.separated.base_runner_multitype import Runner
+from onpolicy.runner.separated.base_runner_multitype import Runner, _flatten_agents
 
 
 def _t2n(x):
@@ -26,6 +26,7 @@ class SMACRunner(Runner):
 
         last_battles_game = np.zeros(self.n_rollout_threads, dtype=np.float32)
         last_battles_won = np.zeros(self.n_rollout_threads, dtype=np.float32)
+        last_battles_draw = np.zeros(self.n_rollout_threads, dtype=np.float32)
 
         for episode in range(episodes):
             for unit_type in range(self.unit_type_bits):
@@ -74,26 +75,12 @@ class SMACRunner(Runner):
                               int(total_num_steps / (end - start))))
 
                 if self.env_name == "StarCraft2":
-                    battles_won = []
-                    battles_draw = []
-                    battles_game = []
-                    incre_battles_won = []
-                    incre_battles_draw = []
-                    incre_battles_game = []
-
-                    for i, info in enumerate(infos):
-                        if 'battles_won' in info[0].keys():
-                            battles_won.append(info[0]['battles_won'])
-                            incre_battles_won.append(
-                                info[0]['battles_won']-last_battles_won[i])
-                        if 'battles_draw' in info[0].keys():
-                            battles_draw.append(info[0]['battles_draw'])
-                            incre_battles_draw.append(
-                                info[0]['battles_won']-last_battles_won[i])
-                        if 'battles_game' in info[0].keys():
-                            battles_game.append(info[0]['battles_game'])
-                            incre_battles_game.append(
-                                info[0]['battles_game']-last_battles_game[i])
+                    battles_won = infos['battles_won']
+                    battles_draw = infos['battles_draw']
+                    battles_game = infos['battles_game']
+                    incre_battles_won = battles_won - last_battles_won
+                    incre_battles_draw = battles_draw - last_battles_draw
+                    incre_battles_game = battles_game - last_battles_game
 
                     incre_win_rate = np.sum(
                         incre_battles_won)/np.sum(incre_battles_game) if np.sum(incre_battles_game) > 0 else 0.0
@@ -115,6 +102,7 @@ class SMACRunner(Runner):
 
                     last_battles_game = battles_game
                     last_battles_won = battles_won
+                    last_battles_draw = battles_draw
 
                 for unit_type in range(self.unit_type_bits):
                     train_infos[unit_type].update(
@@ -125,6 +113,9 @@ class SMACRunner(Runner):
             # eval
             if episode % self.eval_interval == 0 and self.use_eval:
                 self.eval(total_num_steps)
+
+        if self.use_parallel_train:
+            self.train_pool.close()
         # print("saving")
         # self.envs.envs[0].save_replay()
         # print("saved")
@@ -141,57 +132,32 @@ class SMACRunner(Runner):
             share_obs = obs
             
         
-        bit = 0
-        for count in self.type_count:
-            self.buffer[bit].share_obs[0] = share_obs[:, :count]
-            self.buffer[bit].obs[0] = obs[:, :count]
-            self.buffer[bit].available_actions[0] = available_actions[:, :count]
-            bit += 1
-
-            obs = obs[:, count:]
-            share_obs = share_obs[:, count:]
-            available_actions = available_actions[:, count:]
+        for unit_type, agents in enumerate(self.type_slices):
+            self.buffer[unit_type].share_obs[0] = share_obs[:, agents]
+            self.buffer[unit_type].obs[0] = obs[:, agents]
+            self.buffer[unit_type].available_actions[0] = available_actions[:, agents]
 
     @ torch.no_grad()
     def collect(self, step):
-        values = []
-        actions = []
-        action_log_probs = []
-        rnn_states = []
-        rnn_states_critics = []
-        
-        for unit_type in range(self.unit_type_bits):
+        # outputs of every unit type are scattered into [self.envs, agents, dim] arrays
+        outputs = [None] * 5
+
+        for unit_type, agents in enumerate(self.type_slices):
             self.trainer[unit_type].prep_rollout()
-            value, action, action_log_prob, rnn_state, rnn_states_critic \
-                = self.trainer[unit_type].policy.get_actions(np.concatenate(self.buffer[unit_type].share_obs[step]),
-                                                            np.concatenate(self.buffer[unit_type].obs[step]),
-                                                            np.concatenate(self.buffer[unit_type].rnn_states[step]),
-                                                            np.concatenate(self.buffer[unit_type].rnn_states_critic[step]),
-                                                            np.concatenate(self.buffer[unit_type].masks[step]),
-                                                            np.concatenate(self.buffer[unit_type].available_actions[step]))
-            value = np.array(np.split(_t2n(value), self.n_rollout_threads))
-            action = np.array(np.split(_t2n(action), self.n_rollout_threads))
-            action_log_prob = np.array(np.split(_t2n(action_log_prob), self.n_rollout_threads))
-            rnn_state = np.array(np.split(_t2n(rnn_state), self.n_rollout_threads))
-            rnn_states_critic = np.array(np.split(_t2n(rnn_states_critic), self.n_rollout_threads))
-            
-            values.append(value)
-            actions.append(action)
-            action_log_probs.append(action_log_prob)
-            rnn_states.append(rnn_state)
-            rnn_states_critics.append(rnn_states_critic)
-        # [self.envs, agents, dim]
-        values = np.concatenate(values,1)
-        actions = np.concatenate(actions,1)
-        action_log_probs = np.concatenate(action_log_probs,1)
-        rnn_states = np.concatenate(rnn_states,1)
-        rnn_states_critics = np.concatenate(rnn_states_critics,1)
-        
-        # values = np.array(np.split(values, self.n_rollout_threads))
-        # actions = np.array(np.split(actions, self.n_rollout_threads))
-        # action_log_probs = np.array(np.split(action_log_probs, self.n_rollout_threads))
-        # rnn_states = np.array(np.split(rnn_states, self.n_rollout_threads))
-        # rnn_states_critics = np.array(np.split(rnn_states_critics, self.n_rollout_threads))
+            buffer = self.buffer[unit_type]
+            type_outputs = self.trainer[unit_type].policy.get_actions(_flatten_agents(buffer.share_obs[step]),
+                                                                      _flatten_agents(buffer.obs[step]),
+                                                                      _flatten_agents(buffer.rnn_states[step]),
+                                                                      _flatten_agents(buffer.rnn_states_critic[step]),
+                                                                      _flatten_agents(buffer.masks[step]),
+                                                                      _flatten_agents(buffer.available_actions[step]))
+            for i, output in enumerate(type_outputs):
+                output = _t2n(output)
+                if outputs[i] is None:
+                    outputs[i] = np.empty((self.n_rollout_threads, self.num_agents, *output.shape[1:]), dtype=output.dtype)
+                outputs[i][:, agents] = output.reshape(self.n_rollout_threads, -1, *output.shape[1:])
+
+        values, actions, action_log_probs, rnn_states, rnn_states_critics = outputs
 
         return values, actions, action_log_probs, rnn_states, rnn_states_critics
 
@@ -217,8 +183,8 @@ class SMACRunner(Runner):
         active_masks[dones_env == True] = np.ones(
             ((dones_env == True).sum(), self.num_agents, 1), dtype=np.float32)
 
-        bad_masks = np.array([[[0.0] if info[agent_id]['bad_transition'] else [
-                             1.0] for agent_id in range(self.num_agents)] for info in infos])
+        bad_masks = np.ones((self.n_rollout_threads, self.num_agents, 1), dtype=np.float32)
+        bad_masks[infos['bad_transition']] = 0.0
 
         # _obs = obs.copy()
         # _share_obs = share_obs.copy()
@@ -236,35 +202,19 @@ class SMACRunner(Runner):
         if not self.use_centralized_V:
             share_obs = obs
             
-        bit = 0
-        for count in self.type_count:
-            self.buffer[bit].insert(share_obs[:, :count], 
-                                    obs[:, :count], 
-                                    rnn_states[:, :count], 
-                                    rnn_states_critic[:, :count],
-                                    actions[:, :count], 
-                                    action_log_probs[:, :count],
-                                    values[:, :count],
-                                    rewards[:, :count],
-                                    masks[:, :count],
-                                    bad_masks[:, :count],
-                                    active_masks[:, :count],
-                                    available_actions[:, :count])
-
-            share_obs = share_obs[:, count:]
-            obs = obs[:, count:]
-            rnn_states = rnn_states[:, count:]
-            rnn_states_critic = rnn_states_critic[:, count:]
-            actions = actions[:, count:]
-            action_log_probs = action_log_probs[:, count:]
-            values = values[:, count:]
-            rewards = rewards[:, count:]
-            masks = masks[:, count:]
-            bad_masks = bad_masks[:, count:]
-            active_masks = active_masks[:, count:]
-            available_actions = available_actions[:, count:]
-
-            bit += 1
+        for unit_type, agents in enumerate(self.type_slices):
+            self.buffer[unit_type].insert(share_obs[:, agents],
+                                          obs[:, agents],
+                                          rnn_states[:, agents],
+                                          rnn_states_critic[:, agents],
+                                          actions[:, agents],
+                                          action_log_probs[:, agents],
+                                          values[:, agents],
+                                          rewards[:, agents],
+                                          masks[:, agents],
+                                          bad_masks[:, agents],
+                                          active_masks[:, agents],
+                                          available_actions[:, agents])
 
     # def log_train(self, train_infos, total_num_steps):
     #     train_infos["average_step_rewards"] = np.mean(self.buffer.rewards)
@@ -290,25 +240,21 @@ class SMACRunner(Runner):
                               self.num_agents, 1), dtype=np.float32)
 
         while True:
-            eval_actions = []
-            _eval_rnn_states = []
-            for unit_type in range(self.unit_type_bits):
+            eval_actions = None
+            _eval_rnn_states = np.empty_like(eval_rnn_states)
+            for unit_type, agents in enumerate(self.type_slices):
                 self.trainer[unit_type].prep_rollout()
-                eval_action, eval_rnn_state = self.trainer[unit_type].policy.act(eval_obs[:, :self.type_count[unit_type]],
-                                                                                  eval_rnn_states[:, :self.type_count[unit_type]],
-                                                                                  eval_masks[:, :self.type_count[unit_type]],
-                                                                                  eval_available_actions[:, :self.type_count[unit_type]],
+                eval_action, eval_rnn_state = self.trainer[unit_type].policy.act(_flatten_agents(eval_obs[:, agents]),
+                                                                                  _flatten_agents(eval_rnn_states[:, agents]),
+                                                                                  _flatten_agents(eval_masks[:, agents]),
+                                                                                  _flatten_agents(eval_available_actions[:, agents]),
                                                                                   deterministic=True)
-                eval_actions.append(_t2n(eval_action))
-                _eval_rnn_states.append(_t2n(eval_rnn_state))
-                
-                eval_obs = eval_obs[:, self.type_count[unit_type]:]
-                eval_rnn_states = eval_rnn_states[:, self.type_count[unit_type]:]
-                eval_masks = eval_masks[:, self.type_count[unit_type]:]
-                eval_available_actions = eval_available_actions[:, self.type_count[unit_type]:]
-
-            eval_actions = np.concatenate(eval_actions,axis=1)
-            eval_rnn_states = np.concatenate(_eval_rnn_states,axis=1)
+                eval_action = _t2n(eval_action)
+                if eval_actions is None:
+                    eval_actions = np.empty((self.n_eval_rollout_threads, self.num_agents, *eval_action.shape[1:]), dtype=eval_action.dtype)
+                eval_actions[:, agents] = eval_action.reshape(self.n_eval_rollout_threads, -1, *eval_action.shape[1:])
+                _eval_rnn_states[:, agents] = _t2n(eval_rnn_state).reshape(self.n_eval_rollout_threads, -1, *eval_rnn_state.shape[1:])
+            eval_rnn_states = _eval_rnn_states
             
             
             # eval_actions = np.array(
@@ -337,7 +283,7 @@ class SMACRunner(Runner):
                     eval_episode_rewards.append(
                         np.sum(one_episode_rewards, axis=0))
                     one_episode_rewards = []
-                    if eval_infos[eval_i][0]['won']:
+                    if eval_infos['won'][eval_i]:
                         eval_battles_won += 1
 
             if eval_episode >= self.all_args.eval_episodes:
@@ -2,13 +2,22 @@ import wandb
 import os
 import numpy as np
 import torch
+import torch.distributed as dist
 from tensorboardX import SummaryWriter
-from onpolicy.utils.shared_buffer import SharedReplayBuffer
+from onpolicy.utils.shared_buffer import SharedReplayBuffer, TorchSharedReplayBuffer
 
 def _t2n(x):
     """Convert torch tensor to a numpy array."""
     return x.detach().cpu().numpy()
 
+def _flatten_envs(x):
+    """Merge the env and agent dimensions of a numpy array or torch tensor."""
+    return x.reshape(-1, *x.shape[2:])
+
+def _split_envs(x, n_envs):
+    """Split the first dimension of a numpy array or torch tensor into (env, agent)."""
+    return x.reshape(n_envs, -1, *x.shape[1:])
+
 class Runner(object):
     """
     Base class for training recurrent policies.
@@ -40,6 +49,7 @@ class Runner(object):
         self.use_wandb = self.all_args.use_wandb
         self.use_render = self.all_args.use_render
         self.recurrent_N = self.all_args.recurrent_N
+        self.use_device_buffer = self.all_args.use_device_buffer
 
         # interval
         self.save_interval = self.all_args.save_interval
@@ -80,13 +90,26 @@ class Runner(object):
 
         # algorithm
         self.trainer = TrainAlgo(self.all_args, self.policy, device = self.device)
+        # policy that collects rollouts, runners may replace it with a snapshot of the trained one
+        self.rollout_trainer = self.trainer
         
         # buffer
-        self.buffer = SharedReplayBuffer(self.all_args,
-                                        self.num_agents,
-                                        self.envs.observation_space[0],
-                                        share_observation_space,
-                                        self.envs.action_space[0])
+        assert self.use_device_buffer or not self.all_args.use_compact_buffer or self.all_args.compact_obs_dtype == "float16", (
+            "bfloat16 observations need the device buffer!")
+        if self.use_device_buffer:
+            self.buffer = TorchSharedReplayBuffer(self.all_args,
+                                                  self.num_agents,
+                                                  self.envs.observation_space[0],
+                                                  share_observation_space,
+                                                  self.envs.action_space[0],
+                                                  device = self.device)
+        else:
+            self.buffer = SharedReplayBuffer(self.all_args,
+                                            self.num_agents,
+                                            self.envs.observation_space[0],
+                                            share_observation_space,
+                                            self.envs.action_space[0])
+        print("replay buffer uses {:.1f} MB.".format(self.buffer.nbytes() / 2 ** 20))
 
     def run(self):
         """Collect training data, perform training updates, and evaluate policy."""
@@ -110,12 +133,14 @@ class Runner(object):
     @torch.no_grad()
     def compute(self):
         """Calculate returns for the collected data."""
-        self.trainer.prep_rollout()
-        next_values = self.trainer.policy.get_values(np.concatenate(self.buffer.share_obs[-1]),
-                                                np.concatenate(self.buffer.rnn_states_critic[-1]),
-                                                np.concatenate(self.buffer.masks[-1]))
-        next_values = np.array(np.split(_t2n(next_values), self.n_rollout_threads))
-        self.buffer.compute_returns(next_values, self.trainer.value_normalizer)
+        self.rollout_trainer.prep_rollout()
+        next_values = self.rollout_trainer.policy.get_values(_flatten_envs(self.buffer.share_obs[-1]),
+                                                             _flatten_envs(self.buffer.rnn_states_critic[-1]),
+                                                             _flatten_envs(self.buffer.masks[-1]))
+        if not self.use_device_buffer:
+            next_values = _t2n(next_values)
+        next_values = _split_envs(next_values, self.n_rollout_threads)
+        self.buffer.compute_returns(next_values, self.rollout_trainer.value_normalizer)
     
     def train(self):
         """Train policies with data in buffer. """
@@ -126,6 +151,9 @@ class Runner(object):
 
     def save(self):
         """Save policy's actor and critic networks."""
+        if self.all_args.use_distributed and dist.get_rank() != 0:
+            # the weights are the same in all learner processes
+            return
         policy_actor = self.trainer.policy.actor
         torch.save(policy_actor.state_dict(), str(self.save_dir) + "/actor.pt")
         policy_critic = self.trainer.policy.critic
@@ -1,9 +1,12 @@
+import copy
 import time
 import wandb
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 import torch
-from onpolicy.runner.shared.base_runner import Runner
+from onpolicy.runner.shared.base_runner import Runner, _flatten_envs, _split_envs
+from onpolicy.utils.inference_server import InferenceServer
 
 
 def _t2n(x):
@@ -15,9 +18,39 @@ class SMACRunner(Runner):
 
     def __init__(self, config):
         super(SMACRunner, self).__init__(config)
+        self.use_async_env = getattr(self.all_args, "use_async_env", False)
+        self.use_pingpong = getattr(self.all_args, "use_pingpong", False)
+        # rollouts come from actor processes on other hosts, self.envs is a RemoteActorEnvs
+        self.use_remote_actors = getattr(self.all_args, "n_remote_actors", 0) > 0
+        if self.use_remote_actors:
+            self.envs.send_weights(self.policy)
+        self.use_pipeline = getattr(self.all_args, "use_pipeline", False)
+        if self.use_pipeline:
+            # rollouts are collected into a second buffer by a policy snapshot while the learner trains
+            self.pipeline_max_lag = self.all_args.pipeline_max_lag
+            self.policy_lag = 0
+            self.buffers = [self.buffer, copy.deepcopy(self.buffer)]
+            self.rollout_trainer = copy.deepcopy(self.trainer)
+            # snapshot that collected self.buffer, its value normalizer goes with the buffer to the learner
+            self.collector = self.rollout_trainer
+            self.learner = ThreadPoolExecutor(max_workers=1)
+        # buffer the last update was trained on
+        self.train_buffer = self.buffer
+        self.use_inference_server = getattr(self.all_args, "use_inference_server", False)
+        if self.use_inference_server:
+            # env workers collect rollouts on their own with actions from a separate inference process
+            share_observation_space = self.envs.share_observation_space[0] if self.use_centralized_V else self.envs.observation_space[0]
+            self.inference_server = InferenceServer(self.all_args, self.policy, self.n_rollout_threads, self.num_agents,
+                                                    self.envs.observation_space[0], share_observation_space,
+                                                    self.envs.action_space[0],
+                                                    max_batch=self.all_args.inference_max_batch,
+                                                    batch_timeout=self.all_args.inference_batch_timeout)
+            self.envs.connect(self.inference_server.clients, self.use_centralized_V,
+                              (self.recurrent_N, self.hidden_size))
 
     def run(self):
-        self.warmup()
+        if not self.use_remote_actors:
+            self.warmup()
 
         start = time.time()
         episodes = int(
@@ -30,25 +63,23 @@ class SMACRunner(Runner):
             if self.use_linear_lr_decay:
                 self.trainer.policy.lr_decay(episode, episodes)
 
-            for step in range(self.episode_length):
-                # Sample actions
-                values, actions, action_log_probs, rnn_states, rnn_states_critic = self.collect(
-                    step)
-
-                # Obser reward and next obs
-                obs, share_obs, rewards, dones, infos, available_actions = self.envs.step(
-                    actions)
-
-                data = obs, share_obs, rewards, dones, infos, available_actions, \
-                    values, actions, action_log_probs, \
-                    rnn_states, rnn_states_critic
-
-                # insert data into buffer
-                self.insert(data)
-
-            # compute return and update network
-            self.compute()
-            train_infos = self.train()
+            # pipelined rollouts after the first one are collected and computed while training
+            if not self.use_pipeline or episode == 0:
+                infos = self.run_rollout()
+                self.compute()
+
+            # update network
+            if self.use_pipeline:
+                # the last rollout is trained on without collecting another one
+                train_infos, next_infos = self.train_pipelined(collect_next=episode < episodes - 1)
+                if next_infos is not None:
+                    infos = next_infos
+            else:
+                train_infos = self.train()
+            if self.use_inference_server:
+                self.inference_server.sync(self.policy)
+            if self.use_remote_actors and episode < episodes - 1:
+                self.envs.send_weights(self.policy)
 
             # post process
             total_num_steps = (episode + 1) * \
@@ -71,20 +102,10 @@ class SMACRunner(Runner):
                               int(total_num_steps / (end - start))))
 
                 if self.env_name == "StarCraft2":
-                    battles_won = []
-                    battles_game = []
-                    incre_battles_won = []
-                    incre_battles_game = []
-
-                    for i, info in enumerate(infos):
-                        if 'battles_won' in info[0].keys():
-                            battles_won.append(info[0]['battles_won'])
-                            incre_battles_won.append(
-                                info[0]['battles_won']-last_battles_won[i])
-                        if 'battles_game' in info[0].keys():
-                            battles_game.append(info[0]['battles_game'])
-                            incre_battles_game.append(
-                                info[0]['battles_game']-last_battles_game[i])
+                    battles_won = infos['battles_won']
+                    battles_game = infos['battles_game']
+                    incre_battles_won = battles_won - last_battles_won
+                    incre_battles_game = battles_game - last_battles_game
 
                     incre_win_rate = np.sum(
                         incre_battles_won)/np.sum(incre_battles_game) if np.sum(incre_battles_game) > 0 else 0.0
@@ -99,18 +120,149 @@ class SMACRunner(Runner):
                     last_battles_game = battles_game
                     last_battles_won = battles_won
 
-                train_infos['dead_ratio'] = 1 - self.buffer.active_masks.sum() / reduce(
-                    lambda x, y: x*y, list(self.buffer.active_masks.shape))
+                train_infos['dead_ratio'] = 1 - self.train_buffer.active_masks.sum().item() / reduce(
+                    lambda x, y: x*y, list(self.train_buffer.active_masks.shape))
 
                 self.log_train(train_infos, total_num_steps)
 
             # eval
             if episode % self.eval_interval == 0 and self.use_eval:
                 self.eval(total_num_steps)
+
+        if self.use_inference_server:
+            self.inference_server.close()
         # print("saving")
         # self.envs.envs[0].save_replay()
         # print("saved")
 
+    def run_rollout(self):
+        """
+        Fill the buffer with one episode_length of steps, collected the way the arguments select.
+        :return infos: (np.ndarray) infos of the last step of every env.
+        """
+        if self.use_remote_actors:
+            return self.envs.recv_rollouts(self.buffer)
+        elif self.use_inference_server:
+            return self.rollout_served()
+        elif self.use_async_env:
+            return self.rollout_async()
+        elif self.use_pingpong:
+            return self.rollout_pingpong()
+        return self.rollout()
+
+    def run_actor(self, learner):
+        """
+        Collect rollouts for a central learner until it stops training. Every rollout segment is sent to the
+        learner, which answers with the weights to collect the next one with.
+        :param learner: (LearnerConnection) connection to the learner.
+        """
+        if not learner.recv_weights(self.policy):
+            return
+        self.warmup()
+        while True:
+            infos = self.run_rollout()
+            learner.send_rollout(self.buffer, infos)
+            if not learner.recv_weights(self.policy):
+                break
+            self.buffer.after_update()
+
+    def rollout(self):
+        """
+        Fill the buffer with one episode_length of steps of all envs.
+        :return infos: (dict) infos of the last step.
+        """
+        for step in range(self.episode_length):
+            # Sample actions
+            values, actions, action_log_probs, rnn_states, rnn_states_critic = self.collect(
+                step)
+
+            # Obser reward and next obs
+            obs, share_obs, rewards, dones, infos, available_actions = self.envs.step(
+                actions)
+
+            data = obs, share_obs, rewards, dones, infos, available_actions, \
+                values, actions, action_log_probs, \
+                rnn_states, rnn_states_critic
+
+            # insert data into buffer
+            self.insert(data)
+
+        return infos
+
+    def rollout_pingpong(self):
+        """
+        Fill the buffer with one episode_length of steps of all envs, split into two halves that take turns:
+        actions of one half are computed while the other half is stepping in SC2. Both halves advance their own
+        step cursors in the buffer, so it ends up with the same layout as after rollout().
+        :return infos: (np.ndarray) infos of the last step of every env.
+        """
+        halves = np.array_split(np.arange(self.n_rollout_threads), 2)
+        infos = [None] * self.n_rollout_threads
+        pending = [None, None]
+
+        def act(half):
+            pending[half] = self.collect_envs(halves[half])
+            self.envs.step_async_envs(pending[half][1], halves[half])
+
+        def observe(half):
+            obs, share_obs, rewards, dones, step_infos, available_actions = self.envs.step_wait_envs(halves[half])
+            for env_id, info in zip(halves[half], step_infos):
+                infos[env_id] = info
+            data = obs, share_obs, rewards, dones, step_infos, available_actions, *pending[half]
+            self.insert(data, halves[half])
+
+        act(0)
+        for step in range(self.episode_length):
+            # half 1 is acted on while half 0 steps and the other way round
+            act(1)
+            observe(0)
+            if step < self.episode_length - 1:
+                act(0)
+            observe(1)
+
+        return np.stack(infos)
+
+    def train_pipelined(self, collect_next=True):
+        """
+        Train on the buffer that was just filled in a background thread, while the next rollout is collected
+        into the other buffer by the rollout policy snapshot. The snapshot is refreshed from the learner once it
+        lags pipeline_max_lag updates behind. Values, returns and action log probs of a rollout all come from the
+        snapshot that collected it, so PPO importance ratios are taken against the policy that actually acted, and
+        advantages are taken with the snapshot's value normalizer.
+        :param collect_next: (bool) whether to collect the next rollout, otherwise only train.
+        :return train_infos: (dict) information about the training update.
+        :return infos: (dict) env infos at the end of the next rollout, None if collect_next is False.
+        """
+        train_buffer = self.train_buffer = self.buffer
+        self.buffer = self.buffers[1] if train_buffer is self.buffers[0] else self.buffers[0]
+        train_buffer.after_update(self.buffer)
+
+        # the learner shuffles minibatches with its own generator, as the rollout keeps sampling from the global RNG
+        generator = torch.Generator().manual_seed(int(torch.randint(2 ** 62, (1,))))
+        # advantages are taken with the normalizer of the snapshot that predicted the values and returns, the
+        # learner's own has moved on with the updates since
+        value_normalizer = self.collector.value_normalizer
+
+        def train():
+            self.trainer.prep_training()
+            return self.trainer.train(train_buffer, generator=generator, value_normalizer=value_normalizer)
+
+        if not collect_next:
+            return train(), None
+
+        learner = self.learner.submit(train)
+        self.collector = self.rollout_trainer
+        infos = self.run_rollout()
+        self.compute()
+        train_infos = learner.result()
+
+        self.policy_lag += 1
+        if self.policy_lag >= self.pipeline_max_lag:
+            self.rollout_trainer = copy.deepcopy(self.trainer)
+            self.policy_lag = 0
+
+        return train_infos, infos
+
     def warmup(self):
         # reset env
         obs, share_obs, available_actions = self.envs.reset()
@@ -119,63 +271,154 @@ class SMACRunner(Runner):
         if not self.use_centralized_V:
             share_obs = obs
 
-        self.buffer.share_obs[0] = share_obs.copy()
-        self.buffer.obs[0] = obs.copy()
-        self.buffer.available_actions[0] = available_actions.copy()
+        if self.use_device_buffer:
+            share_obs, obs, available_actions = map(self.buffer.check, (share_obs, obs, available_actions))
+
+        self.buffer.share_obs[0] = share_obs
+        self.buffer.obs[0] = obs
+        self.buffer.available_actions[0] = available_actions
 
     @ torch.no_grad()
     def collect(self, step):
-        self.trainer.prep_rollout()
+        self.rollout_trainer.prep_rollout()
         value, action, action_log_prob, rnn_state, rnn_state_critic\
-            = self.trainer.policy.get_actions(np.concatenate(self.buffer.share_obs[step]),
-                                              np.concatenate(self.buffer.obs[step]),
-                                              np.concatenate(self.buffer.rnn_states[step]),
-                                              np.concatenate(self.buffer.rnn_states_critic[step]),
-                                              np.concatenate(self.buffer.masks[step]),
-                                              np.concatenate(self.buffer.available_actions[step]))
+            = self.rollout_trainer.policy.get_actions(_flatten_envs(self.buffer.share_obs[step]),
+                                                      _flatten_envs(self.buffer.obs[step]),
+                                                      _flatten_envs(self.buffer.rnn_states[step]),
+                                                      _flatten_envs(self.buffer.rnn_states_critic[step]),
+                                                      _flatten_envs(self.buffer.masks[step]),
+                                                      _flatten_envs(self.buffer.available_actions[step]))
+        # everything but the actions stays on device when it goes into a device buffer
+        to_buffer = (lambda x: x) if self.use_device_buffer else _t2n
         # [self.envs, agents, dim]
-        values              = np.array(np.split(_t2n(value), self.n_rollout_threads))
-        actions             = np.array(np.split(_t2n(action), self.n_rollout_threads))
-        action_log_probs    = np.array(np.split(_t2n(action_log_prob), self.n_rollout_threads))
-        rnn_states          = np.array(np.split(_t2n(rnn_state), self.n_rollout_threads))
-        rnn_states_critic   = np.array(np.split(_t2n(rnn_state_critic), self.n_rollout_threads))
+        values              = _split_envs(to_buffer(value), self.n_rollout_threads)
+        actions             = _split_envs(_t2n(action), self.n_rollout_threads)
+        action_log_probs    = _split_envs(to_buffer(action_log_prob), self.n_rollout_threads)
+        rnn_states          = _split_envs(to_buffer(rnn_state), self.n_rollout_threads)
+        rnn_states_critic   = _split_envs(to_buffer(rnn_state_critic), self.n_rollout_threads)
+
+        return values, actions, action_log_probs, rnn_states, rnn_states_critic
+
+    @ torch.no_grad()
+    def collect_envs(self, env_ids):
+        """Like collect, but for the envs in env_ids, each at its own step cursor in the buffer."""
+        self.rollout_trainer.prep_rollout()
+        steps = self.buffer.env_steps[env_ids]
+        value, action, action_log_prob, rnn_state, rnn_state_critic\
+            = self.rollout_trainer.policy.get_actions(_flatten_envs(self.buffer.share_obs[steps, env_ids]),
+                                                      _flatten_envs(self.buffer.obs[steps, env_ids]),
+                                                      _flatten_envs(self.buffer.rnn_states[steps, env_ids]),
+                                                      _flatten_envs(self.buffer.rnn_states_critic[steps, env_ids]),
+                                                      _flatten_envs(self.buffer.masks[steps, env_ids]),
+                                                      _flatten_envs(self.buffer.available_actions[steps, env_ids]))
+        # [len(env_ids), agents, dim]
+        values              = _split_envs(_t2n(value), len(env_ids))
+        actions             = _split_envs(_t2n(action), len(env_ids))
+        action_log_probs    = _split_envs(_t2n(action_log_prob), len(env_ids))
+        rnn_states          = _split_envs(_t2n(rnn_state), len(env_ids))
+        rnn_states_critic   = _split_envs(_t2n(rnn_state_critic), len(env_ids))
 
         return values, actions, action_log_probs, rnn_states, rnn_states_critic
 
-    def insert(self, data):
+    def rollout_async(self):
+        """
+        Fill the buffer with one episode_length of steps per env, stepping the envs asynchronously.
+        Actions are computed for whichever envs come back first, and every env advances its own
+        step cursor in the buffer until it reaches episode_length.
+        :return infos: (np.ndarray) latest info of every env.
+        """
+        n = self.n_rollout_threads
+        pending = [np.zeros((n, *self.buffer.value_preds.shape[2:]), dtype=np.float32),
+                   np.zeros((n, *self.buffer.actions.shape[2:]), dtype=np.float32),
+                   np.zeros((n, *self.buffer.action_log_probs.shape[2:]), dtype=np.float32),
+                   np.zeros((n, *self.buffer.rnn_states.shape[2:]), dtype=np.float32),
+                   np.zeros((n, *self.buffer.rnn_states_critic.shape[2:]), dtype=np.float32)]
+        infos = [None] * n
+
+        env_ids = np.arange(n)
+        while True:
+            env_ids = env_ids[self.buffer.env_steps[env_ids] < self.episode_length]
+            if len(env_ids) > 0:
+                # Sample actions
+                for buf, new in zip(pending, self.collect_envs(env_ids)):
+                    buf[env_ids] = new
+                self.envs.step_send(pending[1][env_ids], env_ids)
+            if not self.envs.in_flight:
+                break
+
+            # Obser reward and next obs of the first envs to finish
+            env_ids, obs, share_obs, rewards, dones, step_infos, available_actions = self.envs.step_recv()
+            for env_id, info in zip(env_ids, step_infos):
+                infos[env_id] = info
+
+            data = obs, share_obs, rewards, dones, step_infos, available_actions, \
+                *[buf[env_ids] for buf in pending]
+
+            # insert data into buffer
+            self.insert(data, env_ids)
+
+        return np.stack(infos)
+
+    def rollout_served(self):
+        """
+        Fill the buffer with one episode_length of steps per env. The env workers act with the policy served by
+        the inference server and step their envs without waiting for each other, every step is inserted at its
+        env's own step cursor as soon as it arrives.
+        :return infos: (np.ndarray) latest info of every env.
+        """
+        infos = [None] * self.n_rollout_threads
+        self.envs.rollout_send(self.episode_length)
+        while self.envs.steps_left.any():
+            env_ids, obs, share_obs, rewards, dones, step_infos, available_actions, \
+                values, actions, action_log_probs, rnn_states, rnn_states_critic = self.envs.rollout_recv()
+            for env_id, info in zip(env_ids, step_infos):
+                infos[env_id] = info
+
+            data = obs, share_obs, rewards, dones, step_infos, available_actions, \
+                values, actions, action_log_probs, rnn_states, rnn_states_critic
+
+            # insert data into buffer
+            self.insert(data, env_ids)
+
+        return np.stack(infos)
+
+    def insert(self, data, env_ids=None):
         obs, share_obs, rewards, dones, infos, available_actions, \
             values, actions, action_log_probs, rnn_states, rnn_states_critic = data
 
+        n_envs = dones.shape[0]
         dones_env = np.all(dones, axis=1)
 
-        rnn_states[dones_env == True] = np.zeros(((dones_env == True).sum(
-        ), self.num_agents, self.recurrent_N, self.hidden_size), dtype=np.float32)
-        rnn_states_critic[dones_env == True] = np.zeros(((dones_env == True).sum(
-        ), self.num_agents, *self.buffer.rnn_states_critic.shape[3:]), dtype=np.float32)
+        rnn_states[dones_env == True] = 0
+        rnn_states_critic[dones_env == True] = 0
 
         masks = np.ones(
-            (self.n_rollout_threads, self.num_agents, 1), dtype=np.float32)
+            (n_envs, self.num_agents, 1), dtype=np.float32)
         masks[dones_env == True] = np.zeros(
             ((dones_env == True).sum(), self.num_agents, 1), dtype=np.float32)
 
         active_masks = np.ones(
-            (self.n_rollout_threads, self.num_agents, 1), dtype=np.float32)
+            (n_envs, self.num_agents, 1), dtype=np.float32)
         active_masks[dones == True] = np.zeros(
             ((dones == True).sum(), 1), dtype=np.float32)
         active_masks[dones_env == True] = np.ones(
             ((dones_env == True).sum(), self.num_agents, 1), dtype=np.float32)
 
-        bad_masks = np.array([[[0.0] if info[agent_id]['bad_transition'] else [
-                             1.0] for agent_id in range(self.num_agents)] for info in infos])
+        bad_masks = np.ones((n_envs, self.num_agents, 1), dtype=np.float32)
+        bad_masks[infos['bad_transition']] = 0.0
 
         if not self.use_centralized_V:
             share_obs = obs
 
-        self.buffer.insert(share_obs, obs, rnn_states, rnn_states_critic,
-                           actions, action_log_probs, values, rewards, masks, bad_masks, active_masks, available_actions)
+        if env_ids is None:
+            self.buffer.insert(share_obs, obs, rnn_states, rnn_states_critic,
+                               actions, action_log_probs, values, rewards, masks, bad_masks, active_masks, available_actions)
+        else:
+            self.buffer.insert_envs(env_ids, share_obs, obs, rnn_states, rnn_states_critic,
+                                    actions, action_log_probs, values, rewards, masks, bad_masks, active_masks, available_actions)
 
     def log_train(self, train_infos, total_num_steps):
-        train_infos["average_step_rewards"] = np.mean(self.buffer.rewards)
+        train_infos["average_step_rewards"] = self.train_buffer.rewards.mean().item()
         for k, v in train_infos.items():
             if self.use_wandb:
                 wandb.log({k: v}, step=total_num_steps)
@@ -233,7 +476,7 @@ class SMACRunner(Runner):
                     eval_episode_rewards.append(
                         np.sum(one_episode_rewards, axis=0))
                     one_episode_rewards = []
-                    if eval_infos[eval_i][0]['won']:
+                    if eval_infos['won'][eval_i]:
                         eval_battles_won += 1
 
             if eval_episode >= self.all_args.eval_episodes:
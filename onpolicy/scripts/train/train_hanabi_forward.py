@@ -81,6 +81,9 @@ def main(args):
     else:
         raise NotImplementedError
 
+    assert not all_args.use_masked_scan or all_args.use_recurrent_policy, (
+        "the masked scan is only meant for the chunked recurrent policy, it is slower on naive recurrent sequences!")
+
     # cuda
     if all_args.cuda and torch.cuda.is_available():
         print("choose to use gpu...")
@@ -72,6 +72,8 @@ def main(args):
     else:
         raise NotImplementedError
 
+    assert not all_args.use_masked_scan or all_args.use_recurrent_policy, (
+        "the masked scan is only meant for the chunked recurrent policy, it is slower on naive recurrent sequences!")
     assert (all_args.share_policy == True and all_args.scenario_name == 'simple_speaker_listener') == False, (
         "The simple_speaker_listener scenario can not use shared policy. Please check the config.py.")
 
@@ -7,10 +7,12 @@ import setproctitle
 import numpy as np
 from pathlib import Path
 import torch
+import torch.distributed as dist
 from onpolicy.config import get_config
 from onpolicy.envs.starcraft2.StarCraft2_Env import StarCraft2Env
 from onpolicy.envs.starcraft2.smac_maps import get_map_params
-from onpolicy.envs.env_wrappers import ShareSubprocVecEnv, ShareDummyVecEnv
+from onpolicy.utils.remote_rollout import RemoteActorEnvs, LearnerConnection, parse_address
+from onpolicy.envs.env_wrappers import ShareSubprocVecEnv, ShmShareSubprocVecEnv, ShareAsyncSubprocVecEnv, MultiShareSubprocVecEnv, ShareServedSubprocVecEnv, ShareDummyVecEnv
 
 """Train script for SMAC."""
 
@@ -20,7 +22,9 @@ def make_train_env(all_args):
         def init_env():
             if all_args.env_name == "StarCraft2":
                 env = StarCraft2Env(all_args,
-                replay_dir = '/home/huy/code/sc2-multiagent-mappo/replays')
+                replay_dir = '/home/huy/code/sc2-multiagent-mappo/replays',
+                map_cache_dir = all_args.map_cache_dir,
+                warm_standby = all_args.use_warm_standby)
             else:
                 print("Can not support the " +
                       all_args.env_name + "environment.")
@@ -30,8 +34,21 @@ def make_train_env(all_args):
 
         return init_env
 
-    if all_args.n_rollout_threads == 1:
+    if all_args.n_remote_actors > 0:
+        return RemoteActorEnvs(parse_address(all_args.learner_address), all_args.n_remote_actors,
+                               all_args.learner_authkey.encode())
+    elif all_args.use_inference_server:
+        return ShareServedSubprocVecEnv([get_env_fn(i) for i in range(all_args.n_rollout_threads)])
+    elif all_args.use_async_env:
+        min_ready = all_args.async_env_k or max(1, all_args.n_rollout_threads // 2)
+        return ShareAsyncSubprocVecEnv([get_env_fn(i) for i in range(all_args.n_rollout_threads)], min_ready=min_ready)
+    elif all_args.n_rollout_threads == 1:
         return ShareDummyVecEnv([get_env_fn(0)])
+    elif all_args.envs_per_worker > 1:
+        return MultiShareSubprocVecEnv([get_env_fn(i) for i in range(all_args.n_rollout_threads)],
+                                       envs_per_worker=all_args.envs_per_worker)
+    elif all_args.use_shm_env:
+        return ShmShareSubprocVecEnv([get_env_fn(i) for i in range(all_args.n_rollout_threads)])
     else:
         return ShareSubprocVecEnv([get_env_fn(i) for i in range(all_args.n_rollout_threads)])
 
@@ -41,7 +58,8 @@ def make_eval_env(all_args):
         def init_env():
             if all_args.env_name == "StarCraft2":
                 env = StarCraft2Env(all_args,
-                replay_dir = '/home/huy/code/sc2-multiagent-mappo/replays')
+                replay_dir = '/home/huy/code/sc2-multiagent-mappo/replays',
+                map_cache_dir = all_args.map_cache_dir)
             else:
                 print("Can not support the " +
                       all_args.env_name + "environment.")
@@ -53,6 +71,11 @@ def make_eval_env(all_args):
 
     if all_args.n_eval_rollout_threads == 1:
         return ShareDummyVecEnv([get_env_fn(0)])
+    elif all_args.envs_per_worker > 1:
+        return MultiShareSubprocVecEnv([get_env_fn(i) for i in range(all_args.n_eval_rollout_threads)],
+                                       envs_per_worker=all_args.envs_per_worker)
+    elif all_args.use_shm_env:
+        return ShmShareSubprocVecEnv([get_env_fn(i) for i in range(all_args.n_eval_rollout_threads)])
     else:
         return ShareSubprocVecEnv([get_env_fn(i) for i in range(all_args.n_eval_rollout_threads)])
 
@@ -78,6 +101,40 @@ def parse_args(args, parser):
     parser.add_argument("--use_mustalive", action='store_false', default=True)
     parser.add_argument("--add_center_xy", action='store_false', default=True)
     parser.add_argument("--scenario_type", type=str,help='choose which scenario to run')
+    parser.add_argument("--map_cache_dir", type=str, default=None,
+                        help="directory to cache decoded SC2 map info in, shared by all env workers")
+    parser.add_argument("--use_shm_env", action='store_true', default=False,
+                        help="by default False, use shared memory instead of pipes to return env outputs from workers")
+    parser.add_argument("--use_warm_standby", action='store_true', default=False,
+                        help="by default False, keep a standby SC2 instance per training env to swap to on full restarts")
+    parser.add_argument("--envs_per_worker", type=int, default=1,
+                        help="number of SC2 envs hosted by each env worker process, stepped from a thread pool")
+    parser.add_argument("--use_async_env", action='store_true', default=False,
+                        help="by default False, step training envs asynchronously and act on the first envs to return (shared policy only)")
+    parser.add_argument("--async_env_k", type=int, default=None,
+                        help="number of envs to wait for in each asynchronous step, by default half of n_rollout_threads")
+    parser.add_argument("--use_pingpong", action='store_true', default=False,
+                        help="by default False, step half of the training envs while computing actions for the other half (shared policy only)")
+    parser.add_argument("--n_remote_actors", type=int, default=0,
+                        help="number of remote rollout actors this learner waits for at --learner_address, by default 0 to collect rollouts locally")
+    parser.add_argument("--remote_actor", action='store_true', default=False,
+                        help="by default False, run as a rollout actor of the learner at --learner_address, give every actor its own --seed")
+    parser.add_argument("--learner_address", type=str, default="127.0.0.1:29600",
+                        help="host:port the learner listens on and the remote actors connect to")
+    parser.add_argument("--learner_authkey", type=str, default=None,
+                        help="secret key the remote actors authenticate to the learner with, by default read from the MAPPO_LEARNER_AUTHKEY environment variable")
+    parser.add_argument("--use_pipeline", action='store_true', default=False,
+                        help="by default False, collect the next rollout with a policy snapshot while training on the last one (shared policy only)")
+    parser.add_argument("--pipeline_max_lag", type=int, default=1,
+                        help="max number of updates the rollout policy snapshot may lag behind the learner")
+    parser.add_argument("--use_batched_inference", action='store_true', default=False,
+                        help="by default False, evaluate all agents' separated policies in one batched call ('multiagent' scenario only)")
+    parser.add_argument("--use_inference_server", action='store_true', default=False,
+                        help="by default False, let env workers collect rollouts with actions from a separate inference process (shared policy only)")
+    parser.add_argument("--inference_max_batch", type=int, default=None,
+                        help="max number of env requests the inference server evaluates together, by default n_rollout_threads")
+    parser.add_argument("--inference_batch_timeout", type=float, default=0.002,
+                        help="seconds the inference server waits for more requests after the first one of a batch")
 
     all_args = parser.parse_known_args(args)[0]
 
@@ -97,8 +154,58 @@ def main(args):
     else:
         raise NotImplementedError
 
+    assert not all_args.use_masked_scan or all_args.use_recurrent_policy, (
+        "the masked scan is only meant for the chunked recurrent policy, it is slower on naive recurrent sequences!")
+    assert not all_args.use_async_env or all_args.share_policy, (
+        "async envs are only supported with a shared policy!")
+    assert not all_args.use_pingpong or all_args.share_policy, (
+        "ping-pong stepping is only supported with a shared policy!")
+    assert not all_args.use_pingpong or (all_args.n_rollout_threads > 1 and all_args.envs_per_worker == 1
+                                         and not all_args.use_shm_env and not all_args.use_async_env
+                                         and not all_args.use_inference_server), (
+        "ping-pong stepping needs more than one training env on plain subprocess workers!")
+    assert not all_args.use_device_buffer or all_args.share_policy, (
+        "the device buffer is only supported with a shared policy!")
+    assert not all_args.use_pipeline or all_args.share_policy, (
+        "the pipelined runner is only supported with a shared policy!")
+    assert all_args.pipeline_max_lag >= 1, ("pipeline_max_lag must be at least 1!")
+    assert not all_args.use_inference_server or all_args.share_policy, (
+        "the inference server is only supported with a shared policy!")
+    assert not all_args.use_inference_server or not (all_args.use_async_env or all_args.use_pipeline), (
+        "the inference server can not be combined with async envs or the pipelined runner!")
+    assert not (all_args.n_remote_actors > 0 or all_args.remote_actor) or (
+        all_args.share_policy and not all_args.use_device_buffer and not all_args.use_pipeline
+        and not all_args.use_inference_server and not all_args.use_distributed), (
+        "remote actors are only supported with a shared policy, a host buffer and no other learner modes!")
+    assert not (all_args.n_remote_actors > 0 and all_args.remote_actor), (
+        "a process is either the learner or a remote actor!")
+    if all_args.n_remote_actors > 0 or all_args.remote_actor:
+        # the learner and the actors unpickle what they receive, so anyone who knows the key can run code on them
+        all_args.learner_authkey = all_args.learner_authkey or os.environ.get("MAPPO_LEARNER_AUTHKEY")
+        assert all_args.learner_authkey, (
+            "remote actors need a secret key, set MAPPO_LEARNER_AUTHKEY or --learner_authkey!")
+    assert not (all_args.use_distributed and all_args.use_parallel_train), (
+        "distributed training can not be combined with parallel per-agent training!")
+    assert not all_args.use_batched_inference or all_args.scenario_type == 'multiagent', (
+        "batched inference is only supported by the separated multiagent runner!")
+
+    rank = 0
+    if all_args.use_distributed:
+        # one learner per process, started with torchrun which sets up the env:// rendezvous
+        dist.init_process_group(backend="gloo")
+        rank = dist.get_rank()
+        # every learner collects different rollouts
+        all_args.seed += rank
+        # only the first learner reports to wandb, the others write tensorboard logs
+        all_args.use_wandb = all_args.use_wandb and rank == 0
+
+    if all_args.remote_actor:
+        # actors only keep local logs, training and evaluation are reported by the learner
+        all_args.use_wandb = False
+        all_args.use_eval = False
+
     # cuda
-    if all_args.cuda and torch.cuda.is_available():
+    if all_args.cuda and torch.cuda.is_available() and not all_args.use_distributed:
         print("choose to use gpu...")
         device = torch.device("cuda:0")
         torch.set_num_threads(all_args.n_training_threads)
@@ -112,10 +219,21 @@ def main(args):
 
     run_dir = Path(os.path.split(os.path.dirname(os.path.abspath(__file__)))[
         0] + "/results") / all_args.env_name / all_args.map_name / all_args.algorithm_name / all_args.experiment_name
-    if not run_dir.exists():
+    if rank == 0 and not run_dir.exists():
         os.makedirs(str(run_dir))
 
-    if all_args.use_wandb:
+    if rank > 0:
+        # the other learners log into a sub directory of the first one's run
+        run_dirs = [None]
+        dist.broadcast_object_list(run_dirs, src=0)
+        run_dir = run_dirs[0] / ("rank%i" % rank)
+        if not run_dir.exists():
+            os.makedirs(str(run_dir))
+    elif all_args.remote_actor:
+        run_dir = run_dir / ("actor-%s-%i" % (socket.gethostname(), os.getpid()))
+        if not run_dir.exists():
+            os.makedirs(str(run_dir))
+    elif all_args.use_wandb:
         run = wandb.init(config=all_args,
                          project=all_args.env_name,
                          entity=all_args.user_name,
@@ -138,6 +256,8 @@ def main(args):
         run_dir = run_dir / curr_run
         if not run_dir.exists():
             os.makedirs(str(run_dir))
+    if rank == 0 and all_args.use_distributed:
+        dist.broadcast_object_list([run_dir], src=0)
 
     setproctitle.setproctitle(
         str(all_args.algorithm_name) + "-" + str(all_args.env_name) + "-" + str(all_args.experiment_name) + "@" + str(
@@ -150,6 +270,8 @@ def main(args):
 
     # env
     envs = make_train_env(all_args)
+    # the learner's buffer holds the envs of all remote actors
+    all_args.n_rollout_threads = envs.num_envs
     eval_envs = make_eval_env(all_args) if all_args.use_eval else None
     num_agents = get_map_params(all_args.map_name)["n_agents"]
     unit_type_bits = get_map_params(all_args.map_name)["unit_type_bits"]
@@ -173,7 +295,12 @@ def main(args):
         from onpolicy.runner.separated.smac_runner import SMACRunner as Runner
 
     runner = Runner(config)
-    runner.run()
+    if all_args.remote_actor:
+        learner = LearnerConnection(parse_address(all_args.learner_address), all_args.learner_authkey.encode(), envs)
+        runner.run_actor(learner)
+        learner.close()
+    else:
+        runner.run()
 
     # post process
 
@@ -188,6 +315,9 @@ def main(args):
             str(runner.log_dir + '/summary.json'))
         runner.writter.close()
 
+    if all_args.use_distributed:
+        dist.destroy_process_group()
+
 
 if __name__ == "__main__":
     main(sys.argv[1:])
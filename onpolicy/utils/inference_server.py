@@ -0,0 +1,213 @@
+import copy
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Pipe, wait
+
+from onpolicy.utils.util import get_shape_from_obs_space, get_shape_from_act_space
+
+
+def _t2n(x):
+    return x.detach().cpu().numpy()
+
+
+def _attach(specs, index=slice(None)):
+    shms = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    slabs = [np.ndarray(shape, dtype=dtype, buffer=shm.buf)[index] for shm, (_, shape, dtype) in zip(shms, specs)]
+    return shms, slabs
+
+
+def _serve(policy, conns, control, specs, lock, max_batch, batch_timeout):
+    """
+    Inference server loop. Blocks for the first request, then keeps collecting requests until max_batch of them
+    have arrived or batch_timeout seconds have passed, and answers all of them with one get_actions call.
+    """
+    shms, slabs = _attach(specs)
+    share_obs, obs, rnn_states, rnn_states_critic, masks, available_actions, \
+        values, actions, action_log_probs = slabs
+    policy.actor.eval()
+    policy.critic.eval()
+
+    clients = {conn: index for index, conn in enumerate(conns)}
+    while clients:
+        ready = wait(list(clients) + [control])
+        if control in ready:
+            break
+
+        batch = []
+        deadline = time.perf_counter() + batch_timeout
+        while True:
+            for conn in ready[:max_batch - len(batch)]:
+                try:
+                    conn.recv()
+                except EOFError:
+                    # the rollout worker has exited
+                    clients.pop(conn)
+                    continue
+                batch.append(clients[conn])
+            timeout = deadline - time.perf_counter()
+            if len(batch) >= max_batch or timeout <= 0:
+                break
+            ready = wait([conn for conn, index in clients.items() if index not in batch], timeout)
+            if not ready:
+                break
+        if not batch:
+            continue
+
+        batch = np.sort(batch)
+        n = len(batch)
+        with lock, torch.no_grad():
+            value, action, action_log_prob, rnn_state, rnn_state_critic \
+                = policy.get_actions(share_obs[batch].reshape(-1, *share_obs.shape[2:]),
+                                     obs[batch].reshape(-1, *obs.shape[2:]),
+                                     rnn_states[batch].reshape(-1, *rnn_states.shape[2:]),
+                                     rnn_states_critic[batch].reshape(-1, *rnn_states_critic.shape[2:]),
+                                     masks[batch].reshape(-1, *masks.shape[2:]),
+                                     available_actions[batch].reshape(-1, *available_actions.shape[2:]))
+        values[batch] = _t2n(value).reshape(n, -1, *values.shape[2:])
+        actions[batch] = _t2n(action).reshape(n, -1, *actions.shape[2:])
+        action_log_probs[batch] = _t2n(action_log_prob).reshape(n, -1, *action_log_probs.shape[2:])
+        rnn_states[batch] = _t2n(rnn_state).reshape(n, -1, *rnn_states.shape[2:])
+        rnn_states_critic[batch] = _t2n(rnn_state_critic).reshape(n, -1, *rnn_states_critic.shape[2:])
+        for index in batch:
+            conns[index].send(None)
+
+    # the array views have to be released before the shared memory can be closed
+    del slabs, share_obs, obs, rnn_states, rnn_states_critic, masks, available_actions, \
+        values, actions, action_log_probs
+    for shm in shms:
+        shm.close()
+
+
+class InferenceClient(object):
+    """
+    Connection of one rollout worker to an InferenceServer. It is handed to the worker process and attaches to
+    the shared memory slot of its env on first use.
+    :param conn: (multiprocessing.Connection) pipe end used to signal requests and replies.
+    :param index: (int) slot of the client in the shared memory arrays.
+    :param specs: (list) (name, shape, dtype) of every shared memory array of the server.
+    """
+    def __init__(self, conn, index, specs):
+        self.conn = conn
+        self.index = index
+        self.specs = specs
+        self.shms, self.slabs = [], None
+
+    def __getstate__(self):
+        return dict(conn=self.conn, index=self.index, specs=self.specs, shms=[], slabs=None)
+
+    def get_actions(self, cent_obs, obs, rnn_states_actor, rnn_states_critic, masks, available_actions):
+        """
+        Compute actions and value predictions of all agents of one env on the server, see
+        R_MAPPOPolicy.get_actions. Inputs have shape (n_agents, ...) and the returns are np.ndarrays.
+        """
+        if self.slabs is None:
+            self.shms, self.slabs = _attach(self.specs, self.index)
+        share_obs_slot, obs_slot, rnn_states_slot, rnn_states_critic_slot, masks_slot, available_actions_slot, \
+            values_slot, actions_slot, action_log_probs_slot = self.slabs
+
+        share_obs_slot[...] = cent_obs
+        obs_slot[...] = obs
+        rnn_states_slot[...] = rnn_states_actor
+        rnn_states_critic_slot[...] = rnn_states_critic
+        masks_slot[...] = masks
+        available_actions_slot[...] = available_actions
+        self.conn.send(None)
+        self.conn.recv()
+
+        return values_slot.copy(), actions_slot.copy(), action_log_probs_slot.copy(), \
+            rnn_states_slot.copy(), rnn_states_critic_slot.copy()
+
+    def close(self):
+        self.slabs = None
+        for shm in self.shms:
+            shm.close()
+        self.shms = []
+        self.conn.close()
+
+
+class InferenceServer(object):
+    """
+    Serves get_actions requests of rollout workers from a copy of the policy held by a dedicated process.
+    Every env has a slot in shared memory arrays of shape (n_clients, n_agents, dim) for the policy inputs and
+    outputs, only short notifications go through the pipes. Requests that arrive within batch_timeout
+    seconds of each other, up to max_batch of them, are evaluated together. The served weights live in shared
+    memory and are only changed by sync().
+    :param args: (argparse.Namespace) arguments containing relevant model and policy information.
+    :param policy: (R_MAPPOPolicy) policy to serve, it is copied.
+    :param n_clients: (int) number of rollout workers, one env each.
+    :param num_agents: (int) number of agents in the env.
+    :param obs_space: (gym.Space) observation space of agents.
+    :param cent_obs_space: (gym.Space) centralized observation space of agents.
+    :param act_space: (gym.Space) action space for agents, must be Discrete.
+    :param max_batch: (int) max number of requests per batch, all clients if None.
+    :param batch_timeout: (float) seconds to wait for more requests after the first one of a batch.
+    """
+    def __init__(self, args, policy, n_clients, num_agents, obs_space, cent_obs_space, act_space,
+                 max_batch=None, batch_timeout=0.002):
+        assert act_space.__class__.__name__ == 'Discrete', "the inference server only supports Discrete actions"
+        self.max_batch = n_clients if max_batch is None else max(1, max_batch)
+        self.batch_timeout = batch_timeout
+
+        obs_shape = get_shape_from_obs_space(obs_space)
+        share_obs_shape = get_shape_from_obs_space(cent_obs_space)
+        if type(obs_shape[-1]) == list:
+            obs_shape = obs_shape[:1]
+        if type(share_obs_shape[-1]) == list:
+            share_obs_shape = share_obs_shape[:1]
+        rnn_shape = (args.recurrent_N, args.hidden_size)
+        act_shape = get_shape_from_act_space(act_space)
+
+        shapes = [share_obs_shape, obs_shape, rnn_shape, rnn_shape, (1,), (act_space.n,),
+                  (1,), (act_shape,), (act_shape,)]
+        dtypes = [np.float32] * 7 + [np.int64, np.float32]
+        # the server and the workers share the resource tracker of this process, so that they do not unlink
+        # the arrays when they exit
+        resource_tracker.ensure_running()
+        self.shms, self.specs = [], []
+        for shape, dtype in zip(shapes, dtypes):
+            shape = (n_clients, num_agents, *shape)
+            shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            self.shms.append(shm)
+            self.specs.append((shm.name, shape, np.dtype(dtype).str))
+
+        self.policy = copy.deepcopy(policy)
+        self.policy.actor.share_memory()
+        self.policy.critic.share_memory()
+
+        # spawn instead of fork, so that the server can use CUDA
+        ctx = mp.get_context('spawn')
+        self.lock = ctx.Lock()
+        server_conns, client_conns = zip(*[Pipe() for _ in range(n_clients)])
+        self.control, server_control = Pipe()
+        self.process = ctx.Process(target=_serve, args=(self.policy, server_conns, server_control, self.specs,
+                                                        self.lock, self.max_batch, self.batch_timeout))
+        self.process.daemon = True
+        self.process.start()
+        for conn in server_conns:
+            conn.close()
+        server_control.close()
+
+        self.clients = [InferenceClient(conn, index, self.specs) for index, conn in enumerate(client_conns)]
+        self.closed = False
+
+    def sync(self, policy):
+        """Copy the weights of policy to the served policy, between two batches."""
+        with self.lock:
+            self.policy.actor.load_state_dict(policy.actor.state_dict())
+            self.policy.critic.load_state_dict(policy.critic.state_dict())
+
+    def close(self):
+        if self.closed:
+            return
+        self.control.send(None)
+        self.process.join()
+        for client in self.clients:
+            client.close()
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.closed = True
@@ -0,0 +1,73 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+
+
+class MinibatchPrefetcher(object):
+    """
+    Pulls minibatches from a buffer generator in a background thread and converts them to float32 tensors
+    on the training device, so that the next minibatch is assembled while the current one is trained on.
+    :param generator: (generator) yields minibatch tuples of np.ndarray, torch.Tensor or None entries.
+    :param device: (torch.device) device the minibatch tensors are moved to.
+    :param queue_size: (int) maximum number of prepared minibatches waiting to be consumed.
+    """
+    _END = object()
+
+    def __init__(self, generator, device=torch.device("cpu"), queue_size=2):
+        self.generator = generator
+        self.tpdv = dict(dtype=torch.float32, device=device)
+        self._pin_memory = torch.device(device).type == 'cuda'
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _to_tensor(self, x):
+        if x is None:
+            return None
+        x = torch.from_numpy(x) if type(x) == np.ndarray else x
+        if self._pin_memory and not x.is_cuda:
+            # page-locked host memory lets the copy overlap with the update on the device
+            return x.pin_memory().to(non_blocking=True, **self.tpdv)
+        return x.to(**self.tpdv)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self):
+        try:
+            for sample in self.generator:
+                if not self._put(tuple(self._to_tensor(x) for x in sample)):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if item is self._END:
+            self._thread.join()
+            raise StopIteration
+        if isinstance(item, Exception):
+            self._thread.join()
+            raise item
+        return item
+
+    def close(self):
+        """Stop the background thread and drop the minibatches it has prepared."""
+        self._stop.set()
+        self._thread.join()
+        while not self._queue.empty():
+            self._queue.get_nowait()
@@ -0,0 +1,119 @@
+import pickle
+
+import numpy as np
+from multiprocessing.connection import Client, Listener
+
+# buffer arrays that make up a rollout segment, in the SharedReplayBuffer layout
+SEGMENT_KEYS = ['share_obs', 'obs', 'rnn_states', 'rnn_states_critic', 'actions', 'action_log_probs', 'value_preds',
+                'rewards', 'masks', 'bad_masks', 'active_masks', 'available_actions']
+
+
+def parse_address(address):
+    """Split a "host:port" string into a (host, port) tuple."""
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def _send(conn, obj):
+    # plain pickle, tensors have to be sent by value to other hosts
+    conn.send_bytes(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _recv(conn):
+    return pickle.loads(conn.recv_bytes())
+
+
+def _policy_state(policy):
+    return {'actor': policy.actor.state_dict(), 'critic': policy.critic.state_dict()}
+
+
+class RemoteActorEnvs(object):
+    """
+    Learner side of distributed rollout collection. Stands in for the vec env of the learner: it waits for
+    n_actors rollout actors to connect over TCP, and every actor runs n_envs_per_actor envs of its own. The envs
+    of actor i get ids i * n_envs_per_actor and up, in the order the actors connected. Messages are pickled,
+    so authkey has to be kept secret: whoever knows it can run code in the learner and the actors.
+    :param address: (tuple) (host, port) to listen on.
+    :param n_actors: (int) number of actors to wait for.
+    :param authkey: (bytes) secret key the actors have to authenticate with.
+    """
+    def __init__(self, address, n_actors, authkey):
+        assert authkey, "remote actors have to authenticate with a secret key"
+        self.closed = False
+        self.listener = Listener(address, authkey=authkey)
+        self.conns = []
+        spaces, counts = [], []
+        for _ in range(n_actors):
+            conn = self.listener.accept()
+            observation_space, share_observation_space, action_space, n_envs = _recv(conn)
+            self.conns.append(conn)
+            spaces.append((observation_space, share_observation_space, action_space))
+            counts.append(n_envs)
+        assert len(set(counts)) == 1, "all actors must run the same number of envs"
+        self.n_envs_per_actor = counts[0]
+        self.num_envs = n_actors * self.n_envs_per_actor
+        self.observation_space, self.share_observation_space, self.action_space = spaces[0]
+
+    def send_weights(self, policy):
+        """Broadcast the actor and critic weights of policy to all actors."""
+        state = _policy_state(policy)
+        for conn in self.conns:
+            _send(conn, state)
+
+    def recv_rollouts(self, buffer):
+        """
+        Wait for the next rollout segment of every actor and copy it into the env slice of the actor in buffer.
+        :param buffer: (SharedReplayBuffer) learner buffer with room for the envs of all actors.
+
+        :return infos: (np.ndarray) infos of the last step of every env.
+        """
+        infos = []
+        for index, conn in enumerate(self.conns):
+            segment, segment_infos = _recv(conn)
+            envs = slice(index * self.n_envs_per_actor, (index + 1) * self.n_envs_per_actor)
+            for key in SEGMENT_KEYS:
+                getattr(buffer, key)[:, envs] = segment[key]
+            infos.append(segment_infos)
+        return np.concatenate(infos)
+
+    def close(self):
+        if self.closed:
+            return
+        # tells the actors to stop
+        for conn in self.conns:
+            _send(conn, None)
+            conn.close()
+        self.listener.close()
+        self.closed = True
+
+
+class LearnerConnection(object):
+    """
+    Actor side of distributed rollout collection, see RemoteActorEnvs.
+    :param address: (tuple) (host, port) of the learner.
+    :param authkey: (bytes) secret key to authenticate with.
+    :param envs: (ShareVecEnv) envs of this actor, their spaces are sent to the learner.
+    """
+    def __init__(self, address, authkey, envs):
+        assert authkey, "remote actors have to authenticate with a secret key"
+        self.conn = Client(address, authkey=authkey)
+        _send(self.conn, (envs.observation_space, envs.share_observation_space, envs.action_space, envs.num_envs))
+
+    def recv_weights(self, policy):
+        """
+        Wait for new weights from the learner and load them into policy.
+        :return: (bool) False if the learner has stopped training instead.
+        """
+        state = _recv(self.conn)
+        if state is None:
+            return False
+        policy.actor.load_state_dict(state['actor'])
+        policy.critic.load_state_dict(state['critic'])
+        return True
+
+    def send_rollout(self, buffer, infos):
+        """Send the rollout segment collected in buffer together with the infos of its last step."""
+        _send(self.conn, ({key: getattr(buffer, key) for key in SEGMENT_KEYS}, infos))
+
+    def close(self):
+        self.conn.close()
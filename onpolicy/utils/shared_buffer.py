@@ -1,6 +1,6 @@
 import torch
 import numpy as np
-from onpolicy.utils.util import get_shape_from_obs_space, get_shape_from_act_space
+from onpolicy.utils.util import get_shape_from_obs_space, get_shape_from_act_space, compute_gae_returns, compute_discounted_returns
 
 
 def _flatten(T, N, x):
@@ -32,6 +32,12 @@ class SharedReplayBuffer(object):
         self._use_popart = args.use_popart
         self._use_valuenorm = args.use_valuenorm
         self._use_proper_time_limits = args.use_proper_time_limits
+        self._use_compact_buffer = args.use_compact_buffer
+
+        # compact storage keeps observations in half precision and 0/1 masks in uint8,
+        # they are cast back to float32 when converted to tensors
+        obs_dtype = np.float16 if self._use_compact_buffer else np.float32
+        mask_dtype = np.uint8 if self._use_compact_buffer else np.float32
 
         obs_shape = get_shape_from_obs_space(obs_space)
         share_obs_shape = get_shape_from_obs_space(cent_obs_space)
@@ -43,8 +49,8 @@ class SharedReplayBuffer(object):
             share_obs_shape = share_obs_shape[:1]
 
         self.share_obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, num_agents, *share_obs_shape),
-                                  dtype=np.float32)
-        self.obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, num_agents, *obs_shape), dtype=np.float32)
+                                  dtype=obs_dtype)
+        self.obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, num_agents, *obs_shape), dtype=obs_dtype)
 
         self.rnn_states = np.zeros(
             (self.episode_length + 1, self.n_rollout_threads, num_agents, self.recurrent_N, self.hidden_size),
@@ -57,7 +63,7 @@ class SharedReplayBuffer(object):
 
         if act_space.__class__.__name__ == 'Discrete':
             self.available_actions = np.ones((self.episode_length + 1, self.n_rollout_threads, num_agents, act_space.n),
-                                             dtype=np.float32)
+                                             dtype=mask_dtype)
         else:
             self.available_actions = None
 
@@ -70,11 +76,21 @@ class SharedReplayBuffer(object):
         self.rewards = np.zeros(
             (self.episode_length, self.n_rollout_threads, num_agents, 1), dtype=np.float32)
 
-        self.masks = np.ones((self.episode_length + 1, self.n_rollout_threads, num_agents, 1), dtype=np.float32)
+        self.masks = np.ones((self.episode_length + 1, self.n_rollout_threads, num_agents, 1), dtype=mask_dtype)
         self.bad_masks = np.ones_like(self.masks)
         self.active_masks = np.ones_like(self.masks)
 
         self.step = 0
+        # per-env step cursors, used when envs are stepped asynchronously
+        self.env_steps = np.zeros(self.n_rollout_threads, dtype=np.int64)
+        self._chunk_indices = None
+
+    def nbytes(self):
+        """Memory used by the buffer's arrays, in bytes."""
+        arrays = [self.share_obs, self.obs, self.rnn_states, self.rnn_states_critic, self.value_preds, self.returns,
+                  self.available_actions, self.actions, self.action_log_probs, self.rewards, self.masks,
+                  self.bad_masks, self.active_masks]
+        return sum(x.nbytes for x in arrays if x is not None)
 
     def insert(self, share_obs, obs, rnn_states_actor, rnn_states_critic, actions, action_log_probs,
                value_preds, rewards, masks, bad_masks=None, active_masks=None, available_actions=None):
@@ -111,6 +127,34 @@ class SharedReplayBuffer(object):
 
         self.step = (self.step + 1) % self.episode_length
 
+    def insert_envs(self, env_ids, share_obs, obs, rnn_states_actor, rnn_states_critic, actions, action_log_probs,
+                    value_preds, rewards, masks, bad_masks=None, active_masks=None, available_actions=None):
+        """
+        Insert data for a subset of the envs, each at its own step cursor. Used with asynchronous envs,
+        where the envs do not advance in lockstep. All arrays have env_ids as their first dimension.
+        :param env_ids: (np.ndarray) ids of the envs the data belongs to.
+        See insert for the remaining parameters.
+        """
+        steps = self.env_steps[env_ids]
+        assert np.all(steps < self.episode_length), "env stepped past the end of the episode"
+        self.share_obs[steps + 1, env_ids] = share_obs
+        self.obs[steps + 1, env_ids] = obs
+        self.rnn_states[steps + 1, env_ids] = rnn_states_actor
+        self.rnn_states_critic[steps + 1, env_ids] = rnn_states_critic
+        self.actions[steps, env_ids] = actions
+        self.action_log_probs[steps, env_ids] = action_log_probs
+        self.value_preds[steps, env_ids] = value_preds
+        self.rewards[steps, env_ids] = rewards
+        self.masks[steps + 1, env_ids] = masks
+        if bad_masks is not None:
+            self.bad_masks[steps + 1, env_ids] = bad_masks
+        if active_masks is not None:
+            self.active_masks[steps + 1, env_ids] = active_masks
+        if available_actions is not None:
+            self.available_actions[steps + 1, env_ids] = available_actions
+
+        self.env_steps[env_ids] += 1
+
     def chooseinsert(self, share_obs, obs, rnn_states, rnn_states_critic, actions, action_log_probs,
                      value_preds, rewards, masks, bad_masks=None, active_masks=None, available_actions=None):
         """
@@ -146,17 +190,22 @@ class SharedReplayBuffer(object):
 
         self.step = (self.step + 1) % self.episode_length
 
-    def after_update(self):
-        """Copy last timestep data to first index. Called after update to model."""
-        self.share_obs[0] = self.share_obs[-1].copy()
-        self.obs[0] = self.obs[-1].copy()
-        self.rnn_states[0] = self.rnn_states[-1].copy()
-        self.rnn_states_critic[0] = self.rnn_states_critic[-1].copy()
-        self.masks[0] = self.masks[-1].copy()
-        self.bad_masks[0] = self.bad_masks[-1].copy()
-        self.active_masks[0] = self.active_masks[-1].copy()
+    def after_update(self, next_buffer=None):
+        """
+        Copy last timestep data to first index. Called after update to model.
+        :param next_buffer: (SharedReplayBuffer) buffer the next rollout is collected into, this buffer if None.
+        """
+        next_buffer = self if next_buffer is None else next_buffer
+        next_buffer.share_obs[0] = self.share_obs[-1].copy()
+        next_buffer.obs[0] = self.obs[-1].copy()
+        next_buffer.rnn_states[0] = self.rnn_states[-1].copy()
+        next_buffer.rnn_states_critic[0] = self.rnn_states_critic[-1].copy()
+        next_buffer.masks[0] = self.masks[-1].copy()
+        next_buffer.bad_masks[0] = self.bad_masks[-1].copy()
+        next_buffer.active_masks[0] = self.active_masks[-1].copy()
         if self.available_actions is not None:
-            self.available_actions[0] = self.available_actions[-1].copy()
+            next_buffer.available_actions[0] = self.available_actions[-1].copy()
+        self.env_steps[:] = 0
 
     def chooseafter_update(self):
         """Copy last timestep data to first index. This method is used for Hanabi."""
@@ -165,70 +214,42 @@ class SharedReplayBuffer(object):
         self.masks[0] = self.masks[-1].copy()
         self.bad_masks[0] = self.bad_masks[-1].copy()
 
+    def _as_float(self, x):
+        return x.astype(np.float32, copy=False)
+
     def compute_returns(self, next_value, value_normalizer=None):
         """
         Compute returns either as discounted sum of rewards, or using GAE.
         :param next_value: (np.ndarray) value predictions for the step after the last episode step.
         :param value_normalizer: (PopArt) If not None, PopArt value normalizer instance.
         """
-        if self._use_proper_time_limits:
-            if self._use_gae:
-                self.value_preds[-1] = next_value
-                gae = 0
-                for step in reversed(range(self.rewards.shape[0])):
-                    if self._use_popart or self._use_valuenorm:
-                        # step + 1
-                        delta = self.rewards[step] + self.gamma * value_normalizer.denormalize(
-                            self.value_preds[step + 1]) * self.masks[step + 1] \
-                                - value_normalizer.denormalize(self.value_preds[step])
-                        gae = delta + self.gamma * self.gae_lambda * gae * self.masks[step + 1]
-                        gae = gae * self.bad_masks[step + 1]
-                        self.returns[step] = gae + value_normalizer.denormalize(self.value_preds[step])
-                    else:
-                        delta = self.rewards[step] + self.gamma * self.value_preds[step + 1] * self.masks[step + 1] - \
-                                self.value_preds[step]
-                        gae = delta + self.gamma * self.gae_lambda * self.masks[step + 1] * gae
-                        gae = gae * self.bad_masks[step + 1]
-                        self.returns[step] = gae + self.value_preds[step]
+        # compact masks are uint8, compute in float32 like the regular buffer
+        masks, bad_masks = self._as_float(self.masks), self._as_float(self.bad_masks)
+        if self._use_gae:
+            self.value_preds[-1] = next_value
+            # denormalize once for the whole buffer instead of twice per step
+            if self._use_popart or self._use_valuenorm:
+                values = value_normalizer.denormalize(self.value_preds)
             else:
-                self.returns[-1] = next_value
-                for step in reversed(range(self.rewards.shape[0])):
-                    if self._use_popart or self._use_valuenorm:
-                        self.returns[step] = (self.returns[step + 1] * self.gamma * self.masks[step + 1] + self.rewards[
-                            step]) * self.bad_masks[step + 1] \
-                                             + (1 - self.bad_masks[step + 1]) * value_normalizer.denormalize(
-                            self.value_preds[step])
-                    else:
-                        self.returns[step] = (self.returns[step + 1] * self.gamma * self.masks[step + 1] + self.rewards[
-                            step]) * self.bad_masks[step + 1] \
-                                             + (1 - self.bad_masks[step + 1]) * self.value_preds[step]
+                values = self.value_preds
+            self.returns[:-1] = compute_gae_returns(self.rewards, values, masks, bad_masks,
+                                                    self.gamma, self.gae_lambda, self._use_proper_time_limits)
         else:
-            if self._use_gae:
-                self.value_preds[-1] = next_value
-                gae = 0
-                for step in reversed(range(self.rewards.shape[0])):
-                    if self._use_popart or self._use_valuenorm:
-                        delta = self.rewards[step] + self.gamma * value_normalizer.denormalize(
-                            self.value_preds[step + 1]) * self.masks[step + 1] \
-                                - value_normalizer.denormalize(self.value_preds[step])
-                        gae = delta + self.gamma * self.gae_lambda * self.masks[step + 1] * gae
-                        self.returns[step] = gae + value_normalizer.denormalize(self.value_preds[step])
-                    else:
-                        delta = self.rewards[step] + self.gamma * self.value_preds[step + 1] * self.masks[step + 1] - \
-                                self.value_preds[step]
-                        gae = delta + self.gamma * self.gae_lambda * self.masks[step + 1] * gae
-                        self.returns[step] = gae + self.value_preds[step]
+            self.returns[-1] = next_value
+            if self._use_proper_time_limits and (self._use_popart or self._use_valuenorm):
+                values = value_normalizer.denormalize(self.value_preds)
             else:
-                self.returns[-1] = next_value
-                for step in reversed(range(self.rewards.shape[0])):
-                    self.returns[step] = self.returns[step + 1] * self.gamma * self.masks[step + 1] + self.rewards[step]
+                values = self.value_preds
+            compute_discounted_returns(self.returns, self.rewards, values, masks, bad_masks,
+                                       self.gamma, self._use_proper_time_limits)
 
-    def feed_forward_generator(self, advantages, num_mini_batch=None, mini_batch_size=None):
+    def feed_forward_generator(self, advantages, num_mini_batch=None, mini_batch_size=None, generator=None):
         """
         Yield training data for MLP policies.
         :param advantages: (np.ndarray) advantage estimates.
         :param num_mini_batch: (int) number of minibatches to split the batch into.
         :param mini_batch_size: (int) number of samples in each minibatch.
+        :param generator: (torch.Generator) optional generator used to shuffle the minibatches.
         """
         episode_length, n_rollout_threads, num_agents = self.rewards.shape[0:3]
         batch_size = n_rollout_threads * episode_length * num_agents
@@ -243,7 +264,7 @@ class SharedReplayBuffer(object):
                           num_mini_batch))
             mini_batch_size = batch_size // num_mini_batch
 
-        rand = torch.randperm(batch_size).numpy()
+        rand = torch.randperm(batch_size, generator=generator).numpy()
         sampler = [rand[i * mini_batch_size:(i + 1) * mini_batch_size] for i in range(num_mini_batch)]
 
         share_obs = self.share_obs[:-1].reshape(-1, *self.share_obs.shape[3:])
@@ -285,11 +306,12 @@ class SharedReplayBuffer(object):
                   value_preds_batch, return_batch, masks_batch, active_masks_batch, old_action_log_probs_batch,\
                   adv_targ, available_actions_batch
 
-    def naive_recurrent_generator(self, advantages, num_mini_batch):
+    def naive_recurrent_generator(self, advantages, num_mini_batch, generator=None):
         """
         Yield training data for non-chunked RNN training.
         :param advantages: (np.ndarray) advantage estimates.
         :param num_mini_batch: (int) number of minibatches to split the batch into.
+        :param generator: (torch.Generator) optional generator used to shuffle the minibatches.
         """
         episode_length, n_rollout_threads, num_agents = self.rewards.shape[0:3]
         batch_size = n_rollout_threads * num_agents
@@ -298,7 +320,7 @@ class SharedReplayBuffer(object):
             "to be greater than or equal to the number of "
             "PPO mini batches ({}).".format(n_rollout_threads, num_agents, num_mini_batch))
         num_envs_per_batch = batch_size // num_mini_batch
-        perm = torch.randperm(batch_size).numpy()
+        perm = torch.randperm(batch_size, generator=generator).numpy()
 
         share_obs = self.share_obs.reshape(-1, batch_size, *self.share_obs.shape[3:])
         obs = self.obs.reshape(-1, batch_size, *self.obs.shape[3:])
@@ -315,180 +337,198 @@ class SharedReplayBuffer(object):
         advantages = advantages.reshape(-1, batch_size, 1)
 
         for start_ind in range(0, batch_size, num_envs_per_batch):
-            share_obs_batch = []
-            obs_batch = []
-            rnn_states_batch = []
-            rnn_states_critic_batch = []
-            actions_batch = []
-            available_actions_batch = []
-            value_preds_batch = []
-            return_batch = []
-            masks_batch = []
-            active_masks_batch = []
-            old_action_log_probs_batch = []
-            adv_targ = []
-
-            for offset in range(num_envs_per_batch):
-                ind = perm[start_ind + offset]
-                share_obs_batch.append(share_obs[:-1, ind])
-                obs_batch.append(obs[:-1, ind])
-                rnn_states_batch.append(rnn_states[0:1, ind])
-                rnn_states_critic_batch.append(rnn_states_critic[0:1, ind])
-                actions_batch.append(actions[:, ind])
-                if self.available_actions is not None:
-                    available_actions_batch.append(available_actions[:-1, ind])
-                value_preds_batch.append(value_preds[:-1, ind])
-                return_batch.append(returns[:-1, ind])
-                masks_batch.append(masks[:-1, ind])
-                active_masks_batch.append(active_masks[:-1, ind])
-                old_action_log_probs_batch.append(action_log_probs[:, ind])
-                adv_targ.append(advantages[:, ind])
-
-            # [N[T, dim]]
-            T, N = self.episode_length, num_envs_per_batch
-            # These are all from_numpys of size (T, N, -1)
-            share_obs_batch = np.stack(share_obs_batch, 1)
-            obs_batch = np.stack(obs_batch, 1)
-            actions_batch = np.stack(actions_batch, 1)
-            if self.available_actions is not None:
-                available_actions_batch = np.stack(available_actions_batch, 1)
-            value_preds_batch = np.stack(value_preds_batch, 1)
-            return_batch = np.stack(return_batch, 1)
-            masks_batch = np.stack(masks_batch, 1)
-            active_masks_batch = np.stack(active_masks_batch, 1)
-            old_action_log_probs_batch = np.stack(old_action_log_probs_batch, 1)
-            adv_targ = np.stack(adv_targ, 1)
-
-            # States is just a (N, dim) from_numpy [N[1,dim]]
-            rnn_states_batch = np.stack(rnn_states_batch).reshape(N, *self.rnn_states.shape[3:])
-            rnn_states_critic_batch = np.stack(rnn_states_critic_batch).reshape(N, *self.rnn_states_critic.shape[3:])
-
-            # Flatten the (T, N, ...) from_numpys to (T * N, ...)
-            share_obs_batch = _flatten(T, N, share_obs_batch)
-            obs_batch = _flatten(T, N, obs_batch)
-            actions_batch = _flatten(T, N, actions_batch)
+            ind = perm[start_ind:start_ind + num_envs_per_batch]
+
+            T, N = self.episode_length, len(ind)
+            # These are all gathered with shape (T, N, -1) and flattened to (T * N, -1)
+            share_obs_batch = _flatten(T, N, share_obs[:-1, ind])
+            obs_batch = _flatten(T, N, obs[:-1, ind])
+            actions_batch = _flatten(T, N, actions[:, ind])
             if self.available_actions is not None:
-                available_actions_batch = _flatten(T, N, available_actions_batch)
+                available_actions_batch = _flatten(T, N, available_actions[:-1, ind])
             else:
                 available_actions_batch = None
-            value_preds_batch = _flatten(T, N, value_preds_batch)
-            return_batch = _flatten(T, N, return_batch)
-            masks_batch = _flatten(T, N, masks_batch)
-            active_masks_batch = _flatten(T, N, active_masks_batch)
-            old_action_log_probs_batch = _flatten(T, N, old_action_log_probs_batch)
-            adv_targ = _flatten(T, N, adv_targ)
+            value_preds_batch = _flatten(T, N, value_preds[:-1, ind])
+            return_batch = _flatten(T, N, returns[:-1, ind])
+            masks_batch = _flatten(T, N, masks[:-1, ind])
+            active_masks_batch = _flatten(T, N, active_masks[:-1, ind])
+            old_action_log_probs_batch = _flatten(T, N, action_log_probs[:, ind])
+            adv_targ = _flatten(T, N, advantages[:, ind])
+
+            # States is just a (N, dim) array
+            rnn_states_batch = rnn_states[0, ind]
+            rnn_states_critic_batch = rnn_states_critic[0, ind]
 
             yield share_obs_batch, obs_batch, rnn_states_batch, rnn_states_critic_batch, actions_batch,\
                   value_preds_batch, return_batch, masks_batch, active_masks_batch, old_action_log_probs_batch,\
                   adv_targ, available_actions_batch
 
-    def recurrent_generator(self, advantages, num_mini_batch, data_chunk_length):
+    def _get_chunk_indices(self, data_chunk_length):
+        """
+        Buffer indices of every step of every data chunk, cached across calls.
+        Chunks are consecutive pieces of length data_chunk_length of the buffer
+        laid out as [N, M, T].
+        :param data_chunk_length: (int) length of sequence chunks with which to train RNN.
+        :return (t, n, m): (np.ndarray) step, env and agent indices, each of shape (data_chunks, data_chunk_length).
+        """
+        if self._chunk_indices is None or self._chunk_indices[0] != data_chunk_length:
+            episode_length, n_rollout_threads, num_agents = self.rewards.shape[0:3]
+            data_chunks = n_rollout_threads * episode_length * num_agents // data_chunk_length
+            flat = np.arange(data_chunks * data_chunk_length).reshape(data_chunks, data_chunk_length)
+            env_agent, t = np.divmod(flat, episode_length)
+            n, m = np.divmod(env_agent, num_agents)
+            self._chunk_indices = (data_chunk_length, t, n, m)
+        return self._chunk_indices[1:]
+
+    def recurrent_generator(self, advantages, num_mini_batch, data_chunk_length, generator=None):
         """
         Yield training data for chunked RNN training.
         :param advantages: (np.ndarray) advantage estimates.
         :param num_mini_batch: (int) number of minibatches to split the batch into.
         :param data_chunk_length: (int) length of sequence chunks with which to train RNN.
+        :param generator: (torch.Generator) optional generator used to shuffle the minibatches.
         """
         episode_length, n_rollout_threads, num_agents = self.rewards.shape[0:3]
         batch_size = n_rollout_threads * episode_length * num_agents
         data_chunks = batch_size // data_chunk_length  # [C=r*T*M/L]
         mini_batch_size = data_chunks // num_mini_batch
 
-        rand = torch.randperm(data_chunks).numpy()
+        rand = torch.randperm(data_chunks, generator=generator).numpy()
         sampler = [rand[i * mini_batch_size:(i + 1) * mini_batch_size] for i in range(num_mini_batch)]
 
-        if len(self.share_obs.shape) > 4:
-            share_obs = self.share_obs[:-1].transpose(1, 2, 0, 3, 4, 5).reshape(-1, *self.share_obs.shape[3:])
-            obs = self.obs[:-1].transpose(1, 2, 0, 3, 4, 5).reshape(-1, *self.obs.shape[3:])
-        else:
-            share_obs = _cast(self.share_obs[:-1])
-            obs = _cast(self.obs[:-1])
-
-        actions = _cast(self.actions)
-        action_log_probs = _cast(self.action_log_probs)
-        advantages = _cast(advantages)
-        value_preds = _cast(self.value_preds[:-1])
-        returns = _cast(self.returns[:-1])
-        masks = _cast(self.masks[:-1])
-        active_masks = _cast(self.active_masks[:-1])
-        # rnn_states = _cast(self.rnn_states[:-1])
-        # rnn_states_critic = _cast(self.rnn_states_critic[:-1])
-        rnn_states = self.rnn_states[:-1].transpose(1, 2, 0, 3, 4).reshape(-1, *self.rnn_states.shape[3:])
-        rnn_states_critic = self.rnn_states_critic[:-1].transpose(1, 2, 0, 3, 4).reshape(-1,
-                                                                                         *self.rnn_states_critic.shape[
-                                                                                          3:])
-
-        if self.available_actions is not None:
-            available_actions = _cast(self.available_actions[:-1])
+        chunk_t, chunk_n, chunk_m = self._get_chunk_indices(data_chunk_length)
 
         for indices in sampler:
-            share_obs_batch = []
-            obs_batch = []
-            rnn_states_batch = []
-            rnn_states_critic_batch = []
-            actions_batch = []
-            available_actions_batch = []
-            value_preds_batch = []
-            return_batch = []
-            masks_batch = []
-            active_masks_batch = []
-            old_action_log_probs_batch = []
-            adv_targ = []
-
-            for index in indices:
-
-                ind = index * data_chunk_length
-                # size [T+1 N M Dim]-->[T N M Dim]-->[N,M,T,Dim]-->[N*M*T,Dim]-->[L,Dim]
-                share_obs_batch.append(share_obs[ind:ind + data_chunk_length])
-                obs_batch.append(obs[ind:ind + data_chunk_length])
-                actions_batch.append(actions[ind:ind + data_chunk_length])
-                if self.available_actions is not None:
-                    available_actions_batch.append(available_actions[ind:ind + data_chunk_length])
-                value_preds_batch.append(value_preds[ind:ind + data_chunk_length])
-                return_batch.append(returns[ind:ind + data_chunk_length])
-                masks_batch.append(masks[ind:ind + data_chunk_length])
-                active_masks_batch.append(active_masks[ind:ind + data_chunk_length])
-                old_action_log_probs_batch.append(action_log_probs[ind:ind + data_chunk_length])
-                adv_targ.append(advantages[ind:ind + data_chunk_length])
-                # size [T+1 N M Dim]-->[T N M Dim]-->[N M T Dim]-->[N*M*T,Dim]-->[1,Dim]
-                rnn_states_batch.append(rnn_states[ind])
-                rnn_states_critic_batch.append(rnn_states_critic[ind])
-
-            L, N = data_chunk_length, mini_batch_size
-
-            # These are all from_numpys of size (L, N, Dim)           
-            share_obs_batch = np.stack(share_obs_batch, axis=1)
-            obs_batch = np.stack(obs_batch, axis=1)
-
-            actions_batch = np.stack(actions_batch, axis=1)
-            if self.available_actions is not None:
-                available_actions_batch = np.stack(available_actions_batch, axis=1)
-            value_preds_batch = np.stack(value_preds_batch, axis=1)
-            return_batch = np.stack(return_batch, axis=1)
-            masks_batch = np.stack(masks_batch, axis=1)
-            active_masks_batch = np.stack(active_masks_batch, axis=1)
-            old_action_log_probs_batch = np.stack(old_action_log_probs_batch, axis=1)
-            adv_targ = np.stack(adv_targ, axis=1)
-
-            # States is just a (N, -1) from_numpy
-            rnn_states_batch = np.stack(rnn_states_batch).reshape(N, *self.rnn_states.shape[3:])
-            rnn_states_critic_batch = np.stack(rnn_states_critic_batch).reshape(N, *self.rnn_states_critic.shape[3:])
-
-            # Flatten the (L, N, ...) from_numpys to (L * N, ...)
-            share_obs_batch = _flatten(L, N, share_obs_batch)
-            obs_batch = _flatten(L, N, obs_batch)
-            actions_batch = _flatten(L, N, actions_batch)
+            # size [T+1 N M Dim]-->[L, N, Dim]-->[L * N, Dim], gathered straight from the buffer
+            t, n, m = (x[indices].T.reshape(-1) for x in (chunk_t, chunk_n, chunk_m))
+            share_obs_batch = self.share_obs[t, n, m]
+            obs_batch = self.obs[t, n, m]
+            actions_batch = self.actions[t, n, m]
             if self.available_actions is not None:
-                available_actions_batch = _flatten(L, N, available_actions_batch)
+                available_actions_batch = self.available_actions[t, n, m]
             else:
                 available_actions_batch = None
-            value_preds_batch = _flatten(L, N, value_preds_batch)
-            return_batch = _flatten(L, N, return_batch)
-            masks_batch = _flatten(L, N, masks_batch)
-            active_masks_batch = _flatten(L, N, active_masks_batch)
-            old_action_log_probs_batch = _flatten(L, N, old_action_log_probs_batch)
-            adv_targ = _flatten(L, N, adv_targ)
+            value_preds_batch = self.value_preds[t, n, m]
+            return_batch = self.returns[t, n, m]
+            masks_batch = self.masks[t, n, m]
+            active_masks_batch = self.active_masks[t, n, m]
+            old_action_log_probs_batch = self.action_log_probs[t, n, m]
+            adv_targ = advantages[t, n, m]
+
+            # States is just a (N, -1) array, taken at the first step of each chunk
+            t, n, m = chunk_t[indices, 0], chunk_n[indices, 0], chunk_m[indices, 0]
+            rnn_states_batch = self.rnn_states[t, n, m]
+            rnn_states_critic_batch = self.rnn_states_critic[t, n, m]
 
             yield share_obs_batch, obs_batch, rnn_states_batch, rnn_states_critic_batch, actions_batch,\
                   value_preds_batch, return_batch, masks_batch, active_masks_batch, old_action_log_probs_batch,\
                   adv_targ, available_actions_batch
+
+
+class TorchSharedReplayBuffer(SharedReplayBuffer):
+    """
+    SharedReplayBuffer that keeps its data in preallocated torch tensors on the training device.
+    Inserts write straight into the tensors and the generators yield tensors, so minibatches
+    need no numpy to torch conversion or host to device copy. Data passed to insert may be
+    numpy arrays or tensors.
+    :param device: (torch.device) device to keep the buffer on.
+    See SharedReplayBuffer for the remaining parameters.
+    """
+
+    _fields = ['share_obs', 'obs', 'rnn_states', 'rnn_states_critic', 'value_preds', 'returns',
+               'available_actions', 'actions', 'action_log_probs', 'rewards', 'masks', 'bad_masks',
+               'active_masks']
+
+    def __init__(self, args, num_agents, obs_space, cent_obs_space, act_space, device=torch.device("cpu")):
+        super(TorchSharedReplayBuffer, self).__init__(args, num_agents, obs_space, cent_obs_space, act_space)
+        self.device = device
+        self.tpdv = dict(dtype=torch.float32, device=device)
+        obs_dtype = getattr(torch, args.compact_obs_dtype) if self._use_compact_buffer else torch.float32
+        for name in self._fields:
+            value = getattr(self, name)
+            if value is not None:
+                value = torch.from_numpy(value).to(self.device)
+                if name in ['share_obs', 'obs']:
+                    value = value.to(obs_dtype)
+                setattr(self, name, value)
+
+    def nbytes(self):
+        """Memory used by the buffer's tensors, in bytes."""
+        values = [getattr(self, name) for name in self._fields]
+        return sum(x.element_size() * x.nelement() for x in values if x is not None)
+
+    def check(self, x):
+        """Convert numpy arrays and tensors to float32 tensors on the buffer's device."""
+        return torch.as_tensor(x, **self.tpdv)
+
+    def _set(self, tensor, index, x):
+        tensor[index] = torch.as_tensor(x, dtype=tensor.dtype, device=self.device)
+
+    def _as_float(self, x):
+        return x.float()
+
+    def insert(self, share_obs, obs, rnn_states_actor, rnn_states_critic, actions, action_log_probs,
+               value_preds, rewards, masks, bad_masks=None, active_masks=None, available_actions=None):
+        """Insert data into the buffer. See SharedReplayBuffer.insert."""
+        self.insert_envs(slice(None), share_obs, obs, rnn_states_actor, rnn_states_critic, actions,
+                         action_log_probs, value_preds, rewards, masks, bad_masks, active_masks, available_actions)
+        self.step = (self.step + 1) % self.episode_length
+
+    def insert_envs(self, env_ids, share_obs, obs, rnn_states_actor, rnn_states_critic, actions, action_log_probs,
+                    value_preds, rewards, masks, bad_masks=None, active_masks=None, available_actions=None):
+        """
+        Insert data for a subset of the envs at their own step cursors, see SharedReplayBuffer.insert_envs.
+        If env_ids is slice(None), all envs are written at self.step instead.
+        """
+        if isinstance(env_ids, slice):
+            steps = self.step
+        else:
+            steps = self.env_steps[env_ids]
+            assert np.all(steps < self.episode_length), "env stepped past the end of the episode"
+        self._set(self.share_obs, (steps + 1, env_ids), share_obs)
+        self._set(self.obs, (steps + 1, env_ids), obs)
+        self._set(self.rnn_states, (steps + 1, env_ids), rnn_states_actor)
+        self._set(self.rnn_states_critic, (steps + 1, env_ids), rnn_states_critic)
+        self._set(self.actions, (steps, env_ids), actions)
+        self._set(self.action_log_probs, (steps, env_ids), action_log_probs)
+        self._set(self.value_preds, (steps, env_ids), value_preds)
+        self._set(self.rewards, (steps, env_ids), rewards)
+        self._set(self.masks, (steps + 1, env_ids), masks)
+        if bad_masks is not None:
+            self._set(self.bad_masks, (steps + 1, env_ids), bad_masks)
+        if active_masks is not None:
+            self._set(self.active_masks, (steps + 1, env_ids), active_masks)
+        if available_actions is not None:
+            self._set(self.available_actions, (steps + 1, env_ids), available_actions)
+
+        if not isinstance(env_ids, slice):
+            self.env_steps[env_ids] += 1
+
+    def after_update(self, next_buffer=None):
+        """
+        Copy last timestep data to first index. Called after update to model.
+        :param next_buffer: (TorchSharedReplayBuffer) buffer the next rollout is collected into, this buffer if None.
+        """
+        next_buffer = self if next_buffer is None else next_buffer
+        for name in ['share_obs', 'obs', 'rnn_states', 'rnn_states_critic', 'masks', 'bad_masks',
+                     'active_masks', 'available_actions']:
+            value = getattr(self, name)
+            if value is not None:
+                getattr(next_buffer, name)[0] = value[-1]
+        self.env_steps[:] = 0
+
+    def compute_returns(self, next_value, value_normalizer=None):
+        """
+        Compute returns either as discounted sum of rewards, or using GAE, on the buffer's device.
+        :param next_value: (np.ndarray / torch.Tensor) value predictions for the step after the last episode step.
+        :param value_normalizer: (PopArt) If not None, PopArt value normalizer instance.
+        """
+        super(TorchSharedReplayBuffer, self).compute_returns(self.check(next_value), value_normalizer)
+
+    def _get_chunk_indices(self, data_chunk_length):
+        """Chunk indices of SharedReplayBuffer._get_chunk_indices, as tensors on the buffer's device."""
+        if self._chunk_indices is None or self._chunk_indices[0] != data_chunk_length:
+            chunk_indices = super(TorchSharedReplayBuffer, self)._get_chunk_indices(data_chunk_length)
+            self._chunk_indices = (data_chunk_length,) + tuple(
+                torch.from_numpy(x).to(self.device) for x in chunk_indices)
+        return self._chunk_indices[1:]
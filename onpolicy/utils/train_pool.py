@@ -0,0 +1,117 @@
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+def _share_buffer(buffer, memo):
+    """
+    Move the arrays of buffer into shared memory, in place. Arrays shared between buffers stay shared.
+    :return state: (dict) attributes of buffer, with the arrays replaced by the shared tensors they are views of.
+    """
+    state = {}
+    for name, value in vars(buffer).items():
+        if isinstance(value, np.ndarray):
+            if id(value) not in memo:
+                # keep the original array alive, so that its id is not reused while sharing
+                memo[id(value)] = value, torch.from_numpy(value).share_memory_()
+            value = memo[id(value)][1]
+            setattr(buffer, name, value.numpy())
+        state[name] = value
+    return state
+
+
+def _restore_buffer(cls, state):
+    buffer = cls.__new__(cls)
+    for name, value in state.items():
+        setattr(buffer, name, value.numpy() if torch.is_tensor(value) else value)
+    return buffer
+
+
+def _work(conn, trainers, buffers, n_threads):
+    """Train loop of one worker process. Trains its trainers one after another on every request."""
+    torch.set_num_threads(n_threads)
+    buffers = [_restore_buffer(*buffer) for buffer in buffers]
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        train_infos = []
+        for trainer, buffer, (seed, actor_lr, critic_lr) in zip(trainers, buffers, request):
+            # learning rates are decayed by the main process
+            for param_group in trainer.policy.actor_optimizer.param_groups:
+                param_group['lr'] = actor_lr
+            for param_group in trainer.policy.critic_optimizer.param_groups:
+                param_group['lr'] = critic_lr
+            trainer.prep_training()
+            train_info = trainer.train(buffer, generator=torch.Generator().manual_seed(seed))
+            # some entries are tensors that are still attached to the graph
+            train_infos.append({k: v.item() if torch.is_tensor(v) else v for k, v in train_info.items()})
+        conn.send(train_infos)
+    conn.close()
+
+
+class TrainPool(object):
+    """
+    Trains independent R_MAPPO trainers concurrently in worker processes, so that every trainer gets cores of
+    its own instead of sharing the interpreter with the others. Trainer i is owned by worker i % n_workers,
+    which keeps its optimizer state. Weights, value normalizers and buffers are moved to shared memory, so the
+    main process sees the updates in place and only seeds, learning rates and train infos go through the pipes.
+    Buffers have to keep their arrays, they are replaced by shared memory views once.
+    :param trainers: (list) R_MAPPO trainers to train.
+    :param buffers: (list) buffer of every trainer.
+    :param n_workers: (int) number of worker processes, one per trainer if None.
+    :param n_threads: (int) number of torch threads of every worker.
+    """
+    def __init__(self, trainers, buffers, n_workers=None, n_threads=1):
+        self.trainers = trainers
+        self.n_workers = len(trainers) if n_workers is None else max(1, min(n_workers, len(trainers)))
+
+        memo = {}
+        states = [(type(buffer), _share_buffer(buffer, memo)) for buffer in buffers]
+        for trainer in trainers:
+            trainer.policy.actor.share_memory()
+            trainer.policy.critic.share_memory()
+            if trainer.value_normalizer is not None:
+                trainer.value_normalizer.share_memory()
+
+        # spawn instead of fork, so that the workers can use CUDA
+        ctx = mp.get_context('spawn')
+        self.conns, self.processes = [], []
+        for worker in range(self.n_workers):
+            conn, worker_conn = ctx.Pipe()
+            process = ctx.Process(target=_work, args=(worker_conn, trainers[worker::self.n_workers],
+                                                      states[worker::self.n_workers], n_threads))
+            process.daemon = True
+            process.start()
+            worker_conn.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+        self.closed = False
+
+    def train(self, seeds):
+        """
+        Train every trainer on its buffer, with minibatches shuffled by a generator seeded with its seed.
+        :param seeds: (list) seed of every trainer.
+
+        :return train_infos: (list) train info of every trainer.
+        """
+        requests = [(seed, trainer.policy.actor_optimizer.param_groups[0]['lr'],
+                     trainer.policy.critic_optimizer.param_groups[0]['lr'])
+                    for trainer, seed in zip(self.trainers, seeds)]
+        for worker, conn in enumerate(self.conns):
+            conn.send(requests[worker::self.n_workers])
+        train_infos = [None] * len(self.trainers)
+        for worker, conn in enumerate(self.conns):
+            train_infos[worker::self.n_workers] = conn.recv()
+        return train_infos
+
+    def close(self):
+        if self.closed:
+            return
+        for conn in self.conns:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+        for conn in self.conns:
+            conn.close()
+        self.closed = True
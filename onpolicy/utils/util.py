@@ -28,6 +28,47 @@ def huber_loss(e, d):
 def mse_loss(e):
     return e**2/2
 
+def compute_gae_returns(rewards, values, masks, bad_masks, gamma, gae_lambda, use_proper_time_limits=False):
+    """
+    Compute GAE returns for a whole rollout, vectorized over all dimensions but time.
+    Works on numpy arrays as well as on torch tensors, which stay on their device.
+    :param rewards: (np.ndarray / torch.Tensor) rewards of shape (T, ...).
+    :param values: (np.ndarray / torch.Tensor) denormalized value predictions of shape (T + 1, ...).
+    :param masks: (np.ndarray / torch.Tensor) masks of shape (T + 1, ...), 0 where an episode ended.
+    :param bad_masks: (np.ndarray / torch.Tensor) bad masks of shape (T + 1, ...), 0 where an episode was truncated.
+    :param use_proper_time_limits: (bool) whether to cut the advantages at truncated episodes.
+    :return returns: (np.ndarray / torch.Tensor) returns of shape (T, ...).
+    """
+    zeros_like = torch.zeros_like if torch.is_tensor(rewards) else np.zeros_like
+    deltas = rewards + gamma * values[1:] * masks[1:] - values[:-1]
+    advantages = zeros_like(rewards)
+    gae = 0
+    for step in reversed(range(rewards.shape[0])):
+        gae = deltas[step] + gamma * gae_lambda * masks[step + 1] * gae
+        if use_proper_time_limits:
+            gae = gae * bad_masks[step + 1]
+        advantages[step] = gae
+    return advantages + values[:-1]
+
+def compute_discounted_returns(returns, rewards, values, masks, bad_masks, gamma, use_proper_time_limits=False):
+    """
+    Compute discounted returns in place, bootstrapping from returns[-1].
+    Works on numpy arrays as well as on torch tensors, which stay on their device.
+    :param returns: (np.ndarray / torch.Tensor) returns of shape (T + 1, ...), the last one set to the next value.
+    :param rewards: (np.ndarray / torch.Tensor) rewards of shape (T, ...).
+    :param values: (np.ndarray / torch.Tensor) denormalized value predictions, used for truncated episodes.
+    :param masks: (np.ndarray / torch.Tensor) masks of shape (T + 1, ...), 0 where an episode ended.
+    :param bad_masks: (np.ndarray / torch.Tensor) bad masks of shape (T + 1, ...), 0 where an episode was truncated.
+    :param use_proper_time_limits: (bool) whether to bootstrap from values at truncated episodes.
+    """
+    for step in reversed(range(rewards.shape[0])):
+        if use_proper_time_limits:
+            returns[step] = (returns[step + 1] * gamma * masks[step + 1] + rewards[step]) * bad_masks[step + 1] \
+                + (1 - bad_masks[step + 1]) * values[step]
+        else:
+            returns[step] = returns[step + 1] * gamma * masks[step + 1] + rewards[step]
+    return returns
+
 def get_shape_from_obs_space(obs_space):
     if obs_space.__class__.__name__ == 'Box':
         obs_shape = obs_space.shape
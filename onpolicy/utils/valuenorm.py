@@ -2,13 +2,15 @@
 import numpy as np
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 
 
 class ValueNorm(nn.Module):
     """ Normalize a vector of observations - across the first norm_axes dimensions"""
 
-    def __init__(self, input_shape, norm_axes=1, beta=0.99999, per_element_update=False, epsilon=1e-5, device=torch.device("cpu")):
+    def __init__(self, input_shape, norm_axes=1, beta=0.99999, per_element_update=False, epsilon=1e-5, device=torch.device("cpu"),
+                 distributed=False):
         super(ValueNorm, self).__init__()
 
         self.input_shape = input_shape
@@ -16,6 +18,8 @@ class ValueNorm(nn.Module):
         self.epsilon = epsilon
         self.beta = beta
         self.per_element_update = per_element_update
+        # average the batch statistics over all processes of the default process group
+        self.distributed = distributed
         self.tpdv = dict(dtype=torch.float32, device=device)
 
         self.running_mean = nn.Parameter(torch.zeros(input_shape), requires_grad=False).to(**self.tpdv)
@@ -43,9 +47,17 @@ class ValueNorm(nn.Module):
 
         batch_mean = input_vector.mean(dim=tuple(range(self.norm_axes)))
         batch_sq_mean = (input_vector ** 2).mean(dim=tuple(range(self.norm_axes)))
+        batch_size = np.prod(input_vector.size()[:self.norm_axes])
+
+        if self.distributed:
+            # every process updates with the same batches, so the running statistics stay identical
+            world_size = dist.get_world_size()
+            stats = torch.stack([batch_mean, batch_sq_mean])
+            dist.all_reduce(stats)
+            batch_mean, batch_sq_mean = stats / world_size
+            batch_size *= world_size
 
         if self.per_element_update:
-            batch_size = np.prod(input_vector.size()[:self.norm_axes])
             weight = self.beta ** batch_size
         else:
             weight = self.beta
@@ -67,13 +79,16 @@ class ValueNorm(nn.Module):
 
     def denormalize(self, input_vector):
         """ Transform normalized data back into original distribution """
-        if type(input_vector) == np.ndarray:
+        # numpy arrays are returned as numpy arrays, tensors stay tensors
+        is_numpy = type(input_vector) == np.ndarray
+        if is_numpy:
             input_vector = torch.from_numpy(input_vector)
         input_vector = input_vector.to(**self.tpdv)
 
         mean, var = self.running_mean_var()
         out = input_vector * torch.sqrt(var)[(None,) * self.norm_axes] + mean[(None,) * self.norm_axes]
         
-        out = out.cpu().numpy()
+        if is_numpy:
+            out = out.cpu().numpy()
         
         return out